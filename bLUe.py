@@ -145,7 +145,7 @@ from PySide2.QtGui import QPixmap, QCursor, QKeySequence, QDesktopServices, QFon
     QTransform, QColor, QImage, QIcon
 from PySide2.QtWidgets import QApplication, QAction, \
     QDockWidget, QSizePolicy, QSplashScreen, QWidget, \
-    QTabWidget, QToolBar, QComboBox, QTabBar
+    QTabWidget, QToolBar, QComboBox, QTabBar, QProgressBar
 from bLUeTop.QtGui1 import app, window, splitWin
 from bLUeTop import exiftool
 from bLUeTop.graphicsBlendFilter import blendFilterForm
@@ -157,7 +157,9 @@ from bLUeTop.graphicsRaw import rawForm
 from bLUeTop.graphicsTransform import transForm, imageForm
 from bLUeGui.bLUeImage import QImageBuffer, QImageFormats
 from bLUeTop.presetReader import aParser
+from bLUeTop.histogramService import histogramService
 from bLUeTop.rawProcessing import rawRead
+from bLUeTop import rawBatch
 from bLUeTop.versatileImg import vImage, metadataBag
 from bLUeTop.MarkedImg import imImage, QRawLayer, QCloningLayer
 from bLUeTop.graphicsRGBLUT import graphicsForm
@@ -270,11 +272,13 @@ def addBasicAdjustmentLayers(img, window=window):
     window.tableView.select(0, 1)
 
 
-def addRawAdjustmentLayer(window=window):
+def addRawAdjustmentLayer(index=None, window=window):
     """
     Add a development layer to the layer stack
+    @param index: stack index of the layer below, default is the active layer
+    @type index: int
     """
-    rlayer = window.label.img.addAdjustmentLayer(layerType=QRawLayer, name='Develop', role='RAW')
+    rlayer = window.label.img.addAdjustmentLayer(layerType=QRawLayer, name='Develop', role='RAW', index=index)
     grWindow = rawForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=rlayer, parent=window)
     # wrapper for the right apply method
     pool = getPool()
@@ -316,7 +320,13 @@ def loadImage(img, withBasic=True, window=window):
     # window.tableView.previewOptionBox.stateChanged.emit(Qt.Checked)  # TODO removed 22/02/20 stack is processed below validate
     # add development layer for raw image, and develop
     if img.rawImage is not None:
-        addRawAdjustmentLayer()
+        if img.rawPending:
+            # the embedded preview is displayed until the image is developed
+            img.rawLayerPending = True
+            img.onRawDeveloped = lambda: installRawLayer()
+            img.developRaw()
+        else:
+            addRawAdjustmentLayer()
     # add default adjustment layers
     if withBasic:
         addBasicAdjustmentLayers(img)
@@ -325,6 +335,26 @@ def loadImage(img, withBasic=True, window=window):
     img.onImageChanged()
 
 
+def installRawLayer(window=window):
+    """
+    Adds the development layer to the current document, if
+    it was opened from the embedded preview of a raw file and its
+    development is done. For a non current document, this is
+    deferred until the document becomes current.
+    """
+    img = window.label.img
+    if not getattr(img, 'rawLayerPending', False) or img.rawPending:
+        return
+    img.rawLayerPending = False
+    # the before image was the embedded preview
+    window.label_2.img = imImage(QImg=img, meta=img.meta)
+    window.label_2.img.isMouseSelectable = False
+    addRawAdjustmentLayer(index=0)
+    img.layersStack[0].applyToStack()
+    img.onImageChanged()
+    updateStatus()
+
+
 def openFile(f, window=window):
     """
     Top level function for file opening, used by File Menu actions
@@ -428,6 +458,7 @@ def closeTabs(index=None, window=window):
         return
     window.tableView.clear(delete=True)
     window.histView.targetImage = None
+    window.histView.service.cancel()
     defaultImImage = initDefaultImage()
     window.label.img = defaultImImage
     window.label_2.img = defaultImImage
@@ -441,12 +472,10 @@ def closeTabs(index=None, window=window):
 def showHistogram(window=window):
     """
     Update and display the histogram of the
-    currently opened document
+    currently opened document. Unless the Exact option
+    is checked, the histogram is computed in background from a
+    subsample of the image, and displayed when ready.
     """
-    if window.histView.listWidget1.items['Original Image'].checkState() is Qt.Checked:
-        histImg = vImage(QImg=window.label.img.getCurrentImage())  # must be vImage : histogram method needed
-    else:
-        histImg = window.label.img.layersStack[-1].getCurrentMaskedImage()
     if window.histView.options['R'] or window.histView.options['G'] or window.histView.options['B']:
         window.histView.mode = 'RGB'
         window.histView.chanColors = [QColor(255, 0, 0), QColor(0, 255, 0), QColor(10, 10, 255)]
@@ -455,11 +484,21 @@ def showHistogram(window=window):
         window.histView.mode = 'Luminosity'
         window.histView.chanColors = [Qt.gray]
         window.histView.chans = []
-    histView = histImg.histogram(QSize(window.histView.width(), window.histView.height()),
-                                 chans=window.histView.chans, bgColor=Qt.black,
-                                 chanColors=window.histView.chanColors, mode=window.histView.mode, addMode='Luminosity' if window.histView.options['L'] else '')
-    window.histView.cache = QPixmap.fromImage(histView)
-    window.histView.Label_Hist.setPixmap(window.histView.cache)
+    kwargs = {'size': QSize(window.histView.width(), window.histView.height()),
+              'chans': window.histView.chans, 'bgColor': Qt.black,
+              'chanColors': window.histView.chanColors, 'mode': window.histView.mode,
+              'addMode': 'Luminosity' if window.histView.options['L'] else ''}
+    if window.histView.options['Original Image']:
+        histImg = window.label.img.getCurrentImage()
+    else:
+        histImg = window.label.img.layersStack[-1].getCurrentMaskedImage()
+    if window.histView.options['Exact']:
+        window.histView.service.cancel()
+        if window.histView.options['Original Image']:
+            histImg = vImage(QImg=histImg)  # must be vImage : histogram method needed
+        window.histView.setHistogram(histImg.histogram(sampleSize=None, **kwargs))
+    else:
+        window.histView.service.submit(histogramService.sample(histImg), **kwargs)
 
 
 def restoreBrush(layer):
@@ -535,6 +574,7 @@ def setDocumentImage(img, window=window):
             return
         # recompute and display histogram for the selected image
         showHistogram()
+        updateStatus()
 
     # active layer changed event handler
     def g():
@@ -545,8 +585,17 @@ def setDocumentImage(img, window=window):
                 layer.brushDict = window.label.State['brush']
             restoreBrush(layer)
 
+    # background rendering progress handler
+    def h(value):
+        if window.label.img is not img:
+            return
+        window.renderProgress.setValue(value)
+        window.renderProgress.setVisible(value < 100)
+
     window.label.img.onImageChanged = f
     window.label.img.onActiveLayerChanged = g
+    window.label.img.onRenderProgress = h
+    window.renderProgress.hide()
 
     # init = first change
     f()
@@ -580,6 +629,8 @@ def setDocumentImage(img, window=window):
     window.label_2.update()
     window.label_3.update()
     updateStatus()
+    # development of a raw image terminated while the document was not current
+    installRawLayer()
     gc.collect()  # tested (very) efficient here
     # back links used by graphicsForm3DLUT.onReset  # TODO 3/1/20 unused removed validate
     # window.label.img.window = window.label
@@ -716,6 +767,9 @@ def menuFile(name, window=window):
     # closing dialog : close opened document
     elif name == 'actionClose':
         closeTabs()
+    # batch development of raw files, using the settings of the current development layer
+    elif name == 'actionRaw_Batch':
+        rawBatchDevelop()
         # global pool
         # if pool is not None:
             # pool.close()
@@ -724,6 +778,58 @@ def menuFile(name, window=window):
     updateStatus()
 
 
+def rawBatchDevelop(window=window):
+    """
+    Develops a list of raw files in background, with the
+    settings of the development layer of the current document.
+    If a batch development is running, the user is asked to abort it.
+    """
+    batch = getattr(window, 'rawBatch', None)
+    if batch is not None:
+        # pending files are not developed, the report is shown when running jobs terminate
+        reply = QMessageBox.question(window, 'Batch Raw Development', 'A batch development is running.\nAbort it ?',
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            batch.abort()
+        return
+    rawLayers = [l for l in window.label.img.layersStack if l.isRawLayer()]
+    if not rawLayers:
+        dlgWarn('No development layer', 'Open a raw image and choose the development settings first')
+        return
+    settings = rawBatch.rawSettings(rawLayers[0])
+    lastDir = str(window.settings.value('paths/dlgdir', '.'))
+    filter = "Raw Images ( *" + " *".join(RAW_FILE_EXTENSIONS) + ")"
+    filenames = QFileDialog.getOpenFileNames(window, "Select raw files", lastDir, filter)[0]
+    if not filenames:
+        return
+    outDir = QFileDialog.getExistingDirectory(window, "Output folder",
+                                              str(window.settings.value('paths/dlgsavedir', lastDir)))
+    if not outDir:
+        return
+    reply = QMessageBox()
+    reply.setWindowTitle('Batch Raw Development')
+    reply.setText('Output format')
+    jpgButton = reply.addButton('JPEG', QMessageBox.AcceptRole)
+    tifButton = reply.addButton('TIFF', QMessageBox.AcceptRole)
+    reply.addButton(QMessageBox.Cancel)
+    reply.exec_()
+    if reply.clickedButton() not in [jpgButton, tifButton]:
+        return
+    batch = rawBatch.rawBatch(filenames, settings, outDir, fileFormat='jpg' if reply.clickedButton() is jpgButton else 'tif')
+
+    def done():
+        window.rawBatch = None
+        updateStatus()
+        w = labelDlg(parent=window, title='Batch Raw Development', wSize=QSize(700, 400))
+        w.label.setText(batch.report())
+        w.show()
+    batch.onFileDone = lambda i: updateStatus()
+    batch.onFinished = done
+    window.rawBatch = batch
+    batch.start()
+    updateStatus()
+
+
 def menuView(name, window=window):
     """
     Menu handler
@@ -1039,6 +1145,7 @@ def menuLayer(name, window=window):
                 rawpyInst = rawRead(filename)
                 # postprocess raw image, applying default settings (cf. vImage.applyRawPostProcessing)
                 rawBuf = rawpyInst.postprocess(use_camera_wb=True)
+                rawpyInst.release()
                 # build Qimage : swittch to BGR and add alpha channel
                 rawBuf = np.dstack((rawBuf[:, :, ::-1], np.zeros(rawBuf.shape[:2], dtype=np.uint8) + 255))
                 imgNew = vImage(cv2Img=rawBuf)
@@ -1304,6 +1411,11 @@ def canClose(index=None, window=window):
         return True
     closeAllRequested = (index is None)
 
+    def removeTab(ind):
+        img = window.tabBar.tabData(ind)
+        window.tabBar.removeTab(ind)
+        img.releaseRaw()
+
     def canCloseTab(ind):
         img = window.tabBar.tabData(ind)
         if img.isModified:
@@ -1324,7 +1436,7 @@ def canClose(index=None, window=window):
                                             writeMeta=writeMeta)
                     # confirm saving
                     dlgInfo("%s written" % filename)
-                    window.tabBar.removeTab(ind)
+                    removeTab(ind)
                     return True
                 elif ret == QMessageBox.Cancel:
                     return False
@@ -1332,7 +1444,7 @@ def canClose(index=None, window=window):
                 dlgWarn(str(e))
                 return False
         # discard changes or img not modified : remove tab
-        window.tabBar.removeTab(ind)
+        removeTab(ind)
         return True
 
     if closeAllRequested:
@@ -1369,7 +1481,19 @@ def updateStatus(window=window):
     if window.label.img.isCropped:
         w, h = window.cropTool.crWidth, window.cropTool.crHeight
         s = s + '&nbsp;&nbsp;&nbsp;&nbsp;Cropped : %dx%d h/w=%.2f ' % (w, h, h / w)
+    # memory used by raw development
+    tip = ''
+    rawLayers = [l for l in img.layersStack if l.isRawLayer()]
+    if rawLayers:
+        d = rawLayers[0].memoryUsage()
+        s = s + '&nbsp;&nbsp;&nbsp;&nbsp;Raw : %d MB' % (sum(d.values()) >> 20)
+        tip = '\n'.join(['%s : %.1f MB' % (k, v / 2**20) for k, v in d.items()])
+    # batch development
+    batch = getattr(window, 'rawBatch', None)
+    if batch is not None:
+        s = s + '&nbsp;&nbsp;&nbsp;&nbsp;Batch : %d/%d' % (sum(r is not None for r in batch.results), len(batch.results))
     window.Label_status.setText(s)
+    window.Label_status.setToolTip(tip)
 
 
 def initCursors(window=window):
@@ -1645,6 +1769,13 @@ def setupGUI(window=window):
     window.Label_status = QLabel()
     # window.Label_status.setStyleSheet("border: 15px solid white;")
     window.statusBar().addWidget(window.Label_status)
+    # background rendering progress indicator
+    window.renderProgress = QProgressBar()
+    window.renderProgress.setRange(0, 100)
+    window.renderProgress.setTextVisible(False)
+    window.renderProgress.setMaximumSize(100, 10)
+    window.renderProgress.hide()
+    window.statusBar().addPermanentWidget(window.renderProgress)
     # permanent text to right
     window.statusBar().addPermanentWidget(QLabel('Shift+F1 for Context Help       '))
     window.updateStatus = updateStatus
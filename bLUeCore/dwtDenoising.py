@@ -15,9 +15,26 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import pywt
-from .rollingStats import movingAverage
+from .rollingStats import movingAverages
+
+# window sizes for the estimation of the local variance of the coefficients (Wiener filter)
+WIENER_WINDOW_SIZES = (3, 5, 7, 9)
+
+# pool of threads for channels and coefficient bands.
+# pywt and numpy release the GIL, so bands are processed concurrently.
+dwtPool = None
+
+
+def getDwtPool():
+    global dwtPool
+    if dwtPool is None:
+        dwtPool = ThreadPool(max(cpu_count(), 1))
+    return dwtPool
 
 
 def noiseEstimation(DWT_coeffs):
@@ -73,67 +90,108 @@ def dwtDenoiseChan(image, chan=0, thr=1.0, thrmode='hard', wavelet='haar', level
     @rtype: ndarray, same shape as the image channel, dtype= np.float
 
     """
-    imArray = image[:, :, chan]
-    w, h = imArray.shape[1], imArray.shape[0]
-    #################
-    # apply DWT
-    # DWT_coeffs is the list of DWT coefficients :
-    # DWT_coeffs[0] : array and for i>=1, DWT_coeffs[i] : dict of arrays(wavedecn),
-    # or t-uple of arrays (wavedec2)
-    # For each array a, a.ndims = imArray.ndims
-    ###############
-    DWT_coeffs = pywt.wavedecn(imArray, wavelet, level=level)
-    if thrmode == 'hard' or thrmode == 'soft':
-        # stack all arrays from coeffs in a single ndims-dimensional array
-        a, s = pywt.coeffs_to_array(DWT_coeffs)  # a:array, s:strides
-        # keep details coefficients only
-        mask = np.ones(a.shape, dtype=np.bool)
-        mask[s[0][0], s[0][1]] = False
+    return dwtDenoise(image, thr=thr, thrmode=thrmode, wavelet=wavelet, level=level, chans=(chan,))[:, :, 0]
+
+
+def filterBand(coeff, thr, thrmode):
+    """
+    Filters in place a band of DWT detail coefficients.
+    For the local Wiener filter, thr is the noise variance.
+    @param coeff: detail coefficients
+    @type coeff: ndarray, ndims=2, dtype=np.float32
+    @param thr: filtering threshold
+    @type thr: float
+    @param thrmode: one among 'hard', 'soft', 'wiener'
+    @type thrmode: str
+    """
+    if thr <= 0:
+        return
+    if thrmode == 'hard':
         # hard threshold: cut coeffs under thr
-        if thrmode == 'hard':
-            a[mask] = np.where(np.abs(a[mask]) < thr, 0, a[mask])
-            DWT_coeffs = pywt.array_to_coeffs(a, s)
+        coeff[np.abs(coeff) < thr] = 0
+    elif thrmode == 'soft':
         # soft threshold: filter h = max(0, (|a| - thr)) * sgn(a) / a
-        elif thrmode == 'soft':
-            a[mask] = np.where(np.abs(a[mask]) <= thr, 0, (np.sign(a[mask])) * (np.abs(a[mask])-thr))
-            DWT_coeffs = pywt.array_to_coeffs(a, s)
-    else:  # local Wiener Filter
-        # we do not estimate the noise variance sigma2 (a priori value or
-        # Mean Absolute Deviation method for instance).
-        # Instead, we use a variable interactive threshold set by the user
-        thr = thr/100
+        mag = np.abs(coeff)
+        np.subtract(mag, thr, out=mag)
+        np.maximum(mag, 0, out=mag)
+        np.copysign(mag, coeff, out=coeff)
+    else:
         ###################################################
+        # local Wiener filter.
         # Estimation of the variance of the coefficients of the
         # DWT transform.
         # we use an adaptative window-based estimation procedure
-        # to capture the effect of edges
+        # to capture the effect of edges : for each coeff Y, estimate E(Y**2)
+        # as the minimum of moving averages of coeff**2 over window sizes.
+        # All averages are computed from a single summed area table.
         ####################################################
-        win_sizes = (3, 5, 7, 9)
-        # skip approximation level and scan other levels
-        for all_coeff in DWT_coeffs[1:]:
-            nY2_est = np.empty(all_coeff['ad'].shape, dtype=float)
-            nY2_est.fill(np.inf)
-            # walk through H,V,D coefficients (2D arrays) at level i,
-            for coeff in all_coeff.values():
-                # for each coeff Y, estimate E(Y**2) as the minimum of
-                # moving averages of coeff**2 over window sizes.
-                for win_size in win_sizes:
-                    nY2 = movingAverage(coeff*coeff, win_size, version='strides')
-                    minmask = (nY2 < nY2_est)
-                    nY2_est[minmask] = nY2[minmask]
-                # The Wiener Estimator for a noisy signal Y with
-                # noise variance sigma is ~ max(0,E(Y**2) - sigma**2)/ (max(0, E(Y**2)-sigma**2) + sigma**2)
-                # here sigma**2 is the interactive threshold
-                coeff *= np.where(nY2_est > thr, 1.0 - thr / nY2_est, 0)
-    # apply inverse DWT
-    imArray = pywt.waverecn(DWT_coeffs, wavelet)
-    # waverecn sometimes returns a padded array
-    return imArray[:h, :w]
+        nY2_est = None
+        for nY2 in movingAverages(np.square(coeff), WIENER_WINDOW_SIZES):
+            nY2_est = nY2 if nY2_est is None else np.minimum(nY2_est, nY2, out=nY2_est)
+        # The Wiener Estimator for a noisy signal Y with
+        # noise variance sigma is ~ max(0,E(Y**2) - sigma**2)/ (max(0, E(Y**2)-sigma**2) + sigma**2)
+        # here sigma**2 is the interactive threshold. We use
+        # the filter 1 - thr / E(Y**2) if E(Y**2) > thr, 0 otherwise.
+        np.maximum(nY2_est, thr, out=nY2_est)
+        np.divide(thr, nY2_est, out=nY2_est)
+        np.subtract(1, nY2_est, out=nY2_est)
+        coeff *= nY2_est
 
 
-def dwtDenoise(image, thr=1.0, thrmode='hard', wavelet='haar', level=None):
-    for chan in image.shape[2]:
-        image[:, :, chan] = dwtDenoiseChan(image, chan=chan, thr=thr, thrmode=thrmode, wavelet=wavelet, level=level)
+def dwtDenoise(image, thr=1.0, thrmode='hard', wavelet='haar', level=None, chans=None):
+    """
+    Denoises channels of image, using a Discrete Wavelet Transform (cf. dwtDenoiseChan()).
+    Decompositions, coefficient bands of all channels and levels and
+    reconstructions are processed in parallel, by a pool of threads.
+    Computations are done in float32.
+    @param image: image array
+    @type image: ndarray, shape(h,w,d), dtype= float or int
+    @param thr: filtering threshold parameter A larger value should result in a smoother output.
+    @type thr: float
+    @param thrmode: one among 'hard', 'soft', 'wiener'
+    @type thrmode: str
+    @param wavelet: wavelet family
+    @type wavelet: str
+    @param level: max level of decomposition, automatic if level is None (default)
+    @type level: int or None
+    @param chans: channels to denoise, default all
+    @type chans: sequence of int
+    @return: the denoised channels
+    @rtype: ndarray, shape (h, w, len(chans)), dtype= np.float32
+    """
+    if chans is None:
+        chans = range(image.shape[2])
+    chans = list(chans)
+    h, w = image.shape[:2]
+    pool = getDwtPool()
+    #################
+    # apply DWT
+    # DWT_coeffs is the list of DWT coefficients :
+    # DWT_coeffs[0] : array and for i>=1, DWT_coeffs[i] : dict of arrays(wavedecn),
+    # For each array a, a.ndims = imArray.ndims
+    ###############
+    allCoeffs = pool.map(lambda c: pywt.wavedecn(np.ascontiguousarray(image[:, :, c], dtype=np.float32),
+                                                 wavelet, level=level),
+                         chans)
+    # we do not estimate the noise variance sigma2 (a priori value or
+    # Mean Absolute Deviation method for instance).
+    # Instead, we use a variable interactive threshold set by the user
+    if thrmode == 'wiener':
+        thr = thr / 100
+    # skip approximation level and filter H, V, D coefficients
+    # (2D arrays) of all levels and channels
+    bands = [coeff for DWT_coeffs in allCoeffs for details in DWT_coeffs[1:] for coeff in details.values()]
+    # largest bands first
+    bands.sort(key=lambda coeff: -coeff.size)
+    pool.map(lambda coeff: filterBand(coeff, thr, thrmode), bands)
+    # apply inverse DWT
+    out = np.empty((h, w, len(chans)), dtype=np.float32)
+
+    def f(i):
+        # waverecn sometimes returns a padded array
+        out[:, :, i] = pywt.waverecn(allCoeffs[i], wavelet)[:h, :w]
+    pool.map(f, range(len(chans)))
+    return out
 
 
 if __name__ == '__main__':
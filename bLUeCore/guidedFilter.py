@@ -0,0 +1,120 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import cv2
+import numpy as np
+
+"""
+Guided filter, cf.
+K. He, J. Sun, X. Tang, Guided Image Filtering, IEEE TPAMI, vol. 35, 2013, pp. 1397-1409,
+and K. He, J. Sun, Fast Guided Filter, arXiv:1505.00996, 2015.
+"""
+
+# the coefficients of the linear models are computed on images subsampled
+# by a factor radius // GUIDED_SUBSAMPLE_RATIO (fast guided filter)
+GUIDED_SUBSAMPLE_RATIO = 4
+
+
+def boxMean(a, r):
+    """
+    Mean over square windows of size 2 * r + 1, computed with running sums.
+    @param a:
+    @type a: ndarray, dtype np.float32
+    @param r: window radius
+    @type r: int
+    @return:
+    @rtype: ndarray, dtype np.float32
+    """
+    return cv2.boxFilter(a, -1, (2 * r + 1, 2 * r + 1), borderType=cv2.BORDER_REFLECT)
+
+
+def guidedFilter(img, radius, eps, subsample=None):
+    """
+    Edge-preserving smoothing of an image by a self-guided filter :
+    each channel is guided by itself. The cost per pixel does not
+    depend on radius. Computations are done in float32.
+    For a channel I, the output is mean(a) * I + mean(b), with
+    a = var(I) / (var(I) + eps), b = (1 - a) * mean(I), means and variances
+    being computed over windows of size 2 * radius + 1.
+    Regions with a variance much lower than eps are smoothed, edges
+    (variance much higher than eps) are preserved.
+    @param img: image
+    @type img: ndarray, shape (h, w) or (h, w, d)
+    @param radius: window radius
+    @type radius: int
+    @param eps: regularization, in squared image units
+    @type eps: float
+    @param subsample: subsampling factor of the fast guided filter, default radius // GUIDED_SUBSAMPLE_RATIO
+    @type subsample: int
+    @return: filtered image
+    @rtype: ndarray, same shape as img, dtype np.float32
+    """
+    radius = max(int(radius), 1)
+    if subsample is None:
+        subsample = max(radius // GUIDED_SUBSAMPLE_RATIO, 1)
+    I = img.astype(np.float32)
+    h, w = I.shape[:2]
+    if subsample > 1:
+        Is = cv2.resize(I, (max(w // subsample, 1), max(h // subsample, 1)), interpolation=cv2.INTER_AREA)
+        r = max(radius // subsample, 1)
+    else:
+        Is, r = I, radius
+    meanI = boxMean(Is, r)
+    # variance, in place
+    var = boxMean(Is * Is, r)
+    var -= meanI * meanI
+    np.maximum(var, 0, out=var)
+    # a = var / (var + eps), in place
+    a = var
+    denom = var + eps
+    np.divide(var, denom, out=a)
+    # b = (1 - a) * meanI, in place
+    b = meanI
+    b -= a * meanI
+    meanA, meanB = boxMean(a, r), boxMean(b, r)
+    if subsample > 1:
+        meanA = cv2.resize(meanA, (w, h), interpolation=cv2.INTER_LINEAR)
+        meanB = cv2.resize(meanB, (w, h), interpolation=cv2.INTER_LINEAR)
+    # output, in place
+    meanA *= I
+    meanA += meanB
+    return meanA
+
+
+def guidedSupport(radius):
+    """
+    Returns the radius of the support of the guided filter,
+    i.e. the width of the margins needed to filter tiles.
+    @param radius: window radius
+    @type radius: int
+    @return:
+    @rtype: int
+    """
+    radius = max(int(radius), 1)
+    return 2 * radius + 2 * max(radius // GUIDED_SUBSAMPLE_RATIO, 1)
+
+
+def guidedRadius(diameter):
+    """
+    Returns the radius of the guided filter equivalent to a bilateral
+    filter with a pixel neighborhood of given diameter.
+    @param diameter:
+    @type diameter: int
+    @return:
+    @rtype: int
+    """
+    return max(int(diameter) // 2, 1)
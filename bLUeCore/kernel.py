@@ -15,9 +15,16 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import cv2
 import numpy as np
 from math import erf
 
+# Gaussian blurs with larger standard deviations are computed by a cascade of box filters
+BOX_CASCADE_SIGMA = 3.0
+BOX_CASCADE_PASSES = 3
+# relative tolerance for the detection of separable kernels
+SEPARABLE_TOL = 1e-6
+
 
 class filterIndex():
     IDENTITY, UNSHARP, SHARPEN, BLUR1, BLUR2, SURFACEBLUR, GRADUALFILTER = range(7)
@@ -39,10 +46,29 @@ def phi(x, mu, sigma):
     return (1.0 + erf((x-mu)/(sigma*np.sqrt(2)))) / 2.0
 
 
+def gaussianKernel1D(w):
+    """
+    1D gaussian kernel of size w, centered.
+    The standard deviation sigma and w are bound by the relation w = 2.0 * int(4.0 * sigma + 0.5)
+    @param w: kernel size, should be odd
+    @type w: int
+    @return: gaussian kernel, size w
+    @rtype: 1D array, shape (w,), dtype numpy.float64
+    """
+    sigma = (w - 1.0) / 8.0
+    interval = 4.0 * sigma
+    points = np.linspace(-interval, interval, num=w + 1)
+    # gaussian CDF
+    cdf = np.fromiter((phi(x, 0, sigma) for x in points), dtype=np.float64, count=w + 1)
+    return np.diff(cdf)
+
+
 def gaussianKernel(mu, w):
     """
     2D gaussian kernel of size w and mean mu.
     The standard deviation sigma and w are bound by the relation w = 2.0 * int(4.0 * sigma + 0.5)
+    The kernel is separable : it is the outer product of the
+    vector returned by separableGaussian(w) with itself.
     @param mu: gaussian mean
     @type mu: float
     @param w: kernel size, should be odd
@@ -50,18 +76,34 @@ def gaussianKernel(mu, w):
     @return: gaussian kernel, size w
     @rtype: 2D array, shape (w,w), dtype numpy.float64
     """
-    sigma = (w - 1.0) / 8.0
-    interval = 4.0 * sigma
-    points = np.linspace(-interval, interval, num=w + 1)
-    # gaussian CDF
-    points = map(lambda x: phi(x, 0, sigma), points)
-    # 1D kernel
-    kern1d = np.diff(list(points))  # python 3
-    # 2D kernel
-    kernel_raw = np.sqrt(np.outer(kern1d, kern1d))
-    # normalize
-    kernel = kernel_raw / kernel_raw.sum()
-    return kernel
+    k = separableGaussian(w)
+    return np.outer(k, k)
+
+
+def separableGaussian(w):
+    """
+    Returns the 1D factor of the 2D gaussian kernel of size w.
+    As the 2D kernel is sqrt(outer(k, k)), with k the 1D gaussian
+    kernel of size w, the factor is sqrt(k), normalized.
+    @param w: kernel size
+    @type w: int
+    @return: 1D kernel
+    @rtype: 1D array, shape (w,), dtype numpy.float64
+    """
+    k = np.sqrt(gaussianKernel1D(w))
+    return k / k.sum()
+
+
+def gaussianSigma(w):
+    """
+    Returns the standard deviation of the 2D gaussian kernel of size w.
+    @param w: kernel size
+    @type w: int
+    @return: standard deviation
+    @rtype: float
+    """
+    # the square root of a gaussian is a gaussian with sigma multiplied by sqrt(2)
+    return np.sqrt(2.0) * (w - 1.0) / 8.0
 
 
 def kernelGaussianBlur(radius):
@@ -96,6 +138,101 @@ def getKernel(category, radius=1, amount=1.0):
         return np.array([[1]])
 
 
+def separableFactors(kernel):
+    """
+    Detects separable 2D kernels : if kernel is the outer product
+    of two vectors, returns them. Otherwise returns None.
+    @param kernel:
+    @type kernel: 2D array
+    @return: column and row kernels, or None
+    @rtype: 2-uple of 1D arrays
+    """
+    if kernel.shape[0] == 1 or kernel.shape[1] == 1:
+        return kernel[:, 0], kernel[0, :]
+    u, s, vt = np.linalg.svd(kernel)
+    if s[1] > SEPARABLE_TOL * s[0]:
+        return None
+    f = np.sqrt(s[0])
+    return u[:, 0] * f, vt[0] * f
+
+
+def boxSizes(sigma, n=BOX_CASCADE_PASSES):
+    """
+    Returns the (odd) sizes of n successive box filters
+    approximating a gaussian blur with standard deviation sigma.
+    Cf. P. Kovesi, Fast Almost-Gaussian Filtering, DICTA 2010.
+    @param sigma: standard deviation
+    @type sigma: float
+    @param n: number of passes
+    @type n: int
+    @return: box sizes
+    @rtype: list of int
+    """
+    wl = int(np.sqrt(12 * sigma * sigma / n + 1))
+    if wl % 2 == 0:
+        wl -= 1
+    wu = wl + 2
+    m = round((12 * sigma * sigma - n * wl * wl - 4 * n * wl - 3 * n) / (-4 * wl - 4))
+    return [wl if i < m else wu for i in range(n)]
+
+
+def gaussianBlur(buf, w):
+    """
+    Applies the 2D gaussian kernel of size w (cf. gaussianKernel()) to an image.
+    Small kernels are applied as two 1D passes. For larger kernels, the blur
+    is approximated by a cascade of box filters, computed with running
+    sums : the cost does not depend on the size of the kernel.
+    @param buf: image
+    @type buf: ndarray, shape (h, w) or (h, w, d)
+    @param w: kernel size
+    @type w: int
+    @return: blurred image, dtype np.float32
+    @rtype: ndarray
+    """
+    sigma = gaussianSigma(w)
+    buf32 = buf.astype(np.float32)
+    if sigma < BOX_CASCADE_SIGMA:
+        k = separableGaussian(w).astype(np.float32)
+        return cv2.sepFilter2D(buf32, -1, k, k)
+    for size in boxSizes(sigma):
+        buf32 = cv2.blur(buf32, (size, size))
+    return buf32
+
+
+def applyKernel(buf, category, radius=1, amount=1.0):
+    """
+    Filter engine : applies the kernel getKernel(category, radius, amount)
+    to an image. Gaussian blur and unsharp mask are computed with gaussianBlur(),
+    other separable kernels as two 1D passes, and non separable kernels with a
+    dense 2D convolution.
+    @param buf: image
+    @type buf: ndarray, shape (h, w, d), dtype np.uint8
+    @param category: filter category
+    @type category: int, cf. filterIndex
+    @param radius: filter radius
+    @type radius: int
+    @param amount: unsharp mask amount (percent)
+    @type amount: float
+    @return: filtered image
+    @rtype: ndarray, same shape and dtype as buf
+    """
+    if category == filterIndex.BLUR1:
+        return cv2.convertScaleAbs(gaussianBlur(buf, radius + 2))
+    elif category == filterIndex.UNSHARP:
+        # kernelUnsharpMask() is (1 + amount) * identity - amount * gaussian
+        amount = amount / 100.0
+        return cv2.addWeighted(buf.astype(np.float32), 1.0 + amount, gaussianBlur(buf, radius + 2), -amount,
+                               0, dtype=cv2.CV_8U)
+    kernel = getKernel(category, radius, amount)
+    if kernel.shape == (1, 1):
+        # identity
+        return buf.copy()
+    factors = separableFactors(kernel)
+    if factors is not None:
+        return cv2.sepFilter2D(buf, -1, factors[1], factors[0])
+    return cv2.filter2D(buf, -1, kernel)
+
+
 if __name__ == '__main__':
     pass
     # print gaussianKernel(0, 5)*256
@@ -60,7 +60,8 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
     partial_f = partial(interpTetra if use_tetra else interpTriLinear, LUT, LUTSTEP, convert=convert)
     # parallel interpolation
     res = pool.map(partial_f, imgList)
-    outImg = np.empty(ndImg.shape)
+    # same dtype as the single process interpolation (uint8 or float32)
+    outImg = np.empty(ndImg.shape, dtype=res[0].dtype)
     # collect results
     for i, (s1, s2) in enumerate(slices):
         outImg[s2, s1] = res[i]
@@ -84,14 +84,101 @@ def strides_2d(a, r, linear=True):
     return s.reshape(a.shape + (shape[2] * shape[3],)) if linear else s
 
 
-def movingAverage(a, winsize, version='kernel'):
+def integralImage(a, r):
+    """
+    Computes the summed area table of a 2D array, padded
+    by reflection (...2,1,0,1,2...) with r rows and columns
+    on each side. The table has a leading row and column of zeros :
+    its shape is (a.shape[0] + 2 * r + 1, a.shape[1] + 2 * r + 1).
+    Sums are accumulated in float64 : differences of large sums
+    are computed for each window, and float32 accumulation
+    would lose the precision of small windows in large images.
+    @param a: 2D array
+    @type a: ndarray, ndims=2
+    @param r: padding size
+    @type r: int
+    @return: summed area table
+    @rtype: ndarray, dtype=np.float64
+    """
+    ax = np.pad(a, r, mode='reflect') if r > 0 else a
+    S = np.zeros((ax.shape[0] + 1, ax.shape[1] + 1), dtype=np.float64)
+    np.cumsum(ax, axis=0, dtype=np.float64, out=S[1:, 1:])
+    np.cumsum(S[1:, 1:], axis=1, out=S[1:, 1:])
+    return S
+
+
+def boxSums(S, R, r, shape):
+    """
+    Returns the sums of the values of the (2r+1)x(2r+1) windows centered
+    at each item of an array, from its summed area table S, padded with
+    R >= r rows and columns (cf. integralImage()). The cost per item does not
+    depend on the window size.
+    @param S: summed area table
+    @type S: ndarray
+    @param R: padding size of S
+    @type R: int
+    @param r: window radius
+    @type r: int
+    @param shape: shape of the (unpadded) array
+    @type shape: 2-uple of int
+    @return: window sums
+    @rtype: ndarray, shape=shape, dtype=np.float32
+    """
+    h, w = shape
+    i0, i1 = R - r, R + r + 1
+    out = np.subtract(S[i1:i1 + h, i1:i1 + w], S[i0:i0 + h, i1:i1 + w], dtype=np.float64)
+    out -= S[i1:i1 + h, i0:i0 + w]
+    out += S[i0:i0 + h, i0:i0 + w]
+    return out.astype(np.float32)
+
+
+def movingAverages(a, winsizes):
+    """
+    Computes the moving averages of a 2D array for several window sizes,
+    from a single summed area table. Windows are square and
+    the borders are handled by reflection (cf. movingAverage()).
+    @param a: 2D array
+    @type a: ndarray, ndims=2
+    @param winsizes: sizes of moving windows
+    @type winsizes: list of int
+    @return: list of arrays of moving averages, in the order of winsizes
+    @rtype: list of ndarray, shape=a.shape, dtype=np.float32
+    """
+    radii = [(s - 1) // 2 for s in winsizes]
+    R = max(radii)
+    S = integralImage(a, R)
+    return [boxSums(S, R, r, a.shape) * (1.0 / (2 * r + 1) ** 2) for r in radii]
+
+
+def movingVariances(a, winsizes):
+    """
+    Computes the moving variances of a 2D array for several window sizes,
+    from the summed area tables of a and a**2 (cf. movingAverages()).
+    @param a: 2D array
+    @type a: ndarray, ndims=2
+    @param winsizes: sizes of moving windows
+    @type winsizes: list of int
+    @return: list of arrays of moving variances, in the order of winsizes
+    @rtype: list of ndarray, shape=a.shape, dtype=np.float32
+    """
+    a = a.astype(np.float32)
+    # center values to limit cancellation in E(a**2) - E(a)**2
+    a -= np.mean(a)
+    m1 = movingAverages(a, winsizes)
+    m2 = movingAverages(a * a, winsizes)
+    return [np.maximum(f2 - f1 * f1, 0, out=f2) for f1, f2 in zip(m1, m2)]
+
+
+def movingAverage(a, winsize, version='integral'):
     """
     Compute the moving averages of a 1D or 2D array.
     For 1D arrays, the borders are not handled : the dimension of
-    the returned array is a.shape[0] - winsize//2.
+    the returned array is a.shape[0] - winsize + 1.
     For 2D arrays, the window is square (winsize*winsize), the
     borders are handled by reflection and the returned array
-    keeps the shape of a. For 2D arrays, if version='kernel' (default)
+    keeps the shape of a. For 2D arrays, if version='integral' (default),
+    we use a summed area table (cf. movingAverages()) : the cost
+    does not depend on winsize. If version='kernel'
     we use the opencv function filter2D to compute the moving average. It is
     fast but suffers from a lack of precision. If version = 'strides',
     we perform a direct and more precise computation,
@@ -100,17 +187,21 @@ def movingAverage(a, winsize, version='kernel'):
     @type a: ndarray ndims = 1 or 2
     @param winsize: size of moving window
     @type winsize: int
-    @param version: 'kernel' or 'strides'
+    @param version: 'integral', 'kernel' or 'strides'
     @type version: str
     @return: array of moving averages
-    @rtype: ndarray, dtype = np.float32 if a.ndims==2 and version=='kernel', otherwise
+    @rtype: ndarray, dtype = np.float32 if a.ndims==2 and version is 'integral' or 'kernel', otherwise
             a.dtype (int types are cast to np.float64)
     """
     n = a.ndim
     if n == 1:
-        return np.mean(rolling_window(a, winsize), axis=-1)
+        c = np.zeros(a.shape[0] + 1, dtype=np.float64)
+        np.cumsum(a, dtype=np.float64, out=c[1:])
+        return (c[winsize:] - c[:-winsize]) / winsize
     elif n == 2:
-        if hasOpenCV and version == 'kernel':
+        if version == 'integral':
+            return movingAverages(a, [winsize])[0]
+        elif hasOpenCV and version == 'kernel':
             kernel = np.ones((winsize, winsize), dtype=np.float32) / (winsize * winsize)
             return cv2.filter2D(a.astype(np.float32), -1, kernel.astype(np.float32))
         else:
@@ -122,11 +213,11 @@ def movingAverage(a, winsize, version='kernel'):
         raise ValueError('array ndims must be 1 or 2')
 
 
-def movingVariance(a, winsize, version='kernel'):
+def movingVariance(a, winsize, version='integral'):
     """
     Compute the moving variance of a 1D or 2D array.
     For 1D arrays, the borders are not handled : the dimension of
-    the returned array is a.shape[0] - winsize//2.
+    the returned array is a.shape[0] - winsize + 1.
     For 2D arrays, the window is square (winsize*winsize), the
     borders are handled by reflection and the returned array
     keeps the shape of a.
@@ -134,20 +225,17 @@ def movingVariance(a, winsize, version='kernel'):
     @type a: ndarray ndims = 1 or 2
     @param winsize: size of moving window
     @type winsize: int
-    @param version:
+    @param version: 'integral', 'kernel' or 'strides' (cf. movingAverage())
     @type version: str
     @return: array of moving variances
     @rtype: ndarray, dtype = np.float32 or np.float64
     """
     if a.ndim > 2:
         raise ValueError('array ndims must be 1 or 2')
+    if a.ndim == 2 and version == 'integral':
+        return movingVariances(a, [winsize])[0]
     if hasOpenCV and version == 'kernel':
         a = a.astype(np.float32)
-        """
-        f1 = movingAverage(a, winsize, version=version)
-        f2 = movingAverage(a * a, winsize, version=version)
-        return f2 - f1 * f1
-        """
     else:
         a = a.astype(np.float64)
     # faster than np.var !!!
@@ -0,0 +1,158 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# the size of tiles is a multiple of the size of the filter window
+TILE_WINDOW_FACTOR = 16
+TILE_MIN_SIZE = 256
+# width of the blending ramp on each side of the seams
+TILE_BLEND = 8
+
+# pool of threads for tiles.
+# OpenCV filters release the GIL, so tiles are processed concurrently.
+tilePool = None
+
+
+def getTilePool():
+    global tilePool
+    if tilePool is None:
+        tilePool = ThreadPool(max(cpu_count(), 1))
+    return tilePool
+
+
+def tileSize(radius):
+    """
+    Returns the size of tiles for a filter of given radius.
+    @param radius: radius of the filter support (search window)
+    @type radius: int
+    @return: tile size
+    @rtype: int
+    """
+    return max(TILE_MIN_SIZE, TILE_WINDOW_FACTOR * (2 * radius + 1))
+
+
+def blendRamp(start, end, length, blend):
+    """
+    Returns the 1D blending weights of a tile spanning
+    the interval [start, end), extended by blend pixels on each side.
+    Weights ramp linearly across the seams, so that the weights of
+    two adjacent tiles sum to 1. No ramp is used at the ends of the
+    image.
+    @param start: tile start
+    @type start: int
+    @param end: tile end
+    @type end: int
+    @param length: image size
+    @type length: int
+    @param blend: ramp half width
+    @type blend: int
+    @return: weights on [max(start - blend, 0), min(end + blend, length))
+    @rtype: ndarray, dtype np.float32
+    """
+    x = np.arange(max(start - blend, 0), min(end + blend, length), dtype=np.float32) + 0.5
+    w = np.ones_like(x)
+    if blend > 0:
+        if start > 0:
+            np.minimum(w, (x - (start - blend)) / (2 * blend), out=w)
+        if end < length:
+            np.minimum(w, (end + blend - x) / (2 * blend), out=w)
+    return w
+
+
+def tiledFilter(buf, func, radius, size=None, blend=TILE_BLEND, out=None, first=None, progress=None, isCancelled=None):
+    """
+    Applies a filter to an image, tile by tile.
+    Tiles are extended by the radius of the filter support, filtered in parallel
+    by a pool of threads and blended across the seams.
+    Tiles intersecting the rectangle first are processed first, starting from its center.
+    The function returns False if the task was cancelled; in that case the
+    contents of out are undefined.
+    @param buf: input image
+    @type buf: ndarray, shape (h, w, d) or (h, w)
+    @param func: filter, taking and returning an array with the same shape and dtype
+    @type func: function
+    @param radius: radius of the filter support
+    @type radius: int
+    @param size: tile size, default tileSize(radius)
+    @type size: int
+    @param blend: ramp half width
+    @type blend: int
+    @param out: output array, may be a view, default a new array
+    @type out: ndarray, same shape and dtype as buf
+    @param first: rectangle (left, top, right, bottom) in buf coordinates, or None
+    @type first: 4-uple of int
+    @param progress: called with the percentage of processed tiles
+    @type progress: function
+    @param isCancelled: polled before processing each tile
+    @type isCancelled: function
+    @return: out, or False if cancelled
+    @rtype: ndarray or boolean
+    """
+    h, w = buf.shape[:2]
+    if size is None:
+        size = tileSize(radius)
+    blend = min(blend, size // 2)
+    if out is None:
+        out = np.empty_like(buf)
+    acc = np.zeros(buf.shape, dtype=np.float32)
+    lock = threading.Lock()
+    tiles = [(r, c) for r in range(0, h, size) for c in range(0, w, size)]
+    if first is not None:
+        left, top, right, bottom = first
+        cx, cy = (left + right) / 2, (top + bottom) / 2
+
+        def key(tile):
+            r, c = tile
+            outside = c >= right or c + size <= left or r >= bottom or r + size <= top
+            return outside, (c + size / 2 - cx) ** 2 + (r + size / 2 - cy) ** 2
+        tiles.sort(key=key)
+
+    def f(tile):
+        if isCancelled is not None and isCancelled():
+            return
+        r, c = tile
+        # blended area
+        r0, r1 = max(r - blend, 0), min(r + size + blend, h)
+        c0, c1 = max(c - blend, 0), min(c + size + blend, w)
+        # filtered area
+        R0, R1 = max(r0 - radius, 0), min(r1 + radius, h)
+        C0, C1 = max(c0 - radius, 0), min(c1 + radius, w)
+        res = func(np.ascontiguousarray(buf[R0:R1, C0:C1]))[r0 - R0:r1 - R0, c0 - C0:c1 - C0].astype(np.float32)
+        weights = blendRamp(r, r + size, h, blend)[:, None] * blendRamp(c, c + size, w, blend)[None, :]
+        if res.ndim == 3:
+            weights = weights[..., None]
+        res *= weights
+        with lock:
+            acc[r0:r1, c0:c1] += res
+
+    count = 0
+    for _ in getTilePool().imap_unordered(f, tiles):
+        count += 1
+        if progress is not None:
+            progress(100 * count // len(tiles))
+    if isCancelled is not None and isCancelled():
+        return False
+    if np.issubdtype(out.dtype, np.integer):
+        np.rint(acc, out=acc)
+    out[...] = acc
+    return out
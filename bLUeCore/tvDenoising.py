@@ -16,6 +16,9 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 
 """
@@ -24,14 +27,29 @@ http://www.askaswiss.com/2016/12/how-to-denoise-images-in-python.html
 LICENSE CC-BY 4.0 Cf. https://creativecommons.org/licenses/by/4.0/
 """
 
+# tiled mode : default tile size and width of the margins added to tiles
+TV_TILE_SIZE = 512
+TV_TILE_MARGIN = 16
+
+# pool of threads for the tiled mode
+tvPool = None
+
+
+def getTvPool():
+    global tvPool
+    if tvPool is None:
+        tvPool = ThreadPool(max(cpu_count(), 1))
+    return tvPool
+
 
-def denoise(img, weight=0.1, eps=1e-3, num_iter_max=200):
-    """Perform total-variation denoising on a grayscale image.
+def denoise(img, weight=0.1, eps=1e-3, num_iter_max=200, tileSize=None):
+    """Perform total-variation denoising on a grayscale or multichannel image.
 
     Parameters
     ----------
     img : array
-        2-D input data to be de-noised.
+        2-D input data, or 3-D array (h, w, channels) to be de-noised.
+        Channels are processed independently, as a single stacked array.
     weight : float, optional
         Denoising weight. The greater `weight`, the more
         de-noising (at the expense of fidelity to `img`).
@@ -43,60 +61,119 @@ def denoise(img, weight=0.1, eps=1e-3, num_iter_max=200):
     num_iter_max : int, optional
         Maximal number of iterations used for the
         optimization.
+    tileSize : int, optional
+        If not None, the image is split into tiles of size tileSize,
+        which are denoised in parallel (cf. denoiseTiled()).
 
     Returns
     -------
     out : array
-        De-noised array of floats.
+        De-noised array, same shape as img, dtype np.float32.
 
     Notes
     -----
     Rudin, Osher and Fatemi algorithm.
+    Finite differences are computed with slices (Neumann boundary conditions)
+    and all iterations run in place in preallocated float32 buffers.
     """
+    if tileSize is not None:
+        return denoiseTiled(img, weight=weight, eps=eps, num_iter_max=num_iter_max, tileSize=tileSize)
 
-    u = np.zeros_like(img)
-    px = np.zeros_like(img)
-    py = np.zeros_like(img)
-
+    img = np.asarray(img, dtype=np.float32)
     nm = np.prod(img.shape[:2])
     tau = 0.125
 
-    i = 0
-    while i < num_iter_max:
-        u_old = u
+    # starting from u = 0 and p = 0, the first iteration gives u = img
+    u = img.copy()
+    err_init = err_prev = np.sqrt(np.vdot(u, u)) / np.sqrt(nm)
+    if err_init == 0:
+        return u
+    # dual variables
+    px = np.zeros_like(img)
+    py = np.zeros_like(img)
+    # scratch buffers : gradient, then norm and divergence.
+    # The last column of gx and the last row of gy are never written,
+    # so the corresponding components of px, py remain 0.
+    gx = np.zeros_like(img)
+    gy = np.zeros_like(img)
 
+    i = 1
+    while i < num_iter_max:
         # x and y components of u's gradient
-        ux = np.roll(u, -1, axis=1) - u
-        uy = np.roll(u, -1, axis=0) - u
+        np.subtract(u[:, 1:], u[:, :-1], out=gx[:, :-1])
+        np.subtract(u[1:], u[:-1], out=gy[:-1])
 
         # update the dual variable
-        px_new = px + (tau / weight) * ux
-        py_new = py + (tau / weight) * uy
-
-        norm_new = np.maximum(1, np.sqrt(px_new ** 2 + py_new ** 2))
-        px = px_new / norm_new
-        py = py_new / norm_new
-
-        # calculate divergence
-        rx = np.roll(px, 1, axis=1)
-        ry = np.roll(py, 1, axis=0)
-        div_p = (px - rx) + (py - ry)
-
-        # update image
-        u = img + weight * div_p
+        gx *= tau / weight
+        gy *= tau / weight
+        px += gx
+        py += gy
+
+        np.hypot(px, py, out=gx)
+        np.maximum(gx, 1, out=gx)
+        px /= gx
+        py /= gx
+
+        # calculate divergence (adjoint of the gradient)
+        gx[:, 0] = px[:, 0]
+        np.subtract(px[:, 1:], px[:, :-1], out=gx[:, 1:])
+        gy[0] = py[0]
+        np.subtract(py[1:], py[:-1], out=gy[1:])
+        gx += gy
+
+        # update image : new u = img + weight * div_p, built in gx
+        gx *= weight
+        gx += img
 
         # calculate error
-        error = np.linalg.norm(u - u_old) / np.sqrt(nm)
-
-        if i == 0:
-            err_init = error
-            err_prev = error
-        else:
-            # break if error small enough
-            if np.abs(err_prev - error) < eps * err_init:
-                break
-            else:
-                e_prev = error
+        np.subtract(gx, u, out=u)
+        error = np.sqrt(np.vdot(u, u)) / np.sqrt(nm)
+        u, gx = gx, u
+        # restore the zero last column and row of the gradient buffers
+        gx[:, -1] = 0
+        gy[-1] = 0
+
         i += 1
+        # break if error small enough
+        if np.abs(err_prev - error) < eps * err_init:
+            break
+        err_prev = error
 
     return u
+
+
+def denoiseTiled(img, weight=0.1, eps=1e-3, num_iter_max=200, tileSize=TV_TILE_SIZE, margin=TV_TILE_MARGIN):
+    """
+    Tiled multi-threaded total-variation denoising.
+    Tiles are extended by margin pixels on each side, denoised
+    independently by a pool of threads, and their inner parts are
+    copied to the output. The stop criterion is evaluated per tile.
+    @param img: 2-D or 3-D (h, w, channels) image array
+    @type img: ndarray
+    @param weight: denoising weight
+    @type weight: float
+    @param eps: stop criterion
+    @type eps: float
+    @param num_iter_max: max number of iterations
+    @type num_iter_max: int
+    @param tileSize: tile size
+    @type tileSize: int
+    @param margin: width of tile margins
+    @type margin: int
+    @return: denoised image
+    @rtype: ndarray, same shape as img, dtype np.float32
+    """
+    img = np.asarray(img, dtype=np.float32)
+    h, w = img.shape[:2]
+    out = np.empty_like(img)
+    tiles = [(r, c) for r in range(0, h, tileSize) for c in range(0, w, tileSize)]
+
+    def f(tile):
+        r, c = tile
+        r0, c0 = max(r - margin, 0), max(c - margin, 0)
+        r1, c1 = min(r + tileSize + margin, h), min(c + tileSize + margin, w)
+        u = denoise(img[r0:r1, c0:c1], weight=weight, eps=eps, num_iter_max=num_iter_max)
+        out[r:r + tileSize, c:c + tileSize] = u[r - r0:r - r0 + tileSize, c - c0:c - c0 + tileSize]
+
+    getTvPool().map(f, tiles)
+    return out
@@ -25,6 +25,7 @@ from PySide2.QtGui import QImage, QPixmap, QColor, QPainter, QPainterPath, QBrus
 from bLUeGui.colorCIE import sRGB2LabVec
 from bLUeGui.colorCube import rgb2hspVec
 from bLUeGui.const import channelValues
+from bLUeTop.settings import HIST_SAMPLE_SIZE
 
 
 class bImage(QImage):
@@ -192,7 +193,8 @@ class bImage(QImage):
 
 
     def histogram(self, size=QSize(200, 200), bgColor=Qt.white, range=(0, 255),
-                  chans=channelValues.RGB, chanColors=Qt.gray, mode='RGB', addMode='', clipping_threshold=0.02):
+                  chans=channelValues.RGB, chanColors=Qt.gray, mode='RGB', addMode='', clipping_threshold=0.02,
+                  sampleSize=HIST_SAMPLE_SIZE):
         """
         Plot the image histogram with the
         specified color mode and channels.
@@ -214,6 +216,8 @@ class bImage(QImage):
         @type addMode:
         @param clipping_threshold: alert threshold for clipped areas
         @type clipping_threshold: float
+        @param sampleSize: max count of sampled pixels, None for an exact histogram
+        @type sampleSize: int
         @return: histogram plot
         @rtype: QImage
         """
@@ -272,15 +276,28 @@ class bImage(QImage):
 
         # green percent for clipping indicators
         gPercent = 1.0
+        # stratified subsampling : we keep one pixel
+        # in each step x step square of the image.
+        step = 1
+        if sampleSize is not None:
+            step = max(int(np.sqrt(self.width() * self.height() / sampleSize)), 1)
+        bufBGR = QImageBuffer(self)[::step, ::step, :3]
         buf = None
         if mode == 'RGB':
-            buf = QImageBuffer(self)[:, :, :3][:, :, ::-1]  # RGB
-        elif mode == 'HSV':
-            buf = self.getHSVBuffer()
-        elif mode == 'HSpB':
-            buf = self.getHspbBuffer()
-        elif mode == 'Lab':
-            buf = self.getLabBuffer()
+            buf = bufBGR[:, :, ::-1]  # RGB
+        elif mode in ['HSV', 'HSpB', 'Lab']:
+            cached = {'HSV': self.HSVBuffer, 'HSpB': self.hspbBuffer, 'Lab': self.LabBuffer}[mode]
+            if step == 1:
+                buf = {'HSV': self.getHSVBuffer, 'HSpB': self.getHspbBuffer, 'Lab': self.getLabBuffer}[mode]()
+            elif cached is not None and getattr(self, 'cachesEnabled', True):
+                buf = cached[::step, ::step]
+            elif mode == 'HSV':
+                # only the sampled pixels are converted
+                buf = cv2.cvtColor(np.ascontiguousarray(bufBGR), cv2.COLOR_BGR2HSV)
+            elif mode == 'HSpB':
+                buf = rgb2hspVec(bufBGR[:, :, ::-1])
+            else:
+                buf = sRGB2LabVec(bufBGR[:, :, ::-1])
         elif mode == 'Luminosity':
             chans = []
         # drawing the histogram onto img
@@ -293,13 +310,13 @@ class bImage(QImage):
         # bins='auto' sometimes causes a huge number of bins ( >= 10**9) and memory error
         # even for small data size (<=250000), so we don't use it.
         if mode == 'Luminosity' or addMode == 'Luminosity':
-            bufL = cv2.cvtColor(QImageBuffer(self)[:, :, :3], cv2.COLOR_BGR2GRAY)[..., np.newaxis]  # returns Y (YCrCb) : Y = 0.299*R + 0.587*G + 0.114*B
-            hist, bin_edges = np.histogram(bufL, range=range, bins=binCount, density=True)
+            bufL = cv2.cvtColor(np.ascontiguousarray(bufBGR), cv2.COLOR_BGR2GRAY)  # returns Y (YCrCb) : Y = 0.299*R + 0.587*G + 0.114*B
+            hist, bin_edges = fastHistogram(bufL, range, binCount)
             drawChannelHistogram(qp, hist, bin_edges, Qt.gray)
         hist_L, bin_edges_L = [0]*len(chans), [0]*len(chans)
         for i, ch in enumerate(chans):
             buf0 = buf[:, :, ch]
-            hist_L[i], bin_edges_L[i] = np.histogram(buf0, range=range, bins=binCount, density=True)
+            hist_L[i], bin_edges_L[i] = fastHistogram(buf0, range, binCount)
             drawChannelHistogram(qp, hist_L[i], bin_edges_L[i], chanColors[ch])
             # subsequent images are added using composition mode Plus
             # qp.setCompositionMode(QPainter.CompositionMode_Plus)  # uncomment for semi-transparent hists
@@ -314,6 +331,40 @@ class bImage(QImage):
         return img
 
 
+def fastHistogram(data, range, binCount):
+    """
+    Density histogram of data, equivalent to
+    np.histogram(data, range=range, bins=binCount, density=True).
+    8 bits data are counted by np.bincount and the counts
+    are next gathered into bins.
+    @param data:
+    @type data: ndarray
+    @param range: histogram range
+    @type range: 2-uple of int or float
+    @param binCount:
+    @type binCount: int
+    @return: histogram and bin edges
+    @rtype: 2-uple of ndarray
+    """
+    r0, r1 = range
+    bin_edges = np.linspace(r0, r1, binCount + 1)
+    if data.dtype == np.uint8:
+        counts = np.bincount(data.ravel(), minlength=256).astype(np.float64)
+        values = np.arange(256, dtype=np.float64)
+    else:
+        values = data.ravel()
+        counts = None
+    # bin indices : values out of range are discarded,
+    # and the last bin includes its right edge.
+    valid = (values >= r0) & (values <= r1)
+    ind = np.minimum(((values[valid] - r0) * (binCount / (r1 - r0))).astype(np.intp), binCount - 1)
+    hist = np.bincount(ind, weights=None if counts is None else counts[valid], minlength=binCount).astype(np.float64)
+    total = hist.sum()
+    if total > 0:
+        hist /= total * (r1 - r0) / binCount
+    return hist, bin_edges
+
+
 QImageFormats = {0: 'invalid', 1: 'mono', 2: 'monoLSB', 3: 'indexed8', 4: 'RGB32', 5: 'ARGB32', 6: 'ARGB32 Premultiplied',
                  7: 'RGB16', 8: 'ARGB8565 Premultiplied', 9: 'RGB666', 10: 'ARGB6666 Premultiplied', 11: 'RGB555',
                  12: 'ARGB8555 Premultiplied', 13: 'RGB888', 14: 'RGB444', 15: 'ARGB4444 Premultiplied'}
@@ -39,3 +39,11 @@ class baseSignal_bool(QObject):
 
 class baseSignal_Int2(QObject):
     sig = QtCore.Signal(int, int, QtCore.Qt.KeyboardModifiers)
+
+
+class baseSignal_Int(QObject):
+    sig = QtCore.Signal(int)
+
+
+class baseSignal_Str2(QObject):
+    sig = QtCore.Signal(str, str)
@@ -16,11 +16,14 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import textwrap
+import threading
 
 from PySide2.QtCore import Qt, QDir, QSize
 
 from PySide2.QtWidgets import QMessageBox, QPushButton, QFileDialog, QDialog, QSlider, QVBoxLayout, QHBoxLayout, QLabel, \
     QCheckBox, QFormLayout, QLineEdit, QDialogButtonBox, QScrollArea
+
+from bLUeGui.baseSignal import baseSignal_Str2
 from bLUeTop.utils import QbLUeSlider
 
 ##################
@@ -136,6 +139,11 @@ def dlgWarn(text, info='', parent=None):
     @param info:
     @type info: str
     """
+    if threading.current_thread() is not threading.main_thread():
+        # dialogs must be opened by the GUI thread :
+        # the warning is queued and the caller goes on.
+        warnSignal.sig.emit(text, info)
+        return
     msg = QMessageBox(parent=parent)
     msg.setWindowTitle('Warning')
     msg.setIcon(QMessageBox.Warning)
@@ -144,6 +152,11 @@ def dlgWarn(text, info='', parent=None):
     msg.exec_()
 
 
+# warnings from background threads
+warnSignal = baseSignal_Str2()
+warnSignal.sig.connect(lambda text, info: dlgWarn(text, info=info), Qt.QueuedConnection)
+
+
 def saveChangeDialog(img):
     """
     Save/discard dialog. Returns the chosen button.
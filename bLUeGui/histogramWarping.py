@@ -423,6 +423,30 @@ def autoQuadSpline(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True):
     return a, b, d, T
 
 
+def warpSpline(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True, spline=None):
+    """
+    Returns the quadratic spline used by warpHistogram() to transform imgBuf,
+    without applying it. Parameters are those of warpHistogram(). As the
+    automatic spline depends on the histogram only, imgBuf can be a sample of the image.
+    @param imgBuf: single channel image (luminance), range 0..1
+    @type imgBuf: ndarray, shape(h,w), dtype=uint8 or int or float
+    @param valleyAperture:
+    @type valleyAperture: float
+    @param warp:
+    @type warp: float
+    @param preserveHigh:
+    @type preserveHigh: boolean
+    @param spline: spline, range 0..256 --> 0..1
+    @type spline: activeSpline
+    @return: the quadratic spline a, b, d, T
+    @rtype: a, b, T are in range 0..1
+    """
+    if spline is None:
+        return autoQuadSpline(imgBuf, valleyAperture=valleyAperture, warp=warp, preserveHigh=preserveHigh)
+    return [p.x() for p in spline.fixedPoints], \
+           [p.y() for p in spline.fixedPoints], spline.fixedTangents, spline.LUTXY/256
+
+
 def warpHistogram(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True, spline=None):
     """
     Stretches and warps the distribution of imgBuf to enhance the contrast.
@@ -448,20 +472,11 @@ def warpHistogram(imgBuf, valleyAperture=0.05, warp=1.0, preserveHigh=True, spli
     @return: the transformed image channel, range 0..1 and the quadratic spline
     @rtype: image ndarray same shape as imgBuf, dtype=np.float, a, b, T are in range 0..1
     """
-    if spline is None:
-        a, b, d, T = autoQuadSpline(imgBuf, valleyAperture=valleyAperture, warp=warp, preserveHigh=preserveHigh)
-    else:
-        a, b, d, T = [p.x() for p in spline.fixedPoints], \
-                      [p.y() for p in spline.fixedPoints], spline.fixedTangents, spline.LUTXY/256
-    im = imgBuf*255
-    im1 = im.astype(np.int)
-    im2 = im1+1
-    B1 = T[im1]
-    # extrapolate T to handle eventual value 256 in im2
+    a, b, d, T = warpSpline(imgBuf, valleyAperture=valleyAperture, warp=warp, preserveHigh=preserveHigh, spline=spline)
+    # extrapolate T to handle eventual value 256
     T1 = np.hstack((T, [T[-1]]))
-    B2 = T1[im2]  # clearer but slower : T[np.minimum(im2, 255)]
-    # interpolate B1, B2
-    B = (im2 - im) * B1 + (im - im1) * B2
+    # linear interpolation of T1 at imgBuf*255 (np.interp avoids full size temporary arrays)
+    B = np.interp(imgBuf * 255, np.arange(len(T1)), T1)
     return np.clip(B, 0, 1, out=B), a, b, d, T
 
 
@@ -15,6 +15,7 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import threading
 from io import BytesIO
 from os import path
 
@@ -22,9 +23,10 @@ import numpy as np
 import gc
 
 from PIL.ImageCms import ImageCmsProfile
-from PySide2.QtCore import Qt, QSize, QPoint, QPointF, QFileInfo
+from PySide2.QtCore import Qt, QSize, QPoint, QPointF, QFileInfo, QRectF, QTimer
 
 import cv2
+import rawpy
 from copy import copy
 
 from PySide2.QtGui import QTransform, QColor, QCursor
@@ -38,15 +40,16 @@ from bLUeTop import exiftool
 from bLUeGui.memory import weakProxy
 from bLUeTop.cloning import contours, moments, seamlessClone
 
-from bLUeTop.colorManagement import icc, cmsConvertQImage
+from bLUeTop.colorManagement import icc, displayConvertQImage
 from bLUeGui.bLUeImage import QImageBuffer, ndarrayToQImage, bImage
 from bLUeGui.dialog import dlgWarn, dlgInfo, IMAGE_FILE_EXTENSIONS, RAW_FILE_EXTENSIONS
 from time import time
 
 from bLUeTop.lutUtils import LUT3DIdentity
+from bLUeTop.progressiveRendering import progressiveRenderer
 from bLUeGui.baseSignal import baseSignal_bool, baseSignal_Int2, baseSignal_No
-from bLUeTop.rawProcessing import rawRead
-from bLUeTop.settings import COLOR_MANAGE_OPT
+from bLUeTop.rawProcessing import rawRead, rawPreview, STAGE_DEVELOP
+from bLUeTop.settings import COLOR_MANAGE_OPT, PROGRESSIVE_RENDER
 from bLUeTop.utils import qColorToRGB, historyList
 
 from bLUeTop.versatileImg import vImage
@@ -97,6 +100,9 @@ class mImage(vImage):
         self.layerView = None
         super().__init__(*args, **kwargs)  # must be done before prLayer init.
         self.onActiveLayerChanged = lambda: 0
+        # background rendering of full size layers
+        self.renderer = progressiveRenderer(self)
+        self.onRenderProgress = lambda value: 0
         # background layer
         bgLayer = QLayer.fromImage(self, parentImage=self)
         bgLayer.isClipping = True
@@ -111,6 +117,8 @@ class mImage(vImage):
         self.prLayer = prLayer
         # link to rawpy instance
         self.rawImage = None
+        # exif orientation of the sensor bitmap
+        self.rawOrientation = 0
 
     @property
     def colorTransformation(self):
@@ -277,6 +285,7 @@ class mImage(vImage):
     def setThumbMode(self, value):
         if value == self.useThumb:
             return
+        self.renderer.stop()
         self.useThumb = value
         # recalculate the whole stack
         self.layerStack[0].apply()
@@ -465,6 +474,10 @@ class mImage(vImage):
         # don't save thumbnails
         if self.useThumb:
             return None
+        if getattr(self, 'rawPending', False):
+            raise IOError('Raw development in progress')
+        # wait for full size layers
+        self.renderer.wait()
         # get the final image from the presentation layer.
         # This image is NOT color managed (prLayer.qPixmap
         # only is color managed)
@@ -588,41 +601,36 @@ class imImage(mImage):
             img = imImage(filename=f, colorSpace=colorSpace, orientation=transformation, rawMetadata=metadata,
                           profile=profile, name=name, rating=rating)
         elif ext in list(RAW_FILE_EXTENSIONS):
-            # load raw image file in a RawPy instance
-            # rawpy.imread keeps f open. Calling raw.close() deletes the raw object.
-            # As a workaround we use low-level file buffer and unpack().
+            # load raw image file in a rawFile instance (cf. rawProcessing.rawFile).
+            # The file is closed after reading.
             # Relevant RawPy attributes are black_level_per_channel, camera_white_balance, color_desc, color_matrix,
             # daylight_whitebalance, num_colors, raw_colors_visible, raw_image, raw_image_visible, raw_pattern,
             # raw_type, rgb_xyz_matrix, sizes, tone_curve.
             # raw_image and raw_image_visible are sensor data
             rawpyInst = rawRead(f)
-            # postprocess raw image, applying default settings (cf. vImage.applyRawPostProcessing)
-            rawBuf = rawpyInst.postprocess(use_camera_wb=True)
-            # build Qimage : switch to BGR and add alpha channel
-            rawBuf = np.dstack((rawBuf[:, :, ::-1], np.zeros(rawBuf.shape[:2], dtype=np.uint8) + 255))
+            # The embedded preview is displayed first, and the
+            # raw image is developed in background (cf. imImage.developRaw)
+            preview = rawPreview(rawpyInst, orientation)
+            if preview is not None:
+                rawBuf = preview
+            else:
+                # postprocess raw image, applying default settings (cf. vImage.applyRawPostProcessing)
+                rawBuf = rawpyInst.postprocess(use_camera_wb=True)[:, :, ::-1]
+            # build Qimage : add alpha channel
+            rawBuf = np.dstack((rawBuf, np.zeros(rawBuf.shape[:2], dtype=np.uint8) + 255))
             img = imImage(cv2Img=rawBuf, colorSpace=colorSpace, orientation=transformation,
                           rawMetadata=metadata, profile=profile, name=name, rating=rating)
             # keeping a reference to rawBuf along with img is
             # needed to protect the buffer from garbage collector
             img.rawBuf = rawBuf
             img.filename = f
-            # keep references to rawPy instance. rawpyInst.raw_image is the (linearized) sensor image
+            # keep references to rawFile instance. rawpyInst.raw_image is the (linearized) sensor image
             img.rawImage = rawpyInst
-            #########################################################
-            # Reconstructing the demosaic Bayer bitmap :
-            # we need it to calculate the multipliers corresponding
-            # to a user white point, and we cannot access the
-            # native rawpy demosaic buffer from the RawPy instance !!!!
-            #########################################################
-            # get 16 bits Bayer bitmap
-            img.demosaic = demosaic(rawpyInst.raw_image_visible, rawpyInst.raw_colors_visible,
-                                    rawpyInst.black_level_per_channel)
-            # correct orientation
-            if orientation == 6:  # 90°
-                img.demosaic = np.swapaxes(img.demosaic, 0, 1)
-            elif orientation == 8:  # 270°
-                img.demosaic = np.swapaxes(img.demosaic, 0, 1)
-                img.demosaic = img.demosaic[:, ::-1, :]
+            # the demosaic Bayer bitmap is computed on demand, see demosaicRegion()
+            img.rawOrientation = orientation
+            # the image is the embedded preview : the caller must start
+            # the development (cf. developRaw) and add the development layer when it is done.
+            img.rawPending = preview is not None
         else:
             raise ValueError("Cannot read file %s" % f)
         if img.isNull():
@@ -646,8 +654,101 @@ class imImage(mImage):
         # size of the current window ( NOT the actual pixels of the image).
         self.Zoom_coeff = 1.0
         self.xOffset, self.yOffset = 0, 0
+        # visible part of the image, updated by the paint event handler of imageLabel
+        self.visibleRect = None
         self.isMouseSelectable = True
         self.isModified = False
+        # background development of raw images opened from their embedded preview
+        self.rawPending = False
+        self.rawThread = None
+        self.rawDeveloped = baseSignal_No()
+        self.rawDeveloped.result = None
+        self.rawDeveloped.sig.connect(self.endRawDevelopment, Qt.QueuedConnection)
+        self.onRawDeveloped = lambda: 0
+
+    def developRaw(self):
+        """
+        Starts the development of the raw image by a background thread.
+        The image (embedded preview) is replaced by the developed image
+        in endRawDevelopment().
+        """
+        rawpyInst, done = self.rawImage, self.rawDeveloped
+
+        def run():
+            try:
+                # postprocess raw image, applying default settings (cf. vImage.applyRawPostProcessing)
+                done.result = rawpyInst.postprocess(use_camera_wb=True)
+            except rawpy.LibRawError:
+                done.result = None
+            done.sig.emit()
+        self.rawThread = threading.Thread(target=run, daemon=True)
+        self.rawThread.start()
+
+    def endRawDevelopment(self):
+        """
+        Raw development terminated slot : the embedded preview is
+        replaced by the developed image, and onRawDeveloped() is called.
+        """
+        if self.rawThread is None:
+            return
+        self.rawThread.join()
+        self.rawThread = None
+        buf, self.rawDeveloped.result = self.rawDeveloped.result, None
+        self.rawPending = False
+        if buf is None:
+            dlgWarn('Cannot develop %s' % self.filename, 'The embedded preview is displayed')
+            return
+        bufOut = QImageBuffer(self)
+        h, w = bufOut.shape[:2]
+        if buf.shape[:2] != (h, w):
+            buf = cv2.resize(buf, (w, h), interpolation=cv2.INTER_AREA)
+        bufOut[:, :, :3] = buf[:, :, ::-1]
+        self.layersStack[0].setImage(self)
+        self.initThumb()
+        self.onRawDeveloped()
+
+    def releaseRaw(self):
+        """
+        Frees the memory held by libraw, on document close. Nothing
+        is done while the raw image is developed in background.
+        """
+        if self.rawImage is not None and self.rawThread is None:
+            self.rawImage.release()
+
+    def demosaicRegion(self, rect):
+        """
+        Reconstructs the demosaic Bayer bitmap (16 bits, black levels subtracted)
+        for a region of the image. We need it to calculate the multipliers corresponding
+        to a user white point, and we cannot access the native rawpy demosaic
+        buffer from the RawPy instance. Only the region is demosaiced,
+        so the (full size) bitmap is never kept.
+        @param rect: region, in image coordinates
+        @type rect: QRect
+        @return: demosaic array
+        @rtype: ndarray, dtype uint16, shape (rect.height(), rect.width(), 3)
+        """
+        rawpyInst = self.rawImage
+        x0, x1, y0, y1 = rect.left(), rect.right() + 1, rect.top(), rect.bottom() + 1
+        Hs = rawpyInst.raw_image_visible.shape[0]
+        # region of the sensor bitmap
+        if self.rawOrientation == 6:  # 90°
+            r0, r1, c0, c1 = x0, x1, y0, y1
+        elif self.rawOrientation == 8:  # 270°
+            r0, r1, c0, c1 = Hs - x1, Hs - x0, y0, y1
+        else:
+            r0, r1, c0, c1 = y0, y1, x0, x1
+        # add a margin for the interpolation
+        m = 2
+        R0, C0 = max(r0 - m, 0), max(c0 - m, 0)
+        bayer = rawpyInst.raw_image_visible[R0:r1 + m, C0:c1 + m]
+        colors = rawpyInst.raw_colors_visible[R0:r1 + m, C0:c1 + m]
+        buf = demosaic(bayer, colors, rawpyInst.black_level_per_channel)[r0 - R0:r1 - R0, c0 - C0:c1 - C0]
+        # correct orientation
+        if self.rawOrientation == 6:
+            buf = np.swapaxes(buf, 0, 1)
+        elif self.rawOrientation == 8:
+            buf = np.swapaxes(buf, 0, 1)[:, ::-1, :]
+        return buf
 
     def bTransformed(self, transformation):
         """
@@ -789,6 +890,8 @@ class QLayer(vImage):
         self.xAltOffset, self.yAltOffset = 0, 0
         self.sourceX, self.sourceY = 0, 0
         self.AltZoom_coeff = 1.0
+        # homographies used to align images, see align.alignImages()
+        self.alignCache = {}
         self.updatePixmap()
 
     @property
@@ -1105,6 +1208,9 @@ class QLayer(vImage):
     def applyToStack(self):
         """
         Apply new layer parameters and propagate changes to upper layers.
+        If preview mode is off and PROGRESSIVE_RENDER is True, the
+        stack of thumbnails is updated first and full size layers are computed
+        in background (cf. progressiveRendering.py).
         """
         # recursive function
         def applyToStack_(layer, pool=None):
@@ -1131,10 +1237,24 @@ class QLayer(vImage):
             if ind < lg:
                 layer1 = stack[ind]
                 applyToStack_(layer1, pool=pool)
+        # preempt background rendering, if any
+        renderer = self.parentImage.renderer
+        renderer.cancel()
+        layer = self
+        if not (self.parentImage.useThumb or self.parentImage.useHald):
+            layer = renderer.staleLayer(self)
+            if PROGRESSIVE_RENDER and renderer.render(layer):
+                return
+        # synchronous update : wait for the background task, and
+        # start from the lowest layer of a deferred request, if any.
+        renderer.stop()
+        if not (self.parentImage.useThumb or self.parentImage.useHald):
+            layer = renderer.staleLayer(layer)
+            renderer.dirtyIndex = None
         try:
             QApplication.setOverrideCursor(Qt.WaitCursor)
             QApplication.processEvents()
-            applyToStack_(self, pool=None)
+            applyToStack_(layer, pool=None)
             # update the presentation layer
             self.parentImage.prLayer.execute(l=None, pool=None)
         finally:
@@ -1207,7 +1327,10 @@ class QLayer(vImage):
             rImg = rImg.copy(QRect(-x, -y, rImg.width()*self.Zoom_coeff, rImg.height()*self.Zoom_coeff))
         if self.maskIsEnabled:
             rImg = vImage.visualizeMask(rImg, self.mask, color=self.maskIsSelected)
-        self.rPixmap = QPixmap.fromImage(rImg)
+        # QPixmap is GUI thread only : layers computed by the background
+        # renderer get their pixmaps rebuilt by progressiveRenderer.refine()
+        if threading.current_thread() is threading.main_thread():
+            self.rPixmap = QPixmap.fromImage(rImg)
         self.setModified(True)
 
     def getStackIndex(self):
@@ -1344,6 +1467,7 @@ class QLayer(vImage):
             return
         # update stack
         self.parentImage.layersStack[0].applyToStack()
+        self.parentImage.renderer.wait()
         # merge
         if type(self.compositionMode) is QPainter.CompositionMode:
             qp = QPainter(target)
@@ -1400,50 +1524,152 @@ class QPresentationLayer(QLayer):
     A presentation layer is used for color management. It is an
     adjustment layer whose output is equal to input. It does not belong to the layer stack :
     conceptually, it is "above" the stack, so it holds the composition of
-    all stacked layers. It is the sole color managed layer, via its qPixmap
-    attribute.
+    all stacked layers. It is the sole color managed layer : color management
+    is applied on demand, to the displayed pixels only (cf. displayPixmap()).
+    Downscaled views are drawn from a pyramid of (non color managed) images,
+    built lazily from the current image and updated by region.
     """
+    # smallest dimension of the pyramid levels
+    pyramidMinSize = 64
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.qPixmap = None
-        self.cmImage = None
+        # color managed display pixmap, its source rectangle
+        # (current image coordinates) and its cache key.
+        self.displayPx, self.displayRect, self.displayKey = None, None, None
+        # pyramid levels : pyramid[k] is downscaled by 2**k. Level 0 is
+        # the current image itself. pyramidDirty[k] is the bounding rectangle
+        # (current image coordinates) of the outdated region of level k.
+        self.pyramid, self.pyramidDirty, self.pyramidSize = [None], [None], None
 
     def inputImg(self, redo=True):
         return self.parentImage.layersStack[self.getTopVisibleStackIndex()].getCurrentMaskedImage()
 
     def updatePixmap(self, maskOnly=False):
         """
-        Synchronize qPixmap and rPixmap with the image layer and mask.
-        If maskOnly is True, cmImage is not updated.
-        if maskIsEnabled is False, the mask is not shown.
-        If maskIsEnabled is True, then
-            - if maskIsSelected is True, the mask is drawn over
-              the layer as a color mask.
-            - if maskIsSelected is False, the mask is drawn as an
-              opacity mask, setting image opacity to that of mask
-              (mode DestinationIn). Mask color is no used.
-        @param maskOnly: default False
+        Invalidate the display pixmap and the pyramid. The display
+        pixmap will be rebuilt (and color managed) by the next call to displayPixmap().
+        The presentation layer has no mask, and its rPixmap
+        is not used by the stack : it is not built.
+        @param maskOnly: not used
         @type maskOnly: boolean
         """
-        currentImage = self.getCurrentImage()
-        # color manage
-        if icc.COLOR_MANAGE and self.parentImage is not None and getattr(self, 'role', None) == 'presentation':
-            img = cmsConvertQImage(currentImage, cmsTransformation=self.parentImage.colorTransformation)
-        else:
-            img = currentImage
-        qImg = img
-        rImg = currentImage
+        img = self.getCurrentImage()
+        self.invalidateRegion(QRect(0, 0, img.width(), img.height()))
+        self.rPixmap = None
+        self.setModified(True)
+
+    def invalidateRegion(self, rect):
         """
-        Presentation Layer has not any mask !
-        if self.maskIsEnabled:
-            rImg = vImage.visualizeMask(rImg, self.mask, color=self.maskIsSelected, clipping=self.isClipping)
+        Invalidate a region of the display pixmap and of the pyramid.
+        @param rect: modified region (current image coordinates)
+        @type rect: QRect
         """
-        self.qPixmap = QPixmap.fromImage(qImg)
-        self.rPixmap = QPixmap.fromImage(rImg)
+        for k in range(1, len(self.pyramid)):
+            dirty = self.pyramidDirty[k]
+            self.pyramidDirty[k] = rect if dirty is None else dirty.united(rect)
+        if self.displayRect is None or self.displayRect.intersects(rect):
+            self.displayKey = None
         self.setModified(True)
 
+    def getPyramidLevel(self, k):
+        """
+        Returns the level k of the pyramid, downscaled by 2**k.
+        Missing levels are built and the outdated regions of the
+        levels 1..k are recomputed from the next lower level, by 2x2 averaging.
+        @param k: level
+        @type k: int
+        @return:
+        @rtype: QImage
+        """
+        img = self.getCurrentImage()
+        if k == 0:
+            return img
+        w, h = img.width(), img.height()
+        if self.pyramidSize != (w, h):
+            # the current image has changed (preview mode switching, resizing...)
+            self.pyramid, self.pyramidDirty, self.pyramidSize = [None], [None], (w, h)
+        for i in range(1, k + 1):
+            if i == len(self.pyramid):
+                self.pyramid.append(QImage(max(w >> i, 1), max(h >> i, 1), img.format()))
+                self.pyramidDirty.append(QRect(0, 0, w, h))
+            dirty = self.pyramidDirty[i]
+            if dirty is None:
+                continue
+            src = QImageBuffer(self.pyramid[i - 1] if i > 1 else img)
+            dst = QImageBuffer(self.pyramid[i])
+            f = 2 ** i
+            x0, y0 = dirty.left() // f, dirty.top() // f
+            x1, y1 = min(-(-(dirty.right() + 1) // f), dst.shape[1]), min(-(-(dirty.bottom() + 1) // f), dst.shape[0])
+            if x1 > x0 and y1 > y0:
+                dst[y0:y1, x0:x1] = cv2.resize(src[2 * y0:2 * y1, 2 * x0:2 * x1], (x1 - x0, y1 - y0),
+                                               interpolation=cv2.INTER_AREA)
+            self.pyramidDirty[i] = None
+        return self.pyramid[k]
+
+    def colorManaged(self, img):
+        """
+        Returns the image converted to the monitor profile, or img
+        if color management is off.
+        @param img:
+        @type img: QImage
+        @return:
+        @rtype: QImage
+        """
+        if icc.COLOR_MANAGE and self.parentImage is not None and getattr(self, 'role', None) == 'presentation':
+            return displayConvertQImage(img)
+        return img
+
+    def displayPixmap(self, targetRect, viewRect):
+        """
+        Returns a color managed pixmap holding the visible part of
+        the current image and the rectangle where it must be drawn.
+        The visible region, enlarged by a margin to absorb small moves,
+        is read from the pyramid level closest to (and not smaller than)
+        the display scale, resized to display resolution and color managed.
+        Pixmaps are cached until the displayed region is invalidated.
+        @param targetRect: position of the whole image (view coordinates)
+        @type targetRect: QRectF
+        @param viewRect: view rectangle (view coordinates)
+        @type viewRect: QRect
+        @return: pixmap (None if the image is not visible) and drawing rectangle
+        @rtype: 2-uple QPixmap, QRectF
+        """
+        img = self.getCurrentImage()
+        w, h = img.width(), img.height()
+        scale = targetRect.width() / w
+        visible = QRectF((viewRect.x() - targetRect.x()) / scale, (viewRect.y() - targetRect.y()) / scale,
+                         viewRect.width() / scale, viewRect.height() / scale).toAlignedRect() & QRect(0, 0, w, h)
+        if visible.isEmpty():
+            return None, targetRect
+        if self.displayKey != scale or not self.displayRect.contains(visible):
+            # choose pyramid level
+            k = 0
+            while scale * 2 ** (k + 1) <= 1 and (min(w, h) >> (k + 1)) >= self.pyramidMinSize:
+                k += 1
+            level = self.getPyramidLevel(k)
+            f = 2 ** k
+            m = max(visible.width(), visible.height()) // 2
+            region = visible.adjusted(-m, -m, m, m)
+            # region in level coordinates
+            x0, y0 = max(region.left() // f, 0), max(region.top() // f, 0)
+            x1, y1 = min(-(-(region.right() + 1) // f), level.width()), min(-(-(region.bottom() + 1) // f), level.height())
+            src = level.copy(QRect(x0, y0, x1 - x0, y1 - y0))
+            self.displayRect = QRect(x0 * f, y0 * f, (x1 - x0) * f, (y1 - y0) * f)
+            if scale < 1:
+                src = src.scaled(max(int(self.displayRect.width() * scale), 1),
+                                 max(int(self.displayRect.height() * scale), 1),
+                                 Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.displayPx = QPixmap.fromImage(self.colorManaged(src))
+            self.displayKey = scale
+        r = self.displayRect
+        return self.displayPx, QRectF(targetRect.x() + r.x() * scale, targetRect.y() + r.y() * scale,
+                                      r.width() * scale, r.height() * scale)
+
     def applyNone(self):
+        # the stack containers must not be
+        # updated while a background rendering is running.
+        self.parentImage.renderer.stop()
         super().applyNone()
         self.parentImage.setModified(True)
 
@@ -1457,6 +1683,9 @@ class QCloningLayer(QLayer):
     To make mask retouching easier, the binary cloning mask
     is taken from the destination image
     """
+    # delay (ms) of inactivity before exact cloning, while moving the virtual layer
+    cloningIdleDelay = 300
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.role = 'CLONING'
@@ -1465,6 +1694,12 @@ class QCloningLayer(QLayer):
         # virtual layer moved flag
         self.vlChanged = False
         self.cloningState = ''
+        # previous solutions of seamless cloning, see cloning.seamlessClone()
+        self.cloningCache = {}
+        # exact cloning after a move of the virtual layer, when the mouse is idle
+        self.cloningTimer = QTimer()
+        self.cloningTimer.setSingleShot(True)
+        self.cloningTimer.timeout.connect(self.cloneMoved)
         # init self.cloning mask, self.monts, self.conts;
         # these attributes are relative to full sized images
         # and used in applyCloning() to speed up move display.
@@ -1499,6 +1734,28 @@ class QCloningLayer(QLayer):
             qp.drawImage(QPointF(currentAltX, currentAltY), img1.copy())
         return img1
 
+    def previewCloning(self):
+        """
+        Interactive cloning while the virtual layer is moved : the seamless
+        blend is computed at low resolution, and the exact
+        cloning is scheduled after cloningIdleDelay ms of inactivity.
+        Low resolution cloning is available for the bLUe method only :
+        with the OpenCV method, the source is simply copied while moving.
+        """
+        adjustForm = self.getGraphicsForm()
+        blue = adjustForm is not None and adjustForm.options['blue']
+        self.applyCloning(seamless=blue, showTranslated=True, moving=True, preview=blue)
+        self.cloningTimer.start(self.cloningIdleDelay)
+
+    def cloneMoved(self):
+        """
+        Exact cloning after a move of the virtual layer.
+        """
+        self.cloningTimer.stop()
+        if self.vlChanged:
+            self.applyCloning(seamless=True, showTranslated=True, moving=True)
+            self.vlChanged = False
+
     def updateCloningMask(self):
         """
         Update the binary cloning mask (relative to the full sized image)
@@ -1524,7 +1781,7 @@ class QCloningLayer(QLayer):
                 img.rPixmap = QPixmap.fromImage(img)
             adjustForm.sourcePixmap = img.rPixmap
 
-    def seamlessMerge(self, outImg, inImg, mask, cloningMethod, version='opencv', w=3):
+    def seamlessMerge(self, outImg, inImg, mask, cloningMethod, version='opencv', w=3, preview=False):
         """
         Seamless cloning.  The cloning mask and contours are
         recomputed and scaled to image size.
@@ -1540,6 +1797,8 @@ class QCloningLayer(QLayer):
         @type version: str
         @param w:
         @type w:
+        @param preview: low resolution cloning (version 'blue' only)
+        @type preview: boolean
         """
         # build the working cloning mask.
         # scale mask to dest current size,  and convert to a binary mask
@@ -1584,7 +1843,8 @@ class QCloningLayer(QLayer):
                                     (0, 0),
                                     (0, 0),
                                     w=w,
-                                   passes=2)
+                                    cache=self.cloningCache,
+                                    preview=preview)
             destBuf[:, :, :3] = output
 
 
@@ -1684,8 +1944,21 @@ class QRawLayer(QLayer):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # caches of the stages of the development pipeline (cf. rawProcessing.STAGE_DEVELOP...)
+        self.bufpost16 = None
         self.postProcessCache = None
         self.bufCache_HSV_CV32 = None
+        self.toneCache = None
+        # True if the caches were computed in preview mode
+        self.half = False
+        # first stage to recompute
+        self.rawStage = STAGE_DEVELOP
+        # (key, buffer) : cached development used by white balance sampling
+        self.sampleBase = None
+        # (profile, look table flag, LUT) : baked profile, see rawProcessing.profileLUT()
+        self.profileLUTCache = None
+        # (key, table) : composed tone curves, see rawProcessing.toneTable()
+        self.toneTableCache = None
 
     @property
     def postProcessCache(self):
@@ -1703,5 +1976,42 @@ class QRawLayer(QLayer):
     def bufCache_HSV_CV32(self, buffer):
         self.__bufCache_HSV_CV32 = buffer
 
+    def invalidateStage(self, stage):
+        """
+        Invalidates the cache of a stage of the development
+        pipeline and the caches of the next stages.
+        @param stage: cf. rawProcessing.STAGE_DEVELOP...STAGE_COLOR
+        @type stage: int
+        """
+        self.rawStage = min(self.rawStage, stage)
+
+    def memoryUsage(self):
+        """
+        Returns the sizes of the buffers held by the development layer
+        and by the raw image. Buffers shared by several
+        stage caches are counted once.
+        @return: buffer names and sizes (bytes)
+        @rtype: dict
+        """
+        d = {}
+        d['image'] = self.sizeInBytes()
+        d['thumbnail'] = self.thumb.sizeInBytes() if self.thumb is not None else 0
+        img = self.parentImage
+        rawBuf = getattr(img, 'rawBuf', None)
+        d['document'] = rawBuf.nbytes if rawBuf is not None else 0
+        rawImage = getattr(img, 'rawImage', None)
+        # released sensor data are not reloaded
+        d['sensor data'] = rawImage.raw_image.nbytes if rawImage is not None and rawImage.isUnpacked else 0
+        d['development'] = self.bufpost16.nbytes if self.bufpost16 is not None else 0
+        d['sampling'] = self.sampleBase[1].nbytes if self.sampleBase is not None else 0
+        counted = set()
+        for name, buf in [('postProcessCache', self.postProcessCache), ('bufCache_HSV_CV32', self.bufCache_HSV_CV32),
+                          ('toneCache', self.toneCache)]:
+            if buf is None or id(buf) in counted:
+                continue
+            counted.add(id(buf))
+            d[name] = buf.nbytes
+        return d
+
 
 
@@ -25,46 +25,141 @@ import cv2
 
 MAX_FEATURES = 500
 GOOD_MATCH_PERCENT = 0.15
-
-
-def alignImages(im1, im2):
-    # Convert images to grayscale
-    im1Gray = cv2.cvtColor(im1, cv2.COLOR_BGR2GRAY)
-    im2Gray = cv2.cvtColor(im2, cv2.COLOR_BGR2GRAY)
-
+# features are detected on images downscaled to this size
+ALIGN_SIZE = 1024
+# max count of iterations of the full scale refinement
+ALIGN_REFINE_ITER = 10
+# size of the thumbnails identifying image contents
+FINGERPRINT_SIZE = 32
+
+
+def fingerprint(im):
+    """
+    Returns a key identifying the content of an image :
+    its shape and a small thumbnail.
+    @param im:
+    @type im: ndarray
+    @return:
+    @rtype: tuple
+    """
+    return im.shape + (cv2.resize(np.ascontiguousarray(im), (FINGERPRINT_SIZE, FINGERPRINT_SIZE),
+                                  interpolation=cv2.INTER_AREA).tobytes(),)
+
+
+def findHomography(im1Gray, im2Gray):
+    """
+    Feature based estimation of the homography mapping
+    im1Gray onto im2Gray.
+    @param im1Gray:
+    @type im1Gray: ndarray, dtype=np.uint8
+    @param im2Gray:
+    @type im2Gray: ndarray, dtype=np.uint8
+    @return: homography or None
+    @rtype: ndarray, shape (3, 3)
+    """
     # Detect ORB features and compute descriptors.
     orb = cv2.ORB_create(MAX_FEATURES)
     keypoints1, descriptors1 = orb.detectAndCompute(im1Gray, None)
     keypoints2, descriptors2 = orb.detectAndCompute(im2Gray, None)
+    if descriptors1 is None or descriptors2 is None:
+        return None
 
     # Match features.
     matcher = cv2.DescriptorMatcher_create(cv2.DESCRIPTOR_MATCHER_BRUTEFORCE_HAMMING)
     matches = matcher.match(descriptors1, descriptors2, None)
 
     # Sort matches by score
-    matches.sort(key=lambda x: x.distance, reverse=False)
+    matches = sorted(matches, key=lambda x: x.distance)
 
     # Remove not so good matches
     numGoodMatches = int(len(matches) * GOOD_MATCH_PERCENT)
     matches = matches[:numGoodMatches]
-
-    # Draw top matches
-    imMatches = cv2.drawMatches(im1, keypoints1, im2, keypoints2, matches, None)
-    cv2.imwrite("matches.jpg", imMatches)
+    if len(matches) < 4:
+        return None
 
     # Extract location of good matches
-    points1 = np.zeros((len(matches), 2), dtype=np.float32)
-    points2 = np.zeros((len(matches), 2), dtype=np.float32)
-
-    for i, match in enumerate(matches):
-        points1[i, :] = keypoints1[match.queryIdx].pt
-        points2[i, :] = keypoints2[match.trainIdx].pt
+    points1 = np.float32([keypoints1[match.queryIdx].pt for match in matches])
+    points2 = np.float32([keypoints2[match.trainIdx].pt for match in matches])
 
     # Find homography
     h, mask = cv2.findHomography(points1, points2, cv2.RANSAC)
+    return h
+
+
+def refineHomography(im1Gray, im2Gray, h):
+    """
+    Full scale refinement of the homography h mapping im1Gray
+    onto im2Gray, by maximization of the enhanced correlation
+    coefficient (ECC). If the maximization fails, h is returned.
+    @param im1Gray:
+    @type im1Gray: ndarray, dtype=np.uint8
+    @param im2Gray:
+    @type im2Gray: ndarray, dtype=np.uint8
+    @param h: initial homography
+    @type h: ndarray, shape (3, 3)
+    @return: refined homography
+    @rtype: ndarray, shape (3, 3)
+    """
+    # ECC warps map template (im2) coordinates to input (im1) coordinates
+    warp = np.linalg.inv(h).astype(np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, ALIGN_REFINE_ITER, 1e-4)
+    try:
+        _, warp = cv2.findTransformECC(im2Gray, im1Gray, warp, cv2.MOTION_HOMOGRAPHY, criteria, None, 5)
+    except (cv2.error, TypeError):
+        return h
+    return np.linalg.inv(warp)
+
+
+def alignImages(im1, im2, cache=None, key=None):
+    """
+    Aligns im1 onto im2.
+    The homography is estimated from ORB features matched on images downscaled
+    to ALIGN_SIZE, and next refined at full scale.
+    If cache is not None, the homography is stored in cache, with the fingerprints
+    of im1 and im2, and it is reused as long as the contents of the images
+    are unchanged. Cache entries are indexed by key and image size.
+    @param im1: image to align
+    @type im1: ndarray, shape (h, w, d), dtype=np.uint8
+    @param im2: reference image
+    @type im2: ndarray, shape (h, w, d), dtype=np.uint8
+    @param cache: homography cache
+    @type cache: dict
+    @param key: cache key, identifying the source and target layers
+    @type key: hashable
+    @return: aligned image and homography
+    @rtype: 2-uple, ndarray, ndarray shape (3, 3)
+    """
+    height, width = im2.shape[:2]
+    h = None
+    if cache is not None:
+        # one entry per image size : preview and full size homographies are both kept
+        key = (key, im1.shape[:2])
+        fps = (fingerprint(im1), fingerprint(im2))
+        entry = cache.get(key)
+        if entry is not None and entry[0] == fps:
+            h = entry[1]
+    if h is None:
+        # Convert images to grayscale
+        im1Gray = cv2.cvtColor(np.ascontiguousarray(im1[:, :, :3]), cv2.COLOR_BGR2GRAY)
+        im2Gray = cv2.cvtColor(np.ascontiguousarray(im2[:, :, :3]), cv2.COLOR_BGR2GRAY)
+        # pyramid level
+        s = min(1.0, ALIGN_SIZE / max(im1Gray.shape + im2Gray.shape))
+        if s < 1.0:
+            small1 = cv2.resize(im1Gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+            small2 = cv2.resize(im2Gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+        else:
+            small1, small2 = im1Gray, im2Gray
+        h = findHomography(small1, small2)
+        if h is None:
+            h = np.eye(3)
+        else:
+            # back to full scale
+            S = np.diag([s, s, 1.0])
+            h = np.linalg.inv(S) @ h @ S
+            h = refineHomography(im1Gray, im2Gray, h)
+        if cache is not None:
+            cache[key] = (fps, h)
 
     # Use homography
-    height, width, channels = im2.shape
     im1Reg = cv2.warpPerspective(im1, h, (width, height))
     return im1Reg, h
-
@@ -151,83 +151,264 @@ def moments(maskBuf):
     return cv2.moments(maskBuf)
 
 
-def membrane(inMBuf, maskBuf, maskContour, passes=1):
+#####################
+# multigrid parameters
+#####################
+# coarsest grid size
+MG_MIN_SIZE = 4
+# red-black Gauss-Seidel sweeps before and after coarse grid correction
+MG_SWEEPS = 3
+# max count of V-cycles (watchdog)
+MG_MAX_CYCLES = 30
+# stop criterion : max update of a V-cycle (pixel value units)
+MG_TOL = 0.1
+# max size of the grid used by interactive previews
+CLONING_PREVIEW_SIZE = 256
+
+
+def mgLevel(M):
+    """
+    Returns the interior mask of a grid level and its red
+    and black (checkerboard) parts.
+    @param M: interior mask
+    @type M: ndarray, shape (h, w), dtype=bool
+    @return:
+    @rtype: 3-uple of ndarrays
+    """
+    h, w = M.shape
+    red = np.add.outer(np.arange(h), np.arange(w)) % 2 == 0
+    return M, (red & M)[..., np.newaxis], (~red & M)[..., np.newaxis]
+
+
+def mgSmooth(U, F, level, sweeps):
+    """
+    Red-black Gauss-Seidel sweeps for the discrete Poisson equation
+    4 * u - (sum of the 4 neighbors of u) = F on the interior of a grid level.
+    U is padded with a 1 pixel ring. Values outside of the interior
+    are the Dirichlet boundary conditions. U is updated in place.
+    @param U: padded grid values
+    @type U: ndarray, shape (h + 2, w + 2, d), dtype=np.float32
+    @param F: right hand side
+    @type F: ndarray, shape (h, w, d), dtype=np.float32
+    @param level: see mgLevel()
+    @type level: 3-uple
+    @param sweeps:
+    @type sweeps: int
+    """
+    u = U[1:-1, 1:-1]
+    S = np.empty_like(u)
+    for _ in range(sweeps):
+        for color in level[1:]:
+            np.add(U[:-2, 1:-1], U[2:, 1:-1], out=S)
+            S += U[1:-1, :-2]
+            S += U[1:-1, 2:]
+            S += F
+            S *= 0.25
+            np.copyto(u, S, where=color)
+
+
+def mgResidual(U, F, M):
+    """
+    Returns the residual F - 4 * u + (sum of the 4 neighbors of u)
+    on the interior M of a grid level, 0 outside.
+    @param U: padded grid values
+    @type U: ndarray, shape (h + 2, w + 2, d), dtype=np.float32
+    @param F: right hand side
+    @type F: ndarray, shape (h, w, d), dtype=np.float32
+    @param M: interior mask
+    @type M: ndarray, shape (h, w), dtype=bool
+    @return: residual
+    @rtype: ndarray, shape (h, w, d), dtype=np.float32
+    """
+    r = U[:-2, 1:-1] + U[2:, 1:-1]
+    r += U[1:-1, :-2]
+    r += U[1:-1, 2:]
+    r -= 4 * U[1:-1, 1:-1]
+    r += F
+    r[~M] = 0
+    return r
+
+
+def mgRestrict(r):
+    """
+    Full weighting restriction of a residual to the next coarser grid.
+    Grids are vertex centered : coarse point (i, j) is the fine point
+    (2 * i + 1, 2 * j + 1), and the boundary rings of both grids coincide.
+    @param r: residual
+    @type r: ndarray, shape (h, w, d)
+    @return: coarse residual
+    @rtype: ndarray, shape ((h - 1) // 2, (w - 1) // 2, d)
+    """
+    h, w = r.shape[:2]
+    hc, wc = (h - 1) // 2, (w - 1) // 2
+    R = np.pad(r, ((1, 1), (1, 1), (0, 0)), mode='constant')
+    rows = [slice(1, 2 * hc, 2), slice(2, 2 * hc + 1, 2), slice(3, 2 * hc + 2, 2)]
+    cols = [slice(1, 2 * wc, 2), slice(2, 2 * wc + 1, 2), slice(3, 2 * wc + 2, 2)]
+    weights = (1, 2, 1)
+    rc = np.zeros((hc, wc, r.shape[2]), dtype=np.float32)
+    for wr, sr in zip(weights, rows):
+        for wcol, sc in zip(weights, cols):
+            rc += (wr * wcol / 16) * R[sr, sc]
+    return rc
+
+
+def mgProlong(ec, h, w):
+    """
+    Bilinear prolongation of a coarse grid correction (cf. mgRestrict()).
+    The boundary ring of the coarse grid is 0.
+    @param ec: coarse correction
+    @type ec: ndarray, shape (hc, wc, d)
+    @param h: fine grid height
+    @type h: int
+    @param w: fine grid width
+    @type w: int
+    @return: fine correction
+    @rtype: ndarray, shape (h, w, d)
+    """
+    hc, wc = ec.shape[:2]
+    Ec = np.pad(ec, ((1, 1), (1, 1), (0, 0)), mode='constant')
+    # P is the fine grid with its boundary ring : P[2 * i, 2 * j] = Ec[i, j]
+    P = np.zeros((2 * hc + 3, 2 * wc + 3, ec.shape[2]), dtype=np.float32)
+    P[::2, ::2] = Ec
+    P[1::2, ::2] = (Ec[:-1] + Ec[1:]) * 0.5
+    P[:, 1::2] = (P[:, :-1:2] + P[:, 2::2]) * 0.5
+    return P[1:h + 1, 1:w + 1]
+
+
+def vCycle(U, F, levels, k=0):
+    """
+    Multigrid V-cycle for the discrete Poisson equation
+    on the interior of level k. U is updated in place.
+    @param U: padded grid values
+    @type U: ndarray, shape (h + 2, w + 2, d), dtype=np.float32
+    @param F: right hand side
+    @type F: ndarray, shape (h, w, d), dtype=np.float32
+    @param levels: grid levels, see mgLevel()
+    @type levels: list of 3-uples
+    @param k: current level
+    @type k: int
+    """
+    level = levels[k]
+    M = level[0]
+    h, w = M.shape
+    if k == len(levels) - 1:
+        # coarsest grid : relaxation
+        mgSmooth(U, F, level, 2 * max(h, w))
+        return
+    mgSmooth(U, F, level, MG_SWEEPS)
+    # restrict the residual. The coarse grid spacing is doubled,
+    # hence the factor 4 = 2**2.
+    Fc = mgRestrict(mgResidual(U, F, M))
+    Fc *= 4
+    hc, wc = Fc.shape[:2]
+    # coarse grid correction, with homogeneous boundary conditions
+    Uc = np.zeros((hc + 2, wc + 2, Fc.shape[2]), dtype=np.float32)
+    vCycle(Uc, Fc, levels, k + 1)
+    e = mgProlong(Uc[1:-1, 1:-1], h, w)
+    e[~M] = 0
+    U[1:-1, 1:-1] += e
+    mgSmooth(U, F, level, MG_SWEEPS)
+
+
+def membrane(inMBuf, maskBuf, maskContour, init=None):
     """
     Calculates the harmonic function with boundary
-    values imgBuf on the contour of
-    maskBuf (Dirichlet conditions), using either the Jacobi Method or the Gauss Seidel Method:
-    http://www.math.umbc.edu/~kogan/technical_papers/2007/Yang_Gobbert.pdf
+    values inMBuf on the contour of maskBuf (Dirichlet conditions),
+    using a multigrid solver (V-cycles with red-black Gauss-Seidel smoothing):
     https://web.stanford.edu/class/cme324/saad.pdf
-    The Laplacian kernel is applied to the interior
-    of the unmasked region only. The exterior is
-    returned unmodified.
-    The input arrays imgBuf, maskBuf and maskContour are not modified.
+    W. L. Briggs, V. E. Henson, S. F. McCormick, A Multigrid Tutorial, SIAM, 2000.
+    The Laplace equation is solved on the interior of the unmasked region only,
+    within its bounding box. The exterior is returned unmodified.
+    If init is not None, its values on the interior are used as initial
+    guess (warm start), otherwise the interior is initialized with
+    the mean of the boundary values.
+    The input arrays inMBuf, maskBuf and maskContour are not modified.
     @param inMBuf: boundary values
     @type inMBuf: ndarray, shape (h, w, d)
     @param maskBuf: mask image
     @type maskBuf: ndarray, shape (h, w)
     @param maskContour:
-    @type maskContour:
-    @param passes: number of grid refinements
-    @type passes: int
+    @type maskContour: ndarray, shape (h, w)
+    @param init: initial guess
+    @type init: ndarray, shape (h, w, d), or None
     @return: membrane buffer
-    @rtype: ndarray, shape (h, w, d), dtype=np.float
+    @rtype: ndarray, shape (h, w, d), dtype=np.float32
     """
-    steps = [33, 17, 9, 5]
-    passes = min(max(1, passes), len(steps))
+    dBuf = inMBuf.astype(np.float32)
     # get the interior of the unmasked region (remove contour)
     innerRegion = (maskContour != 255) & (maskBuf == 255)
-    ##############
-    # stop criterion
-    threshold = 1
-    ##############
-    dBuf = inMBuf.copy()
-    # compute means per color channel over contour
-    m = np.mean(dBuf[maskContour == 255], axis=0)
-    if np.any(np.isnan(m)):
+    ys, xs = np.nonzero(innerRegion)
+    if len(ys) == 0:
         return dBuf
     # init the interior area
-    dBuf[innerRegion] = m
-    # solve Laplace equation using a grid with unit cells of size step.
-    # init the laplacian kernel
-    r = 3
-    lpKernel = np.zeros((r, r), dtype=np.float)
-    lpKernel[0, r // 2], lpKernel[r // 2, 0], lpKernel[r - 1, r // 2], lpKernel[r // 2, r - 1] = (0.25,) * 4
-    lpKernel[r // 2, r // 2] = 0.0
-    for step in steps[:passes]:  # [33, 17]:
-        bMask1 = innerRegion[::step, ::step]
-        # init each grid vertex with the mean of dBuf values over a (step,step) neighborhood
-        # and restore initial values for contour vertices.
-        buf1 = cv2.blur(dBuf, (step, step))
-        buf1[maskContour == 255] = inMBuf[maskContour == 255]
-        buf1 = buf1[::step, ::step, :]
-        ####################################
-        # evaluation of SOR coeff
-        # exact formula sorCoeff = 2 / (1 + sin(pi * h)) with h = 1 / ( N + 1),
-        # where  N + 2 is the (square) grid size (= width or height)
-        # We approximate it by sorCoeff = 2 * (1 - pi * h)
-        ####################################
-        # sorCoeff = 2.0 * (1.0 - np.pi / (np.amax(buf1.shape) - 1 ))
-        # iterate the Laplacian kernel
-        c = 0
-        while True:
-            c += 1
-            outBuf1 = cv2.filter2D(buf1, -1, lpKernel)
-            tmpa = (buf1 - outBuf1)[bMask1]
-            # update the interior region
-            buf1[bMask1] = outBuf1[bMask1]
-            if (max(tmpa.max(initial=0), -tmpa.min(initial=0)) < threshold) or (c > 10 * 3):  # watchdog added
-                break
-        # interpolate the grid for next step
-        buf1 = cv2.resize(buf1, (dBuf.shape[1], dBuf.shape[0]))
-    # copy the cloned region into dBuf
-    dBuf[innerRegion] = buf1[innerRegion]
-    maskContour = cv2.blur(maskContour, (20, 20))
-    dBuf[maskContour > 64] = buf1[maskContour > 64]
+    if init is not None:
+        dBuf[innerRegion] = init[innerRegion]
+    else:
+        # compute means per color channel over contour
+        m = np.mean(dBuf[maskContour == 255], axis=0)
+        if np.any(np.isnan(m)):
+            return dBuf
+        dBuf[innerRegion] = m
+    # bounding box of the interior and 1 pixel ring of boundary values
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    U = np.pad(dBuf, ((1, 1), (1, 1), (0, 0)), mode='edge')[y0:y1 + 2, x0:x1 + 2]
+    M = innerRegion[y0:y1, x0:x1]
+    F = np.zeros(U[1:-1, 1:-1].shape, dtype=np.float32)
+    # grid levels
+    levels = [mgLevel(M)]
+    while min(levels[-1][0].shape) > MG_MIN_SIZE:
+        # injection : coarse points are interior iff the corresponding fine points are
+        levels.append(mgLevel(levels[-1][0][1:-1:2, 1:-1:2]))
+    u = U[1:-1, 1:-1]
+    for _ in range(MG_MAX_CYCLES):
+        prev = u[M]
+        vCycle(U, F, levels)
+        # max update of the cycle
+        if np.abs(u[M] - prev).max(initial=0) < MG_TOL:
+            break
+    dBuf[y0:y1, x0:x1][M] = U[1:-1, 1:-1][M]
     return dBuf
 
 
-def seamlessClone(srcBuf, destBuf, mask, conts, bRect, srcTr, destTr, w=3, passes=1):
+def previewMembrane(inMBuf, maskBuf, maskContour, scale, init=None):
+    """
+    Low resolution version of membrane(), for interactive previews.
+    The Laplace equation is solved on buffers downscaled by scale, and
+    the solution is upscaled to the size of inMBuf. The exterior of
+    the unmasked region is returned unmodified.
+    @param inMBuf: boundary values
+    @type inMBuf: ndarray, shape (h, w, d)
+    @param maskBuf: mask image
+    @type maskBuf: ndarray, shape (h, w)
+    @param maskContour:
+    @type maskContour: ndarray, shape (h, w)
+    @param scale: downscaling factor (< 1)
+    @type scale: float
+    @param init: initial guess, low resolution
+    @type init: ndarray or None
+    @return: membrane buffer and low resolution membrane buffer
+    @rtype: 2-uple of ndarrays, dtype=np.float32
+    """
+    h, w = inMBuf.shape[:2]
+    size = (max(int(w * scale), 1), max(int(h * scale), 1))
+    dBuf = inMBuf.astype(np.float32)
+    smallBuf = cv2.resize(dBuf, size, interpolation=cv2.INTER_AREA)
+    smallMask = cv2.resize(maskBuf, size, interpolation=cv2.INTER_NEAREST)
+    # keep thin contours : any contour pixel in a cell makes a contour cell
+    smallContour = cv2.resize(maskContour, size, interpolation=cv2.INTER_AREA)
+    smallContour[smallContour > 0] = 255
+    if init is not None and init.shape != smallBuf.shape:
+        init = None
+    small = membrane(smallBuf, smallMask, smallContour, init=init)
+    up = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    if up.ndim == 2:
+        up = up[..., np.newaxis]
+    innerRegion = (maskContour != 255) & (maskBuf == 255)
+    dBuf[innerRegion] = up[innerRegion]
+    return dBuf, small
+
+
+def seamlessClone(srcBuf, destBuf, mask, conts, bRect, srcTr, destTr, w=3, cache=None, preview=False):
     """
     The area in srcBuf delimited by the mask translated by srcTr is cloned
     into the area in destBuf delimited by the mask translated by destTr.
@@ -247,8 +428,11 @@ def seamlessClone(srcBuf, destBuf, mask, conts, bRect, srcTr, destTr, w=3, passe
     @type destTr: 2-uple
     @param w: contour thickness
     @type w: int
-    @param passes: number of grid refinements
-    @type passes: int
+    @param cache: previous solutions of the Laplace equation, used as initial guesses
+                  when the cloning region is unchanged (moving source), updated.
+    @type cache: dict or None
+    @param preview: if True, the Laplace equation is solved at low resolution
+    @type preview: boolean
     @return: cloned image
     @rtype: ndarray
     """
@@ -265,9 +449,28 @@ def seamlessClone(srcBuf, destBuf, mask, conts, bRect, srcTr, destTr, w=3, passe
     # obtaining contour of mask
     maskContour = np.zeros(mask.shape, dtype=mask.dtype)  # dest of contours
     cv2.drawContours(maskContour, conts, -1, 255, w)  # -1: draw all contours; 0: draw contour 0  # TODO 19/12/19 changed 0 to -1 validate
+    maskT = mask[array2DSlices(mask, bRect)]
+    contourT = maskContour[array2DSlices(maskContour, bRect)]
+    scale = min(1.0, CLONING_PREVIEW_SIZE / max(bRect[2], bRect[3], 1)) if preview else 1.0
+    key = (bRect, scale)
+    # warm start : the cloning region is unchanged
+    init = None
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None and np.array_equal(entry[0], maskT):
+            init = entry[1]
     # solving Laplace equation for delta = destBufT - srcBufT
-    buf = membrane(destBufT.astype(np.float) - srcBufT.astype(np.float), mask[array2DSlices(mask, bRect)],
-                   maskContour[array2DSlices(maskContour, bRect)], passes=passes)
+    delta = destBufT.astype(np.float32) - srcBufT.astype(np.float32)
+    if scale < 1.0:
+        buf, sol = previewMembrane(delta, maskT, contourT, scale, init=init)
+    else:
+        buf = sol = membrane(delta, maskT, contourT, init=init)
+    if cache is not None:
+        # keep the solutions for the current and preview image sizes only
+        cache.pop(key, None)
+        if len(cache) >= 3:
+            cache.pop(next(iter(cache)))
+        cache[key] = (maskT.copy(), sol)
     tmp = buf + srcBufT
     np.clip(tmp, 0, 255, tmp)
     result = destBuf.copy()
@@ -23,6 +23,7 @@ from PIL.ImageCms import getOpenProfile, getProfileInfo, \
     buildTransformFromOpenProfiles, applyTransform, INTENT_PERCEPTUAL, ImageCmsProfile, PyCMSError, core
 from PySide2.QtGui import QImage
 
+from bLUeCore.multi import chosenInterp
 from bLUeGui.bLUeImage import QImageBuffer
 from bLUeGui.dialog import dlgWarn
 
@@ -86,6 +87,34 @@ class icc:
 
     monitorProfile, workingProfile, workToMonTransform = (None,)*3
     workingProfileInfo, monitorProfileInfo = '', ''
+    # workToMonTransform sampled as a 3D LUT (cf. buildDisplayLUT())
+    workToMonLUT = None
+    # display LUTs, keyed by (working profile, monitor profile, intent)
+    displayLUTCache = {}
+
+    @classmethod
+    def getDisplayLUT(cls, workingProfile, monitorProfile, intent):
+        """
+        Returns the 3D LUT sampling the transformation
+        workingProfile ---> monitorProfile. LUTs are cached, so
+        they are built only once for each profile pair and intent.
+        @param workingProfile:
+        @type workingProfile: ImageCmsProfile
+        @param monitorProfile:
+        @type monitorProfile: ImageCmsProfile
+        @param intent:
+        @type intent: int
+        @return: 3D LUT array
+        @rtype: ndarray, dtype=np.float32
+        """
+        key = (workingProfile.tobytes(), monitorProfile.tobytes(), intent)
+        lut = cls.displayLUTCache.get(key, None)
+        if lut is None:
+            transform = buildTransformFromOpenProfiles(workingProfile, monitorProfile,
+                                                       "RGB", "RGB", renderingIntent=intent)
+            lut = buildDisplayLUT(transform)
+            cls.displayLUTCache[key] = lut
+        return lut
 
     @staticmethod
     def B_get_display_profile(handle=None, device_id=None):
@@ -161,6 +190,7 @@ class icc:
         @type workingProfile:
         """
         cls.HAS_COLOR_MANAGE = False
+        cls.workToMonLUT = None
         # a (default) working image profile is always needed, at least for RGB<-->XYZ conversions
         cls.defaultWorkingProfile = get_default_working_profile()
         cls.workingProfile = cls.defaultWorkingProfile
@@ -198,6 +228,8 @@ class icc:
             """
             cls.HAS_COLOR_MANAGE = (cls.monitorProfile is not None) and \
                                    (cls.workingProfile is not None) and (cls.workToMonTransform is not None)
+            if cls.HAS_COLOR_MANAGE:
+                cls.workToMonLUT = cls.getDisplayLUT(cls.workingProfile, cls.monitorProfile, INTENT_PERCEPTUAL)
             cls.COLOR_MANAGE = cls.HAS_COLOR_MANAGE and cls.COLOR_MANAGE
         except (OSError, IOError) as e:
             print("I/O error({0}): {1}".format(e.errno, e.strerror))
@@ -231,3 +263,74 @@ def cmsConvertQImage(image, cmsTransformation=None):
     # back to the image buffer
     buf[...] = np.frombuffer(PIL_img.tobytes(), dtype=np.uint8).reshape(buf.shape)
     return image
+
+
+# display LUT interpolation step : 255 is a multiple of
+# DISPLAY_LUT_STEP, so the LUT vertices hit the extreme values exactly.
+DISPLAY_LUT_STEP = 5
+
+
+def buildDisplayLUT(cmsTransformation, step=DISPLAY_LUT_STEP):
+    """
+    Sample a Cms transformation into a 3D LUT. Axes and
+    channels of the LUT are in BGR order, suitable for the
+    interpolation of QImage buffers. A last (unused) vertex is
+    added to each axis, as interpolation needs right opened intervals.
+    @param cmsTransformation: Cms transformation
+    @type cmsTransformation: ImageCmsTransform
+    @param step: interpolation step, should divide 255
+    @type step: int
+    @return: 3D LUT array
+    @rtype: ndarray, dtype=np.float32, shape=(s, s, s, 3)
+    """
+    a = np.minimum(np.arange(0, 256 + step, step), 255).astype(np.uint8)
+    s = len(a)
+    # RGB vertices, r varying slowest
+    grid = np.ascontiguousarray(np.stack(np.meshgrid(a, a, a, indexing='ij'), axis=-1).reshape(1, s ** 3, 3))
+    PIL_img = Image.frombuffer('RGB', (s ** 3, 1), grid, 'raw', 'RGB', 0, 1)
+    applyTransform(PIL_img, cmsTransformation, 1)  # 1=in place
+    lut = np.frombuffer(PIL_img.tobytes(), dtype=np.uint8).reshape(s, s, s, 3)
+    # switch to BGR axes and channels
+    return np.ascontiguousarray(lut.transpose(2, 1, 0, 3)[..., ::-1], dtype=np.float32)
+
+
+def cmsConvertQImageLUT(image, lut, step=DISPLAY_LUT_STEP, out=None):
+    """
+    Fast version of cmsConvertQImage, interpolating the transformation
+    from a 3D LUT (cf. buildDisplayLUT()). The result is written into out
+    if it is a QImage with the same size and format as image.
+    Otherwise a new image is returned.
+    @param image: image to transform
+    @type image: QImage
+    @param lut: 3D LUT array, BGR axes and channels
+    @type lut: ndarray
+    @param step: interpolation step
+    @type step: int
+    @param out: output image
+    @type out: QImage
+    @return: The converted QImage
+    @rtype: QImage
+    """
+    if out is None or out.size() != image.size() or out.format() != image.format():
+        out = QImage(image.size(), image.format())
+    bufIn, bufOut = QImageBuffer(image), QImageBuffer(out)
+    interp = chosenInterp(None, image.width() * image.height())
+    bufOut[:, :, :3] = interp(lut, step, bufIn[:, :, :3])
+    bufOut[:, :, 3] = bufIn[:, :, 3]
+    return out
+
+
+def displayConvertQImage(image, out=None):
+    """
+    Convert an image from the working profile to the
+    monitor profile, using the display LUT if it is available.
+    @param image: image to transform
+    @type image: QImage
+    @param out: output image (display LUT only)
+    @type out: QImage
+    @return: The converted QImage
+    @rtype: QImage
+    """
+    if icc.workToMonLUT is None:
+        return cmsConvertQImage(image, cmsTransformation=icc.workToMonTransform)
+    return cmsConvertQImageLUT(image, icc.workToMonLUT, out=out)
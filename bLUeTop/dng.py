@@ -16,12 +16,15 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import json
+import zipfile
+from hashlib import sha1
 from os.path import basename
 
 from bLUeTop import exiftool
 import numpy as np
 from bLUeGui.spline import cubicSpline
-from bLUeTop.settings import DNG_PROFILES_DIR2, DNG_PROFILES_DIR1
+from bLUeTop.settings import DNG_PROFILES_DIR2, DNG_PROFILES_DIR1, DNG_PROFILES_CACHE_DIR
 
 #########################################################################################
 # Functions and classes related to dng/dcp profile tags.
@@ -30,33 +33,164 @@ from bLUeTop.settings import DNG_PROFILES_DIR2, DNG_PROFILES_DIR1
 ########################################################################################
 
 
+# profile tags read from dng or dcp files
+dngProfileTags = ['LinearizationTable',
+                  'ProfileLookTableData',
+                  'ProfileLookTableDims',
+                  'ProfileLookTableEncoding',
+                  'ProfileToneCurve',
+                  'CalibrationIlluminant1',
+                  'CalibrationIlluminant2',
+                  'ColorMatrix1',
+                  'ColorMatrix2',
+                  'CameraCalibration1',
+                  'CameraCalibration2',
+                  'ForwardMatrix1',
+                  'ForwardMatrix2',
+                  'AnalogBalance'
+                  ]
+
+# tags holding lists of numbers : they are decoded to float arrays
+dngArrayTags = ['LinearizationTable', 'ProfileLookTableData', 'ProfileLookTableDims', 'ProfileToneCurve',
+                'ColorMatrix1', 'ColorMatrix2', 'CameraCalibration1', 'CameraCalibration2',
+                'ForwardMatrix1', 'ForwardMatrix2', 'AnalogBalance']
+
+
+def dngFloats(value):
+    """
+    Returns a tag value as a float array. Tag values
+    are str (as decoded by exiftool) or float arrays (decoded values).
+    A ValueError exception is raised if value is None or cannot be decoded.
+    @param value: tag value
+    @type value: str or ndarray
+    @return:
+    @rtype: ndarray, dtype np.float
+    """
+    if value is None:
+        raise ValueError('dngFloats : missing tag value')
+    if isinstance(value, str):
+        return np.array(value.split(), dtype=np.float64)
+    return np.asarray(value, dtype=np.float64)
+
+
+def dngCachePath(filename, suffix):
+    """
+    Returns the path of a cache file.
+    @param filename: path of the cached file or folder
+    @type filename: str
+    @param suffix:
+    @type suffix: str
+    @return:
+    @rtype: str
+    """
+    return os.path.join(DNG_PROFILES_CACHE_DIR, sha1(os.path.abspath(filename).encode('utf-8')).hexdigest() + suffix)
+
+
+def dngCacheWrite(path, write):
+    """
+    Atomically writes a cache file. Errors are ignored : the cache is only an optimization.
+    @param path: path of cache file
+    @type path: str
+    @param write: function writing to a binary file object
+    @type write: function
+    """
+    try:
+        os.makedirs(DNG_PROFILES_CACHE_DIR, exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
 def getDngProfileDict(filename):
     """
     Read profile related tags from a dng or dcp file or folder.
-    Return a dictionary of (str) decoded {tagname : tagvalue} pairs.
+    Return a dictionary of decoded {tagname : tagvalue} pairs. Empty
+    values are removed. Values of tags holding lists of numbers are
+    float arrays, other values are str.
+    Decoded dictionaries are cached on disk : the cache entry of
+    a file is valid as long as the file modification time and size are unchanged,
+    so exiftool is called only for new or modified files.
     @param filename: path
     @type filename: str
     @return: dictionary
     @rtype: dict
     """
+    try:
+        st = os.stat(filename)
+        stamp = np.array([st.st_mtime, st.st_size], dtype=np.float64)
+    except OSError:
+        stamp = None
+    cachePath = dngCachePath(filename, '.npz')
+    if stamp is not None:
+        try:
+            with np.load(cachePath, allow_pickle=False) as data:
+                if np.array_equal(data['_stamp'], stamp):
+                    return {k: (data[k] if k in dngArrayTags else str(data[k])) for k in data.files if k != '_stamp'}
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
     with exiftool.ExifTool() as e:
-        profileDict = e.readBinaryDataAsDict(filename,
-                                             taglist=['LinearizationTable',
-                                                      'ProfileLookTableData',
-                                                      'ProfileLookTableDims',
-                                                      'ProfileLookTableEncoding',
-                                                      'ProfileToneCurve',
-                                                      'CalibrationIlluminant1',
-                                                      'CalibrationIlluminant2',
-                                                      'ColorMatrix1',
-                                                      'ColorMatrix2',
-                                                      'CameraCalibration1',
-                                                      'CameraCalibration2',
-                                                      'ForwardMatrix1',
-                                                      'ForwardMatrix2',
-                                                      'AnalogBalance'
-                                                      ])
-    return profileDict
+        profileDict = e.readBinaryDataAsDict(filename, taglist=dngProfileTags)
+    # filter and decode
+    d = {}
+    for k, v in profileDict.items():
+        if v == '':
+            continue
+        if k in dngArrayTags:
+            try:
+                v = dngFloats(v)
+            except ValueError:
+                pass
+        d[k] = v
+    if stamp is not None:
+        dngCacheWrite(cachePath, lambda f: np.savez(f, _stamp=stamp, **d))
+    return d
+
+
+def dngProfileIndex():
+    """
+    Returns the index of the profile folders : a list of (entry name, paths) pairs.
+    Entries of the profile folders are camera profiles or camera folders. For camera
+    folders, paths are the paths of all files in the folder.
+    The index is cached on disk and rebuilt when the modification time of a folder changes.
+    @return:
+    @rtype: list of (str, list of str)
+    """
+    def mtimes(folders):
+        d = {}
+        for folder in folders:
+            try:
+                d[folder] = os.stat(folder).st_mtime
+            except OSError:
+                d[folder] = None
+        return d
+    cachePath = os.path.join(DNG_PROFILES_CACHE_DIR, 'profileIndex.json')
+    try:
+        with open(cachePath, 'r') as f:
+            index = json.load(f)
+        if mtimes(index['folders']) == index['folders']:
+            return index['entries']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    # build index
+    entries, folders = [], [DNG_PROFILES_DIR1, DNG_PROFILES_DIR2]
+    for folder in [DNG_PROFILES_DIR1, DNG_PROFILES_DIR2]:
+        try:
+            for entry in os.scandir(folder):
+                if entry.is_file():
+                    # camera file : add
+                    entries.append((entry.name, [entry.path]))
+                elif entry.is_dir():
+                    # camera folder : add all files
+                    entries.append((entry.name, [ent.path for ent in os.scandir(entry.path)]))
+                    folders.append(entry.path)
+        except OSError:
+            pass
+    index = {'folders': mtimes(folders), 'entries': entries}
+    dngCacheWrite(cachePath, lambda f: f.write(json.dumps(index).encode('utf-8')))
+    return entries
 
 
 def getDngProfileList(cameraName):
@@ -71,19 +205,9 @@ def getDngProfileList(cameraName):
     if cameraName == '':
         return plist
     cameraName = cameraName.lower()
-    for folder in [DNG_PROFILES_DIR1, DNG_PROFILES_DIR2]:
-        try:
-            for entry in os.scandir(folder):
-                if cameraName in entry.name.lower():
-                    if entry.is_file():
-                        # camera file : add
-                        plist.append(entry.path)
-                    elif entry.is_dir():
-                        # camera folder : add all files
-                        for ent in os.scandir(entry.path):
-                            plist.append(ent.path)
-        except OSError:
-            pass
+    for name, paths in dngProfileIndex():
+        if cameraName in name.lower():
+            plist.extend(paths)
     return plist
 
 
@@ -96,17 +220,18 @@ class dngProfileToneCurve:
     """
     def __init__(self, buf):
         """
-        Init the coordinates from a (str) decoded buffer of
+        Init the coordinates from a decoded buffer of
         interleaved x and y coordinates. If the tone curve cannot
         be initialized from the buffer, it is set to identity.
         @param buf: decoded buffer
-        @type buf: str
+        @type buf: str or ndarray
         """
         try:
-            buf = buf.split(' ')
-            buf = np.array([float(x) for x in buf])
+            buf = dngFloats(buf)
+            if buf.size < 4:
+                raise ValueError
             self.dataX, self.dataY = buf[::2], buf[1::2]
-        except (ValueError, AttributeError):
+        except (ValueError, TypeError):
             # identity curve
             self.dataX, self.dataY = np.array([0, 1]), np.array([0, 1])
 
@@ -132,7 +257,7 @@ class dngProfileLookTable:
     """
     def __init__(self, dngDict):
         """
-        Init a profile look table from a dictionary of (tagname, str) pairs.
+        Init a profile look table from a dictionary of (tagname, value) pairs.
         Tags are 'ProfileLookTableDims', 'ProfileLookTableEncoding', 'ProfileLookTableData'.
         Values are decoded following the Adobe dng spec.
         @param dngDict:
@@ -150,9 +275,9 @@ class dngProfileLookTable:
             except TypeError:
                 self.encoding = 0
             # read the number of division points for each axis.
-            divs = [int(x) for x in divs.split(' ')]
+            divs = [int(x) for x in dngFloats(divs)]
             # read data. Tthe table is stored in v, h, s loops ordering (cf. the dng specification)
-            data = np.array([float(x) for x in data.split(' ')]).reshape(divs[2], divs[0], divs[1], 3)  # v, h, s
+            data = dngFloats(data).reshape(divs[2], divs[0], divs[1], 3)  # v, h, s
             self.__divs = tuple(divs)
             # allocate data array.
             # Adding sentinels, so all
@@ -240,7 +365,7 @@ class dngProfileColorMatrices:
         try:
             for tag in ['ColorMatrix1', 'ColorMatrix2']:
                 M = dngDict.get(tag, None)
-                M = np.array([float(x) for x in M.split(' ')]).reshape(3, 3)
+                M = dngFloats(M).reshape(3, 3)
                 setattr(self, '_' + tag, M)  # a single _ , as setattr does no mangling
 
         except (ValueError, KeyError) as e:
@@ -264,7 +389,7 @@ class dngProfileForwardMatrices:
         try:
             for tag in ['ForwardMatrix1', 'ForwardMatrix2']:
                 M = dngDict.get(tag, None)
-                M = np.array([float(x) for x in M.split(' ')]).reshape(3, 3)
+                M = dngFloats(M).reshape(3, 3)
                 setattr(self, '_' + tag, M) # a single _ , as setattr does no mangling
         except (ValueError, KeyError) as e:
             print('dngProfileForwardMatrices : ', str(e))
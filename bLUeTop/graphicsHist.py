@@ -17,9 +17,11 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 from PySide2.QtCore import Qt
+from PySide2.QtGui import QPixmap
 from PySide2.QtWidgets import QSizePolicy, QVBoxLayout, QLabel, QHBoxLayout
 
 from bLUeGui.graphicsForm import baseForm
+from bLUeTop.histogramService import histogramService
 from bLUeTop.utils import optionsWidget, UDict
 
 
@@ -38,9 +40,13 @@ class histForm (baseForm):
         self.Label_Hist.setScaledContents(True)
         self.Label_Hist.setFocusPolicy(Qt.ClickFocus)
         self.setStyleSheet("QListWidget{border: 0px; font-size: 12px}")
+        self.cache = None
+        # histograms are computed in background from a subsample of the image
+        self.service = histogramService()
+        self.service.onReady = self.setHistogram
 
         # options
-        options1, optionNames1 = ['Original Image'], ['Source']
+        options1, optionNames1 = ['Original Image', 'Exact'], ['Source', 'Exact']
         self.listWidget1 = optionsWidget(options=options1, optionNames=optionNames1, exclusive=False)
         self.listWidget1.setFixedSize((self.listWidget1.sizeHintForColumn(0) + 15) * len(options1), 20)
         options2, optionNames2 = ['R', 'G', 'B', 'L'], ['R', 'G', 'B', 'L']
@@ -54,7 +60,9 @@ class histForm (baseForm):
         self.setWhatsThis("""
         <b>Histogram</b><br>
         The histogram shows the initial or final color ditribution of the image, depending on 
-        whether the <I>Source</I> option is checked or not. 
+        whether the <I>Source</I> option is checked or not.<br>
+        To keep the interface responsive, the histogram is computed in background from a sample
+        of the image pixels. Check the <I>Exact</I> option to count all pixels.
         """)
 
         def onSelect(item):
@@ -83,6 +91,15 @@ class histForm (baseForm):
         self.setLayout(vl)
         self.adjustSize()
 
+    def setHistogram(self, img):
+        """
+        Display a histogram plot
+        @param img: histogram plot
+        @type img: QImage
+        """
+        self.cache = QPixmap.fromImage(img)
+        self.Label_Hist.setPixmap(self.cache)
+
 
 
 
@@ -15,7 +15,6 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
-import cv2
 import threading
 
 from collections import OrderedDict
@@ -31,6 +30,7 @@ from PySide2.QtWidgets import QVBoxLayout, QLabel, QHBoxLayout, QFrame, QGroupBo
 from bLUeGui.graphicsSpline import graphicsSplineForm
 from bLUeGui.graphicsForm import baseForm
 from bLUeTop.dng import getDngProfileList, getDngProfileDict, dngProfileToneCurve
+from bLUeTop.rawProcessing import STAGE_DEVELOP, STAGE_MATRIX, STAGE_PROFILE, STAGE_TONE, STAGE_COLOR
 from bLUeTop.utils import optionsWidget, UDict, QbLUeSlider, stateAwareQDockWidget
 from bLUeGui.multiplier import *
 
@@ -64,12 +64,12 @@ class graphicsToneForm(graphicsSplineForm):
         @type modifiers:
         """
         rImg = self.scene().targetImage.getActiveLayer()
-        if rImg.parentImage.useThumb:
-            x, y = x//2, y//2
-        color = rImg.linearImg.pixelColor(x, y)
-        r, g, b = color.red(), color.green(), color.blue()
-        h, s, v = cv2.cvtColor((np.array([r, g, b])/255).astype(np.float32)[np.newaxis, np.newaxis, :],
-                               cv2.COLOR_RGB2HSV)[0, 0, :]
+        buf = rImg.postProcessCache
+        if buf is None:
+            return
+        # postProcessCache may be smaller than the image (preview mode)
+        x, y = x * buf.shape[1] // rImg.width(), y * buf.shape[0] // rImg.height()
+        v = buf[min(y, buf.shape[0] - 1), min(x, buf.shape[1] - 1), 2]
         self.inputMarker.setPos(v*self.scene().axeSize, 0.0)
 
 
@@ -194,11 +194,13 @@ class rawForm (baseForm):
         optionList2, optionNames2 = ['cpLookTable', 'cpToneCurve', 'manualCurve'], ['Use Camera Profile Look Table',
                                                                                     'Show Tone Curves', 'Show Contrast Curve']
         self.listWidget1 = optionsWidget(options=optionList0, optionNames=optionNames0, exclusive=False,
-                                         changed=lambda: self.dataChanged.emit(1))
+                                         changed=lambda: self.dataChanged.emit(STAGE_DEVELOP))
         self.listWidget2 = optionsWidget(options=optionList1, optionNames=optionNames1,  exclusive=True,
-                                         changed=lambda: self.dataChanged.emit(1))
+                                         changed=lambda: self.dataChanged.emit(STAGE_DEVELOP))
+        # the look table option changes the profile stage, display options change the tone stage
         self.listWidget3 = optionsWidget(options=optionList2, optionNames=optionNames2, exclusive=False,
-                                         changed=lambda: self.dataChanged.emit(2))
+                                         changed=lambda item: self.dataChanged.emit(
+                                             STAGE_PROFILE if item.internalName == 'cpLookTable' else STAGE_TONE))
         self.options = UDict((self.listWidget1.options, self.listWidget2.options, self.listWidget3.options))
         # display the 'as shot' temperature
         item = self.listWidget2.item(1)
@@ -277,9 +279,8 @@ class rawForm (baseForm):
             # display updated as shot temp
             item = self.listWidget2.item(1)
             item.setText(item.text().split(":")[0] + ': %d' % self.asShotTemp)
-            # invalidate cache
-            self.layer.bufCache_HSV_CV32 = None
-            self.dataChanged.emit(2)  # 2 = no postprocessing
+            # the forward matrices of the profile are used by the camera matrix stage
+            self.dataChanged.emit(STAGE_MATRIX)
 
         self.cameraProfilesCombo.currentIndexChanged.connect(cameraProfileUpdate)
 
@@ -292,7 +293,7 @@ class rawForm (baseForm):
         # denoiseCombo index changed event handler
         def denoiseUpdate(value):
             self.denoiseValue = self.denoiseCombo.itemData(value)
-            self.dataChanged.emit(1)
+            self.dataChanged.emit(STAGE_DEVELOP)
 
         self.denoiseCombo.currentIndexChanged.connect(denoiseUpdate)
 
@@ -305,7 +306,7 @@ class rawForm (baseForm):
         # overexpCombo index changed event handler
         def overexpUpdate(value):
             self.overexpValue = self.overexpCombo.itemData(value)
-            self.dataChanged.emit(1)
+            self.dataChanged.emit(STAGE_DEVELOP)
 
         self.overexpCombo.currentIndexChanged.connect(overexpUpdate)
 
@@ -341,7 +342,7 @@ class rawForm (baseForm):
                 pass
             # rawpy: expCorrection range is -2.0...3.0, boiling down to exp_shift range 2**(-2)=0.25...2**3=8.0
             self.expCorrection = self.slider2Exp(self.sliderExp.value())
-            self.dataChanged.emit(1)
+            self.dataChanged.emit(STAGE_DEVELOP)
             self.sliderExp.valueChanged.connect(expUpdate)  # send new value as parameter
             self.sliderExp.sliderReleased.connect(lambda: expUpdate(self.sliderExp.value()))  # signal pass no parameter
         self.sliderExp.valueChanged.connect(expUpdate)  # send new value as parameter
@@ -380,7 +381,7 @@ class rawForm (baseForm):
             except RuntimeError:
                 pass
             self.brCorrection = self.slider2Br(self.sliderBrightness.value())
-            self.dataChanged.emit(1)
+            self.dataChanged.emit(STAGE_DEVELOP)
             self.sliderBrightness.sliderReleased.connect(lambda: brUpdate(self.sliderBrightness.value()))
             self.sliderBrightness.valueChanged.connect(brUpdate)  # send new value as parameter
         self.sliderBrightness.valueChanged.connect(brUpdate)  # send new value as parameter
@@ -420,7 +421,7 @@ class rawForm (baseForm):
             self.contValue.setText(str("{:+d}".format(self.contCorrection)))
             # force to recalculate the spline
             self.layer.autoSpline = True
-            self.dataChanged.emit(3)  # no postprocessing and no camera profile stuff
+            self.dataChanged.emit(STAGE_TONE)
             self.sliderCont.valueChanged.connect(contUpdate)  # send new value as parameter
             self.sliderCont.sliderReleased.connect(lambda: contUpdate(self.sliderCont.value()))  # signal has no parameter
         self.sliderCont.valueChanged.connect(contUpdate)  # send new value as parameter
@@ -457,7 +458,7 @@ class rawForm (baseForm):
             except RuntimeError:
                 pass
             self.satCorrection = self.slider2Sat(self.sliderSat.value())
-            self.dataChanged.emit(3)  # no post processing and no camera profile stuff
+            self.dataChanged.emit(STAGE_COLOR)
             self.sliderSat.valueChanged.connect(satUpdate)  # send new value as parameter
             self.sliderSat.sliderReleased.connect(lambda: satUpdate(self.sliderSat.value()))  # signal has no parameter
         self.sliderSat.valueChanged.connect(satUpdate)  # send new value as parameter
@@ -585,7 +586,7 @@ class rawForm (baseForm):
 
             def f():
                 layer = self.layer
-                layer.bufCache_HSV_CV32 = None
+                layer.invalidateStage(STAGE_TONE)
                 layer.applyToStack()
                 layer.parentImage.onImageChanged()
 
@@ -601,6 +602,8 @@ class rawForm (baseForm):
             window.addDockWidget(Qt.LeftDockWidgetArea, dockT)
             self.dockT = dockT
             dockT.setWidget(form)
+            # the user tone curve is applied only while the form is visible
+            dockT.visibilityChanged.connect(lambda visible: self.dataChanged.emit(STAGE_TONE))
             showFirst = True
             form.setWhatsThis(
                             """<b>Camera Profile Tone Curve</b><br>
@@ -616,7 +619,10 @@ class rawForm (baseForm):
             form = self.toneForm
             showFirst = False
         form.scene().setSceneRect(-25, -axeSize - 25, axeSize + 50, axeSize + 50)
+        # called during the development : the visibility change must not restart it
+        self.dockT.blockSignals(True)
         self.dockT.showNormal()
+        self.dockT.blockSignals(False)
         return showFirst
 
     def setContrastSpline(self, a, b, d, T):
@@ -643,6 +649,7 @@ class rawForm (baseForm):
 
             def f():
                 layer = self.layer
+                layer.invalidateStage(STAGE_TONE)
                 layer.applyToStack()
                 layer.parentImage.onImageChanged()
 
@@ -682,7 +689,7 @@ class rawForm (baseForm):
         self.rawMultipliers = multipliers
         m = multipliers[1]
         self.rawMultipliers = [self.rawMultipliers[i] / m for i in range(4)]
-        self.dataChanged.emit(1)
+        self.dataChanged.emit(STAGE_DEVELOP)
         self.sliderTemp.valueChanged.connect(self.tempUpdate)  # send new value as parameter
         self.sliderTemp.sliderReleased.connect(lambda: self.tempUpdate(self.sliderTemp.value()))  # signal has no parameter
 
@@ -705,7 +712,7 @@ class rawForm (baseForm):
         self.rawMultipliers = multipliers
         m = multipliers[1]
         self.rawMultipliers = [self.rawMultipliers[i] / m for i in range(4)]
-        self.dataChanged.emit(1)
+        self.dataChanged.emit(STAGE_DEVELOP)
         self.sliderTint.valueChanged.connect(self.tintUpdate)
         self.sliderTint.sliderReleased.connect(lambda: self.tintUpdate(self.sliderTint.value()))  # signal has no parameter)
 
@@ -729,24 +736,15 @@ class rawForm (baseForm):
         self.sliderTemp.valueChanged.connect(self.tempUpdate)
         self.sliderTint.valueChanged.connect(self.tintUpdate)
         self.sampleMultipliers = sampling
-        self.dataChanged.emit(1)
+        self.dataChanged.emit(STAGE_DEVELOP)
 
     def updateLayer(self, level):
         """
         data changed event handler.
-        @param level: 3: redo contrast and saturation, 2: previous + camera profile stuff, 1: all
+        @param level: first stage of the development pipeline to recompute (cf. rawProcessing.STAGE_DEVELOP...)
         @type level: int
         """
-        if level == 1:
-            # force all
-            self.layer.bufCache_HSV_CV32 = None
-            self.layer.postProcessCache = None
-        elif level == 2:
-            # force camera profile stuff
-            self.layer.bufCache_HSV_CV32 = None
-        elif level == 3:
-            # keep the 2 cache buffers
-            pass
+        self.layer.invalidateStage(level)
         # contrast curve
         cf = getattr(self, 'dockC', None)
         if cf is not None:
@@ -754,13 +752,16 @@ class rawForm (baseForm):
                 cf.showNormal()
             else:
                 cf.hide()
-        # tone curve
+        # tone curve. Visibility changes follow the
+        # option cpToneCurve, whose changes invalidate STAGE_TONE.
         ct = getattr(self, 'dockT', None)
         if ct is not None:
+            ct.blockSignals(True)
             if self.options['cpToneCurve']:
                 ct.showNormal()
             else:
                 ct.hide()
+            ct.blockSignals(False)
         self.enableSliders()
         self.layer.applyToStack()
         self.layer.parentImage.onImageChanged()
@@ -835,8 +836,6 @@ class rawForm (baseForm):
             f = files[nextInd]
             key = basename(f)[:-4] if nextInd > 0 else 'Embedded Profile'
             d = getDngProfileDict(f)
-            # filter d
-            d = {k: d[k] for k in d if d[k] != ''}
             if d:
                 self.cameraProfilesCombo.addItem(key, d)
                 found = True
@@ -847,8 +846,6 @@ class rawForm (baseForm):
             for i, f in enumerate(files[nextInd: ]):
                 key = basename(f)[:-4] if i + nextInd > 0 else 'Embedded Profile'
                 d = getDngProfileDict(f)
-                # filter d
-                d = {k: d[k] for k in d if d[k] != ''}
                 if d:
                     self.cameraProfilesCombo.addItem(key, d)
             self.cameraProfilesCombo.addItem('None', {})
@@ -0,0 +1,120 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+
+import numpy as np
+from PySide2.QtCore import Qt
+from PySide2.QtGui import QImage
+
+from bLUeGui.baseSignal import baseSignal_Int
+from bLUeGui.bLUeImage import bImage, QImageBuffer
+from bLUeTop.settings import HIST_SAMPLE_SIZE
+
+
+class histogramService:
+    """
+    Background computation of histograms.
+    Requests are sent by the GUI thread with a subsample of the image,
+    and histograms are plotted by a worker thread. Pending requests are
+    coalesced : only the most recent one is computed, and the result
+    of a request is dropped if a newer one was submitted meanwhile.
+    """
+
+    @staticmethod
+    def sample(img, sampleSize=HIST_SAMPLE_SIZE):
+        """
+        Returns a copy of a stratified subsample of the image buffer,
+        with at most (approximately) sampleSize pixels.
+        @param img:
+        @type img: QImage
+        @param sampleSize:
+        @type sampleSize: int
+        @return:
+        @rtype: ndarray, shape (h, w, 4), dtype np.uint8
+        """
+        step = max(int(np.sqrt(img.width() * img.height() / sampleSize)), 1)
+        return QImageBuffer(img)[::step, ::step].copy()
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # most recent request not yet computed
+        self.pending = None
+        # id of the most recent request
+        self.requestId = 0
+        self.result = None
+        self.thread = None
+        # called by the GUI thread with the histogram plot
+        self.onReady = lambda img: 0
+        self.done = baseSignal_Int()
+        self.done.sig.connect(self.deliver, Qt.QueuedConnection)
+
+    def submit(self, buf, **kwargs):
+        """
+        Request the histogram of an image buffer.
+        Keyword arguments are passed to bImage.histogram().
+        @param buf: image sample, see sample()
+        @type buf: ndarray
+        """
+        with self.condition:
+            self.requestId += 1
+            self.pending = (self.requestId, buf, kwargs)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def cancel(self):
+        """
+        Drop pending requests and results.
+        """
+        with self.condition:
+            self.requestId += 1
+            self.pending = None
+
+    def run(self):
+        """
+        Worker loop.
+        """
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                rid, buf, kwargs = self.pending
+                self.pending = None
+            h, w = buf.shape[:2]
+            img = bImage(w, h, QImage.Format_ARGB32)
+            QImageBuffer(img)[...] = buf
+            # the buffer is already sampled
+            hist = img.histogram(sampleSize=None, **kwargs)
+            with self.condition:
+                if rid != self.requestId:
+                    continue
+                self.result = hist
+            self.done.sig.emit(rid)
+
+    def deliver(self, rid):
+        """
+        Result slot.
+        @param rid: request id
+        @type rid: int
+        """
+        with self.condition:
+            if rid != self.requestId or self.result is None:
+                return
+            hist, self.result = self.result, None
+        self.onReady(hist)
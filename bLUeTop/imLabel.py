@@ -138,15 +138,15 @@ class imageLabel(QLabel):
         # r is relative to the full resolution image, so we use mimg width and height
         w, h = mimg.width() * r, mimg.height() * r
         rectF = QRectF(mimg.xOffset, mimg.yOffset, w, h)
+        # visible part of the image, in full resolution coordinates
+        mimg.visibleRect = QRect(int(-mimg.xOffset / r), int(-mimg.yOffset / r),
+                                 int(self.width() / r) + 1, int(self.height() / r) + 1).intersected(mimg.rect())
         # draw a checker background to view (semi-)transparent images
         qp.fillRect(rectF, imageLabel.checkerBrush)
-        px = mimg.prLayer.qPixmap
+        # get the color managed visible part of the image
+        px, pxRectF = mimg.prLayer.displayPixmap(rectF, self.rect())
         if px is not None:
-            qp.drawPixmap(rectF, px, px.rect())
-        else:
-            currentImage = mimg.prLayer.getCurrentImage()
-            qp.drawImage(rectF, currentImage,
-                         QImage.rect(currentImage))  # CAUTION : vImage.rect() is overwritten by the attribute rect
+            qp.drawPixmap(pxRectF, px, px.rect())
         # draw selection rectangle and cloning marker of the active layer, if any
         layer = mimg.getActiveLayer()
         rect, mark = layer.rect, layer.marker
@@ -412,7 +412,8 @@ class imageLabel(QLabel):
                         layer.vlChanged = True
                         if layer.maskIsSelected or not layer.maskIsEnabled:
                             layer.setMaskEnabled(color=False)  # set to opacity mask
-                        layer.applyCloning(seamless=False, showTranslated=True, moving=True)
+                        # low resolution cloning, exact cloning on release or when idle
+                        layer.previewCloning()
         # not mouse selectable widget : probably before window alone !
         else:
             if modifiers == Qt.NoModifier:
@@ -509,14 +510,13 @@ class imageLabel(QLabel):
                         """
                         # for raw layer, set multipliers to get selected pixel as White Point : NOT USED YET
                         if layer.isRawLayer() and window.btnValues['colorPicker']:
-                            # get demosaic buffer and sample raw pixels
-                            bufRaw = layer.parentImage.demosaic
+                            # demosaic and sample raw pixels
                             nb = QRect(x_img-2, y_img-2, 4, 4)
                             r = QImage.rect(layer.parentImage).intersected(nb)
-                            if not r.isEmpty():
-                                color = np.sum(bufRaw[r.top():r.bottom()+1, r.left():r.right()+1], axis=(0, 1))/(r.width()*r.height())
-                            else:
-                                color = bufRaw[y_img, x_img, :]
+                            if r.isEmpty():
+                                r = QRect(x_img, y_img, 1, 1)
+                            bufRaw = layer.parentImage.demosaicRegion(r)
+                            color = np.sum(bufRaw, axis=(0, 1))/(r.width()*r.height())
                             color = [color[i] - layer.parentImage.rawImage.black_level_per_channel[i] for i in range(3)]
                             form = layer.getGraphicsForm()
                             if form.sampleMultipliers:
@@ -531,10 +531,8 @@ class imageLabel(QLabel):
                         layer.selectionChanged.sig.emit()
                     # cloning layer
                     elif layer.isCloningLayer():
-                        if layer.vlChanged:
-                            # the virtual layer was moved : clone
-                            layer.applyCloning(seamless=True, showTranslated=True, moving=True)
-                            layer.vlChanged = False
+                        # the virtual layer was moved : clone
+                        layer.cloneMoved()
         # updates
         self.repaint()
         # sync split views
@@ -584,7 +582,9 @@ class imageLabel(QLabel):
         # cloning layer zoom
         elif layer.isCloningLayer() and modifiers == Qt.ControlModifier | Qt.AltModifier:
             layer.AltZoom_coeff *= (1.0 + numSteps)
-            layer.applyCloning(seamless=False, showTranslated=True, moving=True)  # autocloning (seamless=true) too slow
+            layer.vlChanged = True
+            # low resolution cloning, exact cloning when idle
+            layer.previewCloning()
         self.repaint()
         # sync split views
         linked = True
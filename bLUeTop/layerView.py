@@ -154,6 +154,8 @@ class QLayerView(QTableView):
             useThumb = (state == Qt.Checked)
             if useThumb == self.img.useThumb:
                 return
+            # stop background rendering before switching mode
+            self.img.renderer.stop()
             self.img.useThumb = useThumb
             window.updateStatus()
             self.img.cacheInvalidate()
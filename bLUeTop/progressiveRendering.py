@@ -0,0 +1,359 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+from time import time
+
+import cv2
+from PySide2.QtCore import Qt, QRect, QTimer
+
+from bLUeGui.baseSignal import baseSignal_Int, baseSignal_No
+from bLUeGui.bLUeImage import QImageBuffer
+from bLUeGui.memory import weakProxy
+from bLUeTop.settings import RENDER_TILE_SIZE
+
+
+class progressiveRenderer:
+    """
+    Progressive refinement of the layer stack of an mImage.
+    When preview mode is off, a change is first applied to the
+    stack of thumbnails, giving an immediate feedback : the (upscaled)
+    preview is copied to the full size presentation layer. Full size
+    layers are next computed by a background thread and the presentation
+    layer is refined tile by tile, as soon as the thread terminates.
+    Each call to render() or cancel() preempts the running task. As layers
+    are not interruptible, preemption occurs between two layers : the GUI
+    thread never waits for a preempted task, unless stop() or wait() is called.
+    A render request arriving before the preempted task terminates is deferred
+    until it does.
+    """
+    # max duration (in seconds) of a refinement step
+    tileTimeSlice = 0.05
+
+    @staticmethod
+    def isThreadSafe(layer):
+        """
+        Raw, cloning and segmentation layers interact with
+        the GUI while they are executed, so they are never
+        computed in background.
+        @param layer:
+        @type layer: QLayer
+        @return:
+        @rtype: boolean
+        """
+        return not (layer.isRawLayer() or layer.isCloningLayer() or layer.isSegmentLayer())
+
+    def __init__(self, parentImage):
+        """
+        @param parentImage:
+        @type parentImage: mImage
+        """
+        self.parentImage = weakProxy(parentImage)
+        # rendering generation. It is incremented to preempt the running task.
+        self.generation = 0
+        self.thread = None
+        # lowest stack index of possibly stale full size layers
+        self.dirtyIndex = None
+        # True while the full size presentation layer is not up to date
+        self.stalePresentation = False
+        # presentation layer refinement
+        self.source = None
+        self.tiles = []
+        self.tileCount = 0
+        # signals are emitted by the background thread :
+        # slots must be called from the GUI thread.
+        self.done = baseSignal_Int()
+        self.done.sig.connect(self.refine, Qt.QueuedConnection)
+        # position of the layer computed by the background thread
+        self.layerIndex, self.layerCount = 0, 1
+        self.progress = baseSignal_Int()
+        self.progress.sig.connect(self.reportProgress, Qt.QueuedConnection)
+        # deferred render request
+        self.pendingLayer = None
+        self.ended = baseSignal_No()
+        self.ended.sig.connect(self.threadEnded, Qt.QueuedConnection)
+        # stack index of the first layer computed by the last background task
+        self.renderStart = 0
+
+    @property
+    def isBusy(self):
+        return self.thread is not None or len(self.tiles) > 0
+
+    def cancel(self):
+        """
+        Preempt the running task. Does not wait for the current
+        layer to be computed.
+        """
+        busy = self.isBusy
+        self.generation += 1
+        self.tiles = []
+        self.source = None
+        if busy:
+            self.reportProgress(100)
+
+    def stop(self):
+        """
+        Preempt the running task and wait for the current layer
+        to be computed. A deferred render request is recorded as stale
+        full size layers. Must be called before updating
+        the stack synchronously.
+        """
+        self.cancel()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+            self.thread = None
+        self.flushPending()
+
+    def flushPending(self):
+        """
+        Records the deferred render request, if any, as stale full size layers.
+        """
+        if self.pendingLayer is None:
+            return
+        i = self.pendingLayer.getStackIndex()
+        self.dirtyIndex = i if self.dirtyIndex is None else min(self.dirtyIndex, i)
+        self.stalePresentation = True
+        self.pendingLayer = None
+
+    def threadEnded(self):
+        """
+        Background thread terminated slot : the deferred
+        render request, if any, is started.
+        """
+        if self.thread is None or self.thread.is_alive():
+            return
+        self.thread.join()
+        self.thread = None
+        layer, self.pendingLayer = self.pendingLayer, None
+        if layer is None:
+            return
+        try:
+            layer.applyToStack()
+            self.parentImage.onImageChanged()
+        except ReferenceError:
+            # the image was closed
+            pass
+
+    def wait(self):
+        """
+        Wait for the background task to terminate and
+        update the full size presentation layer. Must be
+        called with preview mode off, before reading full size images.
+        """
+        self.stop()
+        if self.dirtyIndex is not None:
+            # preempted task : compute the remaining layers
+            self.run(self.generation, self.dirtyIndex)
+        if self.stalePresentation:
+            self.composite()
+
+    def staleLayer(self, layer):
+        """
+        Returns the lowest layer to recompute in order to update
+        the full size stack from layer. If a background task was preempted,
+        it may be lower than layer.
+        @param layer:
+        @type layer: QLayer
+        @return:
+        @rtype: QLayer
+        """
+        if self.dirtyIndex is None or self.dirtyIndex >= layer.getStackIndex():
+            return layer
+        return self.parentImage.layersStack[self.dirtyIndex]
+
+    def render(self, layer):
+        """
+        Progressive version of QLayer.applyToStack(): the stack of
+        thumbnails is updated from layer, and the computation of
+        full size layers is started in background.
+        Returns False if the stack contains layers that
+        cannot be computed in background. In this case, the caller must
+        update the stack synchronously.
+        @param layer:
+        @type layer: QLayer
+        @return:
+        @rtype: boolean
+        """
+        img = self.parentImage
+        start = layer.getStackIndex()
+        alive = self.thread is not None and self.thread.is_alive()
+        if not alive and self.pendingLayer is not None:
+            # the preempted task terminated before threadEnded() was called
+            self.flushPending()
+            layer = self.staleLayer(layer)
+            start = layer.getStackIndex()
+        if not all(self.isThreadSafe(l) for l in img.layersStack[start:] if l.visible):
+            return False
+        self.cancel()
+        if alive:
+            # the preempted task is still computing a layer :
+            # defer the request, keeping the lowest layer.
+            if self.pendingLayer is None or start < self.pendingLayer.getStackIndex():
+                self.pendingLayer = layer
+            return True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        # fast pass
+        img.useThumb = True
+        try:
+            layer.applyToStack()
+            preview = QImageBuffer(img.prLayer.getCurrentImage())
+        finally:
+            img.useThumb = False
+        prLayer = img.prLayer
+        QImageBuffer(prLayer)[...] = cv2.resize(preview, (prLayer.width(), prLayer.height()),
+                                                interpolation=cv2.INTER_LINEAR)
+        prLayer.updatePixmap()
+        self.dirtyIndex = start
+        self.stalePresentation = True
+        self.renderStart = start
+        gen = self.generation
+        self.thread = threading.Thread(target=self.run, args=(gen, start), daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self, gen, start):
+        """
+        Background task : compute full size layers from
+        index start.
+        @param gen: rendering generation
+        @type gen: int
+        @param start: stack index
+        @type start: int
+        """
+        try:
+            layers = [l for l in self.parentImage.layersStack[start:] if l.visible]
+            for i, layer in enumerate(layers):
+                if gen != self.generation:
+                    return
+                self.layerIndex, self.layerCount = i, len(layers)
+                layer.execute(l=layer)
+                layer.cacheInvalidate()
+                # the first half of the progress bar is for layers
+                self.progress.sig.emit(50 * (i + 1) // len(layers))
+            if gen != self.generation:
+                return
+            self.dirtyIndex = None
+            self.done.sig.emit(gen)
+        except ReferenceError:
+            # the image was closed
+            pass
+        finally:
+            if threading.current_thread() is self.thread:
+                self.ended.sig.emit()
+
+    def composite(self):
+        """
+        Update the (non color managed) full size presentation layer
+        from the stack. Drawing into the containers of the stack must
+        be done by the GUI thread only, so this is not done by the background task.
+        """
+        prLayer = self.parentImage.prLayer
+        bufOut = QImageBuffer(prLayer)
+        bufOut[...] = QImageBuffer(prLayer.inputImg())
+        prLayer.updatePixmap()
+        self.stalePresentation = False
+
+    def refine(self, gen):
+        """
+        Background task terminated slot : starts
+        the tile by tile refinement of the presentation layer.
+        @param gen: rendering generation
+        @type gen: int
+        """
+        if gen != self.generation:
+            return
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        img = self.parentImage
+        # pixmaps cannot be built by the background thread
+        for layer in img.layersStack[self.renderStart:]:
+            if layer.visible:
+                layer.updatePixmap()
+        prLayer = img.prLayer
+        # full size composition of the stack
+        self.source = QImageBuffer(prLayer.inputImg())
+        w, h = prLayer.width(), prLayer.height()
+        s = RENDER_TILE_SIZE
+        self.tiles = [QRect(x, y, min(s, w - x), min(s, h - y)) for y in range(0, h, s) for x in range(0, w, s)]
+        self.tileCount = len(self.tiles)
+        QTimer.singleShot(0, lambda: self.nextTiles(gen))
+
+    def nextTiles(self, gen):
+        """
+        Copy tiles from the full size composition to the presentation
+        layer during (approximately) tileTimeSlice seconds,
+        then give control back to the event loop.
+        @param gen: rendering generation
+        @type gen: int
+        """
+        if gen != self.generation:
+            return
+        img = self.parentImage
+        prLayer = img.prLayer
+        bufOut = QImageBuffer(prLayer)
+        start = time()
+        modified = QRect()
+        while self.tiles and time() - start < self.tileTimeSlice:
+            r = self.tiles.pop(0)
+            sl = (slice(r.top(), r.bottom() + 1), slice(r.left(), r.right() + 1))
+            bufOut[sl] = self.source[sl]
+            modified = modified.united(r)
+        prLayer.invalidateRegion(modified)
+        self.reportProgress(100 - 50 * len(self.tiles) // max(self.tileCount, 1))
+        if self.tiles:
+            img.onImageChanged(hist=False)
+            QTimer.singleShot(0, lambda: self.nextTiles(gen))
+        else:
+            self.source = None
+            self.stalePresentation = False
+            img.onImageChanged()
+
+    def isCancelled(self, gen):
+        """
+        Returns True if the task of rendering generation gen was preempted.
+        Long running layers poll it to stop early.
+        @param gen: rendering generation
+        @type gen: int
+        @return:
+        @rtype: boolean
+        """
+        return gen != self.generation
+
+    def layerProgress(self, value):
+        """
+        Reports the progress of the layer currently computed by the
+        background thread. Calls from other threads are ignored.
+        @param value: percent of the layer
+        @type value: int
+        """
+        if threading.current_thread() is not self.thread:
+            return
+        self.progress.sig.emit((50 * (100 * self.layerIndex + value)) // (100 * self.layerCount))
+
+    def reportProgress(self, value):
+        """
+        Progress slot.
+        @param value: percent
+        @type value: int
+        """
+        try:
+            self.parentImage.onRenderProgress(value)
+        except ReferenceError:
+            pass
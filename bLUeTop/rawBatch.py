@@ -0,0 +1,330 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import multiprocessing
+import threading
+from os.path import basename, join, splitext
+from time import time
+
+import cv2
+import numpy as np
+import rawpy
+from PySide2.QtCore import Qt
+
+from bLUeGui.baseSignal import baseSignal_Int
+from bLUeGui.histogramWarping import warpSpline
+from bLUeGui.multiplier import temperatureAndTint2Multipliers, multipliers2TemperatureAndTint
+from bLUeTop import exiftool
+from bLUeTop.rawProcessing import postprocessParams, rawColorMatrix, bakeProfileLUT, saturationLUT, gammaEncode8, \
+    composeToneTable, applyTable16, PROFILE_LUT_SIZE
+from bLUeCore.trilinear import interpTriLinear
+from bLUeTop.settings import POOL_SIZE, RAW_BATCH_MEMORY, HIST_SAMPLE_SIZE
+
+# Approximate count of bytes allocated by the development of a raw image, per pixel:
+# libraw buffers (sensor data and 4 x 16 bits image) and float32 buffers of the pipeline.
+BATCH_BYTES_PER_PIXEL = 80
+
+
+def rawSettings(rawLayer):
+    """
+    Captures the settings of a development layer. The returned
+    dict is picklable and does not depend on the developed image :
+    white balance is recorded as a mode and a temperature/tint pair,
+    and the multipliers are computed for each developed file.
+    @param rawLayer: development layer
+    @type rawLayer: QRawLayer
+    @return:
+    @rtype: dict
+    """
+    form = rawLayer.getGraphicsForm()
+    options = {}
+    for w in [form.listWidget3, form.listWidget2, form.listWidget1]:
+        options.update(w.options)
+    toneCurve, contrastCurve = None, None
+    if form.toneForm is not None and form.toneForm.isVisible():
+        toneCurve = np.array(form.toneForm.scene().quadricB.LUTXY, dtype=np.float32)
+    if form.contCorrection > 0 and not rawLayer.autoSpline:
+        spline = rawLayer.getMmcSpline()
+        if spline is not None:
+            contrastCurve = np.array(spline.LUTXY / 256, dtype=np.float32)
+    return {'options': options,
+            'expCorrection': form.expCorrection,
+            'brCorrection': form.brCorrection,
+            'overexpValue': form.overexpValue,
+            'denoiseValue': form.denoiseValue,
+            'tempCorrection': form.tempCorrection,
+            'tintCorrection': form.tintCorrection,
+            'contCorrection': form.contCorrection,
+            'satCorrection': form.satCorrection,
+            'dngDict': dict(form.dngDict) if form.dngDict else {},
+            'toneCurve': toneCurve,
+            'contrastCurve': contrastCurve
+            }
+
+
+def developRawFile(filename, settings):
+    """
+    Develops a raw file with the settings captured by rawSettings().
+    The function does not use the GUI, and it can be called by worker processes.
+    Steps and their order are those of rawProcessing.rawPostProcess().
+    @param filename: raw file
+    @type filename: str
+    @param settings:
+    @type settings: dict
+    @return: developed image (BGR)
+    @rtype: ndarray, shape (h, w, 3), dtype np.uint8
+    """
+    options = settings['options']
+    dngDict = settings['dngDict']
+    params = postprocessParams(options, settings['expCorrection'], settings['brCorrection'],
+                               settings['overexpValue'], settings['denoiseValue'])
+    with rawpy.imread(filename) as raw:
+        XYZ2CameraMatrix = raw.rgb_xyz_matrix[:3, :]
+        # white balance of the file (cf. graphicsRaw.rawForm)
+        m1, m2, m3, m4 = raw.camera_whitebalance
+        asShotMultipliers = (m1 / m2, 1.0, m3 / m2, m4 / m2)
+        if options['Camera WB']:
+            multipliers = asShotMultipliers
+            temp, _ = multipliers2TemperatureAndTint(*1 / np.array(multipliers[:3]), XYZ2CameraMatrix)
+        else:
+            temp = settings['tempCorrection']
+            multipliers = [1 / m for m in temperatureAndTint2Multipliers(temp, 1.0, XYZ2CameraMatrix, dngDict=dngDict)]
+            multipliers[1] *= settings['tintCorrection']
+            multipliers = [m / multipliers[1] for m in multipliers]
+        buf8 = raw.postprocess(output_color=rawpy.ColorSpace.raw,
+                               output_bps=8,
+                               use_auto_wb=options['Auto WB'],
+                               use_camera_wb=options['Camera WB'],
+                               user_wb=multipliers,
+                               gamma=(1, 1),
+                               median_filter_passes=1,
+                               **params)
+    h, w = buf8.shape[:2]
+    matrix = rawColorMatrix(multipliers, temp, settings['tempCorrection'], np.linalg.inv(XYZ2CameraMatrix),
+                            dngDict, params['exp_preserve_highlights'])
+    bufRGB32 = buf8.astype(np.float32)
+    del buf8
+    cv2.transform(bufRGB32, matrix.astype(np.float32), dst=bufRGB32)
+    bufRGB32 *= 1.0 / np.max(bufRGB32)
+    np.clip(bufRGB32, 0, 1, out=bufRGB32)
+    # profile
+    LUT = bakeProfileLUT(dngDict, options['cpLookTable'])
+    if LUT is not None:
+        np.sqrt(bufRGB32, out=bufRGB32)
+        bufRGB32 = interpTriLinear(LUT, 1.0 / (PROFILE_LUT_SIZE - 1), bufRGB32, convert=False)
+    bufHSV = cv2.cvtColor(bufRGB32, cv2.COLOR_RGB2HSV)
+    # user tone curve and contrast, composed into a single table (cf. rawProcessing.toneTable)
+    userLUTXY, T = settings['toneCurve'], None
+    if settings['contCorrection'] > 0:
+        T = settings['contrastCurve']
+        if T is None:
+            warp = max(0, (settings['contCorrection'] - 1)) / 10
+            step = max(int(np.sqrt(h * w / HIST_SAMPLE_SIZE)), 1)
+            v = bufHSV[::step, ::step, 2]
+            if userLUTXY is not None:
+                v = np.interp(v * 255, np.arange(len(userLUTXY)), userLUTXY / 255)
+            T = warpSpline(v, valleyAperture=0.05, warp=warp, preserveHigh=options['Preserve Highlights'])[3]
+    if userLUTXY is not None or T is not None:
+        applyTable16(bufHSV[:, :, 2], composeToneTable(userLUTXY, T), np.empty((h, w), dtype=np.uint16))
+    if settings['satCorrection'] != 0:
+        LUT = saturationLUT(settings['satCorrection'] / 100)
+        bufHSV[:, :, 1] = np.interp(bufHSV[:, :, 1] * 255, np.arange(256), LUT)
+    cv2.cvtColor(bufHSV, cv2.COLOR_HSV2RGB, dst=bufRGB32)
+    del bufHSV
+    bufOut = np.empty((h, w, 3), dtype=np.uint8)
+    gammaEncode8(bufRGB32, bufOut, np.empty((h, w), dtype=np.uint16))
+    return bufOut[:, :, ::-1]
+
+
+def batchJob(filename, outFilename, settings, quality):
+    """
+    Worker process job : develops filename and writes the result to outFilename.
+    @param filename:
+    @type filename: str
+    @param outFilename:
+    @type outFilename: str
+    @param settings: development settings, cf. rawSettings()
+    @type settings: dict
+    @param quality: jpeg quality, range 0..100
+    @type quality: int
+    @return: error message or None, development and writing durations (seconds)
+    @rtype: 3-uple
+    """
+    try:
+        start = time()
+        buf = developRawFile(filename, settings)
+        t1 = time()
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality] if outFilename[-3:].upper() == 'JPG' else []
+        if not cv2.imwrite(outFilename, buf, params):
+            raise IOError('Cannot write %s' % outFilename)
+        return None, t1 - start, time() - t1
+    except Exception as e:
+        return str(e), 0, 0
+
+
+def rawMemoryEstimate(filename):
+    """
+    Returns the (approximate) count of bytes allocated by
+    the development of a raw file.
+    @param filename:
+    @type filename: str
+    @return:
+    @rtype: int
+    """
+    with rawpy.imread(filename) as raw:
+        sizes = raw.sizes
+    return sizes.raw_width * sizes.raw_height * BATCH_BYTES_PER_PIXEL
+
+
+class rawBatch:
+    """
+    Batch development of raw files, with a common set of settings.
+    Files are developed in parallel by a pool of processes. A job
+    is started only if the sum of the memory estimates of running jobs
+    (cf. rawMemoryEstimate()) does not exceed the memory budget. A single
+    job is always allowed. Metadata of raw files are copied to the developed
+    images by exiftool. Results are sent to the GUI thread
+    by the signal fileDone, and the batch termination by the signal finished.
+    """
+    def __init__(self, filenames, settings, outDir, fileFormat='jpg', quality=90,
+                 budget=RAW_BATCH_MEMORY * 2**20, processes=POOL_SIZE):
+        """
+        @param filenames: raw files
+        @type filenames: list of str
+        @param settings: development settings, cf. rawSettings()
+        @type settings: dict
+        @param outDir: output folder
+        @type outDir: str
+        @param fileFormat: 'jpg' or 'tif'
+        @type fileFormat: str
+        @param quality: jpeg quality, range 0..100
+        @type quality: int
+        @param budget: max memory (bytes)
+        @type budget: int
+        @param processes: max count of worker processes
+        @type processes: int
+        """
+        self.filenames = filenames
+        self.settings = settings
+        self.outFilenames = [join(outDir, splitext(basename(f))[0] + '.' + fileFormat) for f in filenames]
+        self.quality = quality
+        self.budget = budget
+        self.processes = max(processes, 1)
+        # one entry per file : (error message or None, development, writing and metadata durations)
+        self.results = [None] * len(filenames)
+        self.aborted = False
+        self.thread = None
+        self.condition = threading.Condition()
+        self.fileDone = baseSignal_Int()
+        self.fileDone.sig.connect(lambda i: self.onFileDone(i), Qt.QueuedConnection)
+        self.finished = baseSignal_Int()
+        self.finished.sig.connect(lambda n: self.onFinished(), Qt.QueuedConnection)
+        self.onFileDone = lambda i: 0
+        self.onFinished = lambda: 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def abort(self):
+        """
+        Pending files are not developed. Running jobs terminate.
+        """
+        with self.condition:
+            self.aborted = True
+            self.condition.notify()
+
+    def run(self):
+        """
+        Scheduler loop.
+        """
+        used, running, done = 0, 0, []
+
+        def jobDone(i, size, result):
+            # called by the result handler thread of the pool
+            nonlocal used, running
+            with self.condition:
+                used -= size
+                running -= 1
+                done.append((i, result))
+                self.condition.notify()
+
+        pool = multiprocessing.Pool(min(self.processes, len(self.filenames)) or 1)
+        try:
+            with exiftool.ExifTool() as e:
+                pending = list(range(len(self.filenames)))
+                # memory estimates of pending files, computed once per file
+                sizes = {}
+                while True:
+                    # the next file is estimated outside of the lock (file header reading)
+                    if pending and pending[0] not in sizes and not self.aborted:
+                        try:
+                            sizes[pending[0]] = rawMemoryEstimate(self.filenames[pending[0]])
+                        except (rawpy.LibRawError, IOError) as exc:
+                            with self.condition:
+                                done.append((pending.pop(0), (str(exc), 0, 0)))
+                    with self.condition:
+                        while pending and pending[0] in sizes and not self.aborted:
+                            size = sizes[pending[0]]
+                            if running > 0 and (running >= self.processes or used + size > self.budget):
+                                break
+                            i = pending.pop(0)
+                            used += size
+                            running += 1
+                            pool.apply_async(batchJob, (self.filenames[i], self.outFilenames[i], self.settings, self.quality),
+                                             callback=lambda r, i=i, size=size: jobDone(i, size, r),
+                                             error_callback=lambda exc, i=i, size=size: jobDone(i, size, (str(exc), 0, 0)))
+                        # wait for a job, unless the next file must be estimated first
+                        while not done and running > 0 and (not pending or pending[0] in sizes or self.aborted):
+                            self.condition.wait()
+                        finished, done[:] = list(done), []
+                        if not finished and running == 0 and (not pending or self.aborted):
+                            break
+                    for i, (error, tDev, tWrite) in finished:
+                        tMeta = 0
+                        if error is None:
+                            t = time()
+                            # copy metadata. Developed images are not rotated.
+                            e.execute("-tagsFromFile", self.filenames[i], "-all", "-overwrite_original",
+                                      self.outFilenames[i])
+                            e.writeOrientation(self.outFilenames[i], '1')
+                            tMeta = time() - t
+                        self.results[i] = (error, tDev, tWrite + tMeta)
+                        self.fileDone.sig.emit(i)
+        finally:
+            pool.close()
+            pool.join()
+        self.finished.sig.emit(len(self.filenames))
+
+    def report(self):
+        """
+        Returns the per-file timing report.
+        @return:
+        @rtype: str
+        """
+        lines = []
+        total = 0
+        for f, r in zip(self.filenames, self.results):
+            if r is None:
+                lines.append('%s : not developed' % basename(f))
+            elif r[0] is not None:
+                lines.append('%s : error %s' % (basename(f), r[0]))
+            else:
+                lines.append('%s : development %.2fs, writing %.2fs' % (basename(f), r[1], r[2]))
+                total += r[1] + r[2]
+        lines.append('\nTotal processing time %.2fs' % total)
+        return '\n'.join(lines)
@@ -18,6 +18,8 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import cv2
 import itertools
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import rawpy
@@ -26,31 +28,158 @@ from rawpy._rawpy import LibRawFatalError
 
 from bLUeCore.multi import chosenInterp
 from bLUeGui.bLUeImage import QImageBuffer, bImage
-from bLUeGui.colorCIE import rgbLinear2rgb, sRGB_lin2XYZInverse, bradfordAdaptationMatrix
+from bLUeGui.colorCIE import sRGB_lin2XYZInverse, bradfordAdaptationMatrix, gammaTables
 from bLUeGui.dialog import dlgWarn
 from bLUeGui.const import channelValues
-from bLUeGui.histogramWarping import warpHistogram
+from bLUeGui.histogramWarping import warpSpline
 from bLUeTop.dng import dngProfileLookTable, dngProfileToneCurve, interpolatedForwardMatrix
+from bLUeTop.settings import RAW_DOCUMENT_MEMORY, HIST_SAMPLE_SIZE
+
+# Stages of the development pipeline. Each stage caches its output
+# in the development layer, and a change recomputes its
+# stage and the next ones (cf. QRawLayer.invalidateStage()).
+STAGE_DEVELOP = 1  # demosaic, white balance and exposure (libraw) : rawLayer.bufpost16
+STAGE_MATRIX = 2   # camera matrix : rawLayer.postProcessCache
+STAGE_PROFILE = 3  # profile look table and tone curve : rawLayer.bufCache_HSV_CV32
+STAGE_TONE = 4     # user tone curve and contrast : rawLayer.toneCache
+STAGE_COLOR = 5    # saturation, conversion to RGB and gamma : layer image
+
+# count of nodes per axis of the baked profile LUT (cf. profileLUT)
+PROFILE_LUT_SIZE = 65
+
+# size of the tone table (cf. toneTable)
+TONE_TABLE_SIZE = 65536
+
+# pool of threads for the row bands of the raw pipeline
+BAND_COUNT = max(cpu_count(), 1)
+bandPool = None
+
+
+class rawFile:
+    """
+    Raw image file. The file is read into a RawPy instance and
+    closed at once, so that it is not locked while the document is open.
+    The file content and the unpacked sensor data can be released by release()
+    (on document close, or when the raw document holds too much memory).
+    They are reloaded from the file on the next access to an attribute of the
+    underlying RawPy instance. Attributes and methods of the RawPy
+    instance are accessed through the rawFile instance.
+    load() may be called by background threads : errors are raised, not displayed.
+    """
+    def __init__(self, filename):
+        """
+        @param filename:
+        @type filename: str
+        """
+        self.filename = filename
+        self.raw = None
+        self.load()
+
+    def __getattr__(self, name):
+        # called only for attributes not found in rawFile
+        if name == 'raw':
+            raise AttributeError(name)
+        if self.raw is None:
+            self.load()
+        return getattr(self.raw, name)
+
+    @property
+    def isUnpacked(self):
+        return self.raw is not None
+
+    def load(self):
+        """
+        Reads the file and unpacks sensor data.
+        """
+        raw = rawpy.RawPy()
+        with open(self.filename, "rb") as bufio:
+            raw.open_buffer(bufio)
+        try:
+            raw.unpack()
+        except LibRawFatalError:
+            raw.close()
+            raise
+        self.raw = raw
+
+    def release(self):
+        """
+        Frees the memory held by libraw (file content, sensor data and
+        development buffers).
+        """
+        if self.raw is not None:
+            self.raw.close()
+            self.raw = None
 
 
 def rawRead(filename):
     """
-    Loads a raw image file into a RawPy instance.
-    The image file is closed after reading.
+    Loads a raw image file into a rawFile instance.
     @param filename:
-    @tyep filename: str
+    @type filename: str
     @return:
-    @rtype: RawPy instance
+    @rtype: rawFile
     """
-    rawpyInst = rawpy.RawPy()
-    with open(filename, "rb") as bufio:
-        rawpyInst.open_buffer(bufio)
     try:
-        rawpyInst.unpack()
-    except LibRawFatalError as e:
+        return rawFile(filename)
+    except LibRawFatalError:
         dlgWarn('LibRaw Fatal Error', 'Only flat raw images are supported')
         raise
-    return rawpyInst
+
+
+def rawDevelopmentSize(rawpyInst):
+    """
+    Returns the size of the (full size) image
+    developed by rawpyInst.postprocess().
+    @param rawpyInst:
+    @type rawpyInst: RawPy instance
+    @return: width, height
+    @rtype: 2-uple of int
+    """
+    sizes = rawpyInst.sizes
+    w, h = sizes.width, sizes.height
+    # libraw flip codes 5 and 6 are rotations by 90 and 270 degrees
+    if sizes.flip & 4:
+        w, h = h, w
+    return w, h
+
+
+def rawPreview(rawpyInst, orientation):
+    """
+    Returns the embedded preview of a raw image, oriented and
+    resized to the size of the developed image, or None if the raw file
+    has no usable preview.
+    @param rawpyInst:
+    @type rawpyInst: RawPy instance
+    @param orientation: exif orientation
+    @type orientation: int
+    @return: BGR image
+    @rtype: ndarray, dtype np.uint8, shape (h, w, 3)
+    """
+    try:
+        thumb = rawpyInst.extract_thumb()
+        if thumb.format == rawpy.ThumbFormat.JPEG:
+            # the exif orientation of the preview is ignored : the raw orientation is applied below
+            buf = cv2.imdecode(np.frombuffer(thumb.data, dtype=np.uint8),
+                               cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        elif thumb.format == rawpy.ThumbFormat.BITMAP:
+            buf = np.ascontiguousarray(thumb.data[:, :, ::-1])
+        else:
+            return None
+    except (rawpy.LibRawError, cv2.error):
+        return None
+    if buf is None:
+        return None
+    w, h = rawDevelopmentSize(rawpyInst)
+    # the preview is stored in sensor orientation
+    if orientation == 3:
+        buf = cv2.rotate(buf, cv2.ROTATE_180)
+    elif orientation == 6:
+        buf = cv2.rotate(buf, cv2.ROTATE_90_CLOCKWISE)
+    elif orientation == 8:
+        buf = cv2.rotate(buf, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if buf.shape[:2] != (h, w):
+        buf = cv2.resize(buf, (w, h), interpolation=cv2.INTER_LINEAR)
+    return buf
 
 
 def rawPostProcess(rawLayer, pool=None):
@@ -95,16 +224,19 @@ def rawPostProcess(rawLayer, pool=None):
 
     ##################
     # Control flags
-    # postProcessCache is invalidated (reset to None) to by graphicsRaw.updateLayer (graphicsRaw.dataChanged event handler).
-    # bufCache_HSV_CV32 is invalidated (reset to None) by camera profile related events.
-    doALL = rawLayer.postProcessCache is None
-    if not doALL:
-        parentImage = rawLayer.parentImage
-        if (rawLayer.half and not parentImage.useThumb) or (not rawLayer.half and parentImage.useThumb):
-            rawLayer.postProcessCache, rawLayer.bufCache_HSV_CV32 = (None,) * 2
-            doALL = True
-    doCameraLookTable = options['cpLookTable']  # and (doALL or rawLayer.bufCache_HSV_CV32 is None)
-    half_size = rawLayer.parentImage.useThumb
+    # Each stage of the pipeline caches its output (cf. STAGE_DEVELOP...STAGE_COLOR).
+    # rawLayer.rawStage is the first stage to recompute. It is updated
+    # by graphicsRaw.updateLayer (graphicsRaw.dataChanged event handler).
+    # Caches are computed either from the full size image or in preview mode :
+    # all stages are recomputed when switching modes.
+    parentImage = rawLayer.parentImage
+    if rawLayer.bufpost16 is None or rawLayer.half != parentImage.useThumb:
+        rawLayer.invalidateStage(STAGE_DEVELOP)
+    # the last stage is always executed, to write the output image.
+    stage = min(rawLayer.rawStage, STAGE_COLOR)
+    doALL = stage == STAGE_DEVELOP
+    doCameraLookTable = options['cpLookTable']
+    half_size = parentImage.useThumb
     #################
 
     ######################################################################################################################
@@ -121,61 +253,68 @@ def rawPostProcess(rawLayer, pool=None):
 
     use_auto_wb = options['Auto WB']
     use_camera_wb = options['Camera WB']
-    exp_preserve_highlights = 0.99 if options['Preserve Highlights'] else 0.2  # 0.6  # range 0.0..1.0 (1.0 = full preservation)
+    params = postprocessParams(options, adjustForm.expCorrection, adjustForm.brCorrection,
+                               adjustForm.overexpValue, adjustForm.denoiseValue)
+    exp_preserve_highlights = params['exp_preserve_highlights']
     if doALL:
         ##############################
         # get postprocessing parameters
         ##############################
-        # no_auto_scale = False  don't use : green shift
-        gamma = (2.222, 4.5)  # default REC BT 709 (exponent, slope)
-        # gamma = (2.4, 12.92)  # sRGB (exponent, slope) cf. https://en.wikipedia.org/wiki/SRGB#The_sRGB_transfer_function_("gamma")
-        exp_shift = adjustForm.expCorrection if not options['Auto Brightness'] else 0
-        no_auto_bright = (not options['Auto Brightness'])
-
-        bright = adjustForm.brCorrection  # default 1, should be > 0
-        hv = adjustForm.overexpValue
-        highlightmode = rawpy.HighlightMode.Clip if hv == 0 \
-            else rawpy.HighlightMode.Ignore if hv == 1 \
-            else rawpy.HighlightMode.Blend if hv == 2 \
-            else rawpy.HighlightMode.ReconstructDefault
-        dv = adjustForm.denoiseValue
-        fbdd_noise_reduction = rawpy.FBDDNoiseReductionMode.Off if dv == 0 \
-            else rawpy.FBDDNoiseReductionMode.Light if dv == 1 \
-            else rawpy.FBDDNoiseReductionMode.Full
+        exp_shift, no_auto_bright, bright = params['exp_shift'], params['no_auto_bright'], params['bright']
+        highlightmode = params['highlight_mode']
+        fbdd_noise_reduction = params['fbdd_noise_reduction']
         #############################################
-        # build sample images for a set of multipliers
+        # build sample images for a set of multipliers.
+        # Postprocessing is linear in raw color space, so all samples
+        # are derived from a single development with unit multipliers,
+        # by scaling the channels. This development is cached (at the size of the grid cells)
+        # in rawLayer.sampleBase, as long as the postprocessing parameters are unchanged.
         if adjustForm.sampleMultipliers:
-            bufpost16 = np.empty((rawLayer.height(), rawLayer.width(), 3), dtype=np.uint16)
-            m = adjustForm.rawMultipliers
-            co = np.array([0.85, 1.0, 1.2])
-            mults = itertools.product(m[0] * co, [m[1]], m[2] * co)
-            adjustForm.samples = []
-            for i, mult in enumerate(mults):
-                adjustForm.samples.append(mult)
-                mult = (mult[0], mult[1], mult[2], mult[1])
-                print(mult, '   ', m)
+            h, w = (rawLayer.height(), rawLayer.width()) if not half_size else \
+                   (currentImage.height(), currentImage.width())
+            ch, cw = h // 3, w // 3
+            key = (exp_shift, no_auto_bright, bright, highlightmode, exp_preserve_highlights, cw, ch)
+            base = rawLayer.sampleBase
+            if base is None or base[0] != key:
                 bufpost_temp = rawImage.postprocess(
-                    half_size=half_size,
-                    output_color=rawpy.ColorSpace.sRGB,
-                    output_bps=output_bpc,
+                    half_size=True,
+                    output_color=rawpy.ColorSpace.raw,
+                    output_bps=16,
                     exp_shift=exp_shift,
                     no_auto_bright=no_auto_bright,
-                    use_auto_wb=use_auto_wb,
-                    use_camera_wb=False,  # options['Camera WB'],
-                    user_wb=mult,
-                    gamma=gamma,
+                    use_auto_wb=False,
+                    use_camera_wb=False,
+                    user_wb=(1.0, 1.0, 1.0, 1.0),
+                    gamma=(1, 1),
                     exp_preserve_highlights=exp_preserve_highlights,
                     bright=bright,
                     highlight_mode=highlightmode,
                     fbdd_noise_reduction=rawpy.FBDDNoiseReductionMode.Off
                 )
+                base = (key, cv2.resize(bufpost_temp.astype(np.float32), (cw, ch), interpolation=cv2.INTER_AREA))
+                rawLayer.sampleBase = base
+            cell = base[1]
+            # the grid is in range 0..max_ouput, as the output of postprocess.
+            bufpost16 = np.zeros((h, w, 3), dtype=np.float32)
+            m = adjustForm.rawMultipliers
+            co = np.array([0.85, 1.0, 1.2])
+            mults = itertools.product(m[0] * co, [m[1]], m[2] * co)
+            adjustForm.samples = []
+            for i, mult in enumerate(mults):
+                adjustForm.samples.append(mult)
+                # multipliers are normalized by postprocess : min = 1
+                scale = np.array(mult, dtype=np.float32) / min(mult)
                 row = i // 3
                 col = i % 3
-                w, h = int(bufpost_temp.shape[1] / 3), int(bufpost_temp.shape[0] / 3)
-                bufpost_temp = cv2.resize(bufpost_temp, (w, h))
-                bufpost16[row * h:(row + 1) * h, col * w:(col + 1) * w, :] = bufpost_temp
+                tile = bufpost16[row * ch:(row + 1) * ch, col * cw:(col + 1) * cw, :]
+                np.multiply(cell, scale, out=tile)
+                # saturated sensels
+                np.minimum(tile, 65535, out=tile)
+                tile *= max_ouput / 65535
         # develop
         else:
+            # sampling is over : free its cached development
+            rawLayer.sampleBase = None
             bufpost16 = rawImage.postprocess(
                 half_size=half_size,
                 output_color=rawpy.ColorSpace.raw,  # XYZ
@@ -192,138 +331,415 @@ def rawPostProcess(rawLayer, pool=None):
                 fbdd_noise_reduction=fbdd_noise_reduction,
                 median_filter_passes=1
             )
-        # save image into post processing cache
-        rawLayer.postProcessCache = cv2.cvtColor(((bufpost16.astype(np.float32)) / max_ouput).astype(np.float32), cv2.COLOR_RGB2HSV)
+        # save postprocessed image
         rawLayer.half = half_size
         rawLayer.bufpost16 = bufpost16
-    else:
-        pass
-
-    # postProcessCache is in raw color space.
-    # and must be converted to linear RGB. We follow
-    # the guidelines of Adobe dng spec. (chapter 6).
-    # If we have a valid dng profile and valid ForwardMatrix1
-    # and ForwardMatrix2 matrices, we first convert to XYZ_D50 using the interpolated
-    # ForwardMatrix for T and next from XYZ_D50 to RGB.
-    # If we have no valid dng profile, we reinit the multipliers and
-    # apply a Bradford chromatic adaptation matrix.
-    m1, m2, m3 = adjustForm.asShotMultipliers[:3] if use_camera_wb else adjustForm.rawMultipliers[:3]
-    D = np.diag((1/m1, 1/m2, 1/m3))
-    tempCorrection = adjustForm.asShotTemp if use_camera_wb else adjustForm.tempCorrection
-    MM = bradfordAdaptationMatrix(6500, tempCorrection)
-    MM1 = bradfordAdaptationMatrix(6500, 5000)
-    FM = None
-    myHighlightPreservation = 0.8 if exp_preserve_highlights > 0.9 else 1.0
-    if adjustForm.dngDict:
-        try:
-            FM = interpolatedForwardMatrix(adjustForm.tempCorrection, adjustForm.dngDict)
-        except ValueError:
-            pass
-    raw2sRGBMatrix = sRGB_lin2XYZInverse @ MM1 @ FM * myHighlightPreservation if FM is not None else\
-                     sRGB_lin2XYZInverse @ MM @ adjustForm.XYZ2CameraInverseMatrix @ D
-    bufpost16 = np.tensordot(rawLayer.bufpost16, raw2sRGBMatrix, axes=(-1, -1))
-    M = np.max(bufpost16) / 255.0
-    bufpost16 = bufpost16 / M
-    np.clip(bufpost16, 0, 255, out=bufpost16)
-    rawLayer.postProcessCache = cv2.cvtColor(((bufpost16.astype(np.float32)) / max_ouput).astype(np.float32), cv2.COLOR_RGB2HSV)
-
-    # update histogram
-    s = rawLayer.postProcessCache.shape
-    tmp = bImage(s[1], s[0], QImage.Format_RGB32)
-    buf = QImageBuffer(tmp)
-    buf[:, :, :] = (rawLayer.postProcessCache[:, :, 2, np.newaxis] * 255).astype(np.uint8)  # TODO optimize
-    rawLayer.linearImg = tmp
-
-    if getattr(adjustForm, "toneForm", None) is not None:
+        # The full size development is cached : if the document holds
+        # too much memory, we release the sensor data. They are reloaded
+        # by further developments or samplings.
+        if not half_size and not adjustForm.sampleMultipliers:
+            if sum(rawLayer.memoryUsage().values()) > RAW_DOCUMENT_MEMORY * 2**20:
+                rawImage.release()
+
+    h, w = rawLayer.bufpost16.shape[:2]
+    ind = np.empty((h, w), dtype=np.uint16)
+    bufRGB32 = np.empty((h, w, 3), dtype=np.float32)
+    # True while bufRGB32 holds the output of the camera matrix stage
+    linearRGB = False
+    ########################################################################
+    # The remaining steps are done in place, in float32. The caches
+    # of recomputed stages are released before allocating the new ones.
+    # Element wise operations are applied to bands of rows by a pool of threads.
+    ########################################################################
+    if stage <= STAGE_MATRIX:
+        # bufpost16 is in raw color space.
+        # and must be converted to linear RGB. We follow
+        # the guidelines of Adobe dng spec. (chapter 6).
+        # If we have a valid dng profile and valid ForwardMatrix1
+        # and ForwardMatrix2 matrices, we first convert to XYZ_D50 using the interpolated
+        # ForwardMatrix for T and next from XYZ_D50 to RGB.
+        # If we have no valid dng profile, we reinit the multipliers and
+        # apply a Bradford chromatic adaptation matrix.
+        raw2sRGBMatrix = rawColorMatrix(adjustForm.asShotMultipliers if use_camera_wb else adjustForm.rawMultipliers,
+                                        adjustForm.asShotTemp if use_camera_wb else adjustForm.tempCorrection,
+                                        adjustForm.tempCorrection, adjustForm.XYZ2CameraInverseMatrix,
+                                        adjustForm.dngDict, exp_preserve_highlights)
+        np.copyto(bufRGB32, rawLayer.bufpost16, casting='unsafe')
+        cv2.transform(bufRGB32, raw2sRGBMatrix.astype(np.float32), dst=bufRGB32)
+        # normalize to range 0..1
+        bufRGB32 *= 255.0 / (np.max(bufRGB32) * max_ouput)
+        np.clip(bufRGB32, 0, 1, out=bufRGB32)
+        linearRGB = True
+        rawLayer.postProcessCache, rawLayer.bufCache_HSV_CV32, rawLayer.toneCache = None, None, None
+        bufHSV_CV32 = np.empty((h, w, 3), dtype=np.float32)
+        cv2.cvtColor(bufRGB32, cv2.COLOR_RGB2HSV, dst=bufHSV_CV32)
+        rawLayer.postProcessCache = bufHSV_CV32
+
+    # update histogram (from a subsample of the V channel)
+    if getattr(adjustForm, "toneForm", None) is not None and (stage <= STAGE_MATRIX or toneCurveShowFirst):
+        bufHSV_CV32 = rawLayer.postProcessCache
+        step = max(int(np.sqrt(h * w / HIST_SAMPLE_SIZE)), 1)
+        v = bufHSV_CV32[::step, ::step, 2]
+        tmp = bImage(v.shape[1], v.shape[0], QImage.Format_RGB32)
+        QImageBuffer(tmp)[:, :, :3] = (v * 255).astype(np.uint8)[..., np.newaxis]
         rawLayer.histImg = tmp.histogram(size=adjustForm.toneForm.scene().axeSize,
                                          bgColor=adjustForm.toneForm.scene().bgColor,
                                          range=(0, 255), chans=channelValues.Br)  # mode='Luminosity')
         adjustForm.toneForm.scene().quadricB.histImg = rawLayer.histImg
         adjustForm.toneForm.scene().update()
 
-    # beginning of the camera profile phase : update buffers from the last post processed image
-    bufHSV_CV32 = rawLayer.postProcessCache.copy()
-    rawLayer.bufCache_HSV_CV32 = bufHSV_CV32.copy()
-
-    ##########################
-    # Profile look table
-    # it must be applied to the linear buffer and
-    # before tone curve (cf. Adobe dng spec. p. 65)
-    ##########################
-    if doCameraLookTable:
-        hsvLUT = dngProfileLookTable(adjustForm.dngDict)
-        if hsvLUT.isValid:
-            divs = hsvLUT.divs
-            steps = tuple([360 / divs[0], 1.0 / (divs[1] - 1), 1.0 / (divs[2] - 1)])
+    if stage <= STAGE_PROFILE:
+        ##########################
+        # Profile look table and profile tone curve.
+        # The look table must be applied to the linear buffer and
+        # before tone curve (cf. Adobe dng spec. p. 65). For a given profile,
+        # both are a fixed color function, baked into a 3D LUT (cf. profileLUT).
+        # postProcessCache must be preserved.
+        ##########################
+        rawLayer.bufCache_HSV_CV32, rawLayer.toneCache = None, None
+        LUT = profileLUT(rawLayer, adjustForm.dngDict, doCameraLookTable, pool=pool)
+        if LUT is not None:
+            if not linearRGB:
+                cv2.cvtColor(rawLayer.postProcessCache, cv2.COLOR_HSV2RGB, dst=bufRGB32)
+            # the LUT input is the square root of linear RGB
+            applyByRows(lambda rows: np.sqrt(bufRGB32[rows], out=bufRGB32[rows]), h)
             interp = chosenInterp(pool, currentImage.width() * currentImage.height())
-            coeffs = interp(hsvLUT.data, steps, bufHSV_CV32, convert=False)
-            bufHSV_CV32[:, :, 0] = np.mod(bufHSV_CV32[:, :, 0] + coeffs[:, :, 0], 360)
-            bufHSV_CV32[:, :, 1:] = bufHSV_CV32[:, :, 1:] * coeffs[:, :, 1:]
-            np.clip(bufHSV_CV32, (0, 0, 0), (360, 1, 1), out=bufHSV_CV32)
-            rawLayer.bufCache_HSV_CV32 = bufHSV_CV32.copy()
-    else:
-        pass
-    #############
-    # tone curve
-    ############
-    buf = adjustForm.dngDict.get('ProfileToneCurve', [])
-    # apply profile tone curve, if any
-    if buf:  # non empty list
-        LUTXY = dngProfileToneCurve(buf).toLUTXY(maxrange=255)
-        bufHSV_CV32[:, :, 2] = LUTXY[(bufHSV_CV32[:, :, 2] * 255).astype(np.uint16)] / 255.0  # TODO optimize
-    # apply user tone curve
-    toneForm = adjustForm.toneForm
-    if toneForm is not None:
-        if toneForm.isVisible():
+            # cvtColor RGB2HSV accepts only 8U and 32F buffers
+            bufProfile = interp(LUT, 1.0 / (PROFILE_LUT_SIZE - 1), bufRGB32, convert=False).astype(np.float32, copy=False)
+            bufHSV_CV32 = np.empty((h, w, 3), dtype=np.float32)
+            cv2.cvtColor(bufProfile, cv2.COLOR_RGB2HSV, dst=bufHSV_CV32)
+            del bufProfile
+            rawLayer.bufCache_HSV_CV32 = bufHSV_CV32
+        else:
+            # no copy : the cache is shared with the previous stage
+            rawLayer.bufCache_HSV_CV32 = rawLayer.postProcessCache
+
+    if stage <= STAGE_TONE:
+        ###########
+        # user tone curve and contrast (V channel).
+        # For contrast, we apply an automatic histogram equalization
+        # algorithm, well suited for multimodal histograms.
+        # The user tone curve and the contrast curve are composed
+        # into a single table (cf. toneTable), applied once to V.
+        # bufCache_HSV_CV32 must be preserved.
+        ###########
+        rawLayer.toneCache = None
+        userLUTXY, T = None, None
+        toneForm = adjustForm.toneForm
+        if toneForm is not None and toneForm.isVisible():
             userLUTXY = toneForm.scene().quadricB.LUTXY
-            bufHSV_CV32[:, :, 2] = userLUTXY[(bufHSV_CV32[:, :, 2] * 255).astype(np.uint16)] / 255  # TODO optimize
-    rawLayer.bufCache_HSV_CV32 = bufHSV_CV32.copy()  # CAUTION : must be outside of if toneForm.
+        if adjustForm.contCorrection > 0:
+            # warp should be in range 0..1.
+            # warp = 0 means that no additional warping is done, but
+            # the histogram is always stretched.
+            warp = max(0, (adjustForm.contCorrection - 1)) / 10
+            # the automatic spline is deduced from (a sample of) V after the user tone curve
+            step = max(int(np.sqrt(h * w / HIST_SAMPLE_SIZE)), 1)
+            v = rawLayer.bufCache_HSV_CV32[::step, ::step, 2]
+            if userLUTXY is not None:
+                v = np.interp(v * 255, np.arange(len(userLUTXY)), userLUTXY / 255)
+            a, b, d, T = warpSpline(v, valleyAperture=0.05, warp=warp, preserveHigh=options['Preserve Highlights'],
+                                    spline=None if rawLayer.autoSpline else rawLayer.getMmcSpline())
+            # show the spline
+            if rawLayer.autoSpline and options['manualCurve']:
+                rawLayer.getGraphicsForm().setContrastSpline(a, b, d, T)
+                rawLayer.autoSpline = False
+        if userLUTXY is not None or T is not None:
+            bufHSV_CV32 = rawLayer.bufCache_HSV_CV32.copy()
+            table = toneTable(rawLayer, userLUTXY, T)
+            applyByRows(lambda rows: applyTable16(bufHSV_CV32[rows, :, 2], table, ind[rows]), h)
+            rawLayer.toneCache = bufHSV_CV32
+        else:
+            rawLayer.toneCache = rawLayer.bufCache_HSV_CV32
 
-    # beginning of the contrast-saturation phase : update buffer from the last camera profile applcation
-    bufHSV_CV32 = rawLayer.bufCache_HSV_CV32.copy()
     ###########
-    # contrast (V channel) and saturation correction.
-    # We apply an automatic histogram equalization
-    # algorithm, well suited for multimodal histograms.
+    # saturation correction and conversion to RGB.
+    # toneCache must be preserved.
     ###########
-
-    if adjustForm.contCorrection > 0:
-        # warp should be in range 0..1.
-        # warp = 0 means that no additional warping is done, but
-        # the histogram is always stretched.
-        warp = max(0, (adjustForm.contCorrection - 1)) / 10
-        bufHSV_CV32[:, :, 2], a, b, d, T = warpHistogram(bufHSV_CV32[:, :, 2], valleyAperture=0.05, warp=warp,
-                                                         preserveHigh=options['Preserve Highlights'],
-                                                         spline=None if rawLayer.autoSpline else rawLayer.getMmcSpline())
-        # show the spline
-        if rawLayer.autoSpline and options['manualCurve']:
-            rawLayer.getGraphicsForm().setContrastSpline(a, b, d, T)
-            rawLayer.autoSpline = False
     if adjustForm.satCorrection != 0:
+        bufHSV_CV32 = rawLayer.toneCache.copy()
         satCorr = adjustForm.satCorrection / 100  # range -0.5..0.5
-        alpha = 1.0 / (0.501 + satCorr) - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
-        # tabulate x**alpha
-        LUT = np.power(np.arange(256) / 255, alpha)
+        LUT = saturationLUT(satCorr)
         # convert saturation s to s**alpha
-        bufHSV_CV32[:, :, 1] = LUT[(bufHSV_CV32[:, :, 1] * 255).astype(int)]  # TODO optimize
+        applyByRows(lambda rows: applyLUT(bufHSV_CV32[rows, :, 1], LUT, ind[rows]), h)
+    else:
+        bufHSV_CV32 = rawLayer.toneCache
     # back to RGB
-    bufpostF32_1 = cv2.cvtColor(bufHSV_CV32, cv2.COLOR_HSV2RGB)  # * 65535 # .astype(np.uint16)
-
-    ###################
-    # apply gamma curve
-    ###################
-    bufpostF32_255 = rgbLinear2rgb(bufpostF32_1)
-    #############################
-    # Conversion to 8 bits/channel
-    #############################
-    bufpostUI8 = bufpostF32_255.astype(np.uint8)
-    ###################################################
-    # bufpostUI8 = (bufpost16/256).astype(np.uint8)
-    #################################################
-    if rawLayer.parentImage.useThumb:
-        bufpostUI8 = cv2.resize(bufpostUI8, (currentImage.width(), currentImage.height()))
+    cv2.cvtColor(bufHSV_CV32, cv2.COLOR_HSV2RGB, dst=bufRGB32)
+
+    # apply gamma curve and convert to 8 bits/channel.
+    bufpostUI8 = np.empty((h, w, 3), dtype=np.uint8)
+    gammaEncode8(bufRGB32, bufpostUI8, ind)
 
     bufOut = QImageBuffer(currentImage)
-    bufOut[:, :, :3][:, :, ::-1] = bufpostUI8
+    if rawLayer.parentImage.useThumb:
+        bufOut[:, :, :3][:, :, ::-1] = cv2.resize(bufpostUI8, (currentImage.width(), currentImage.height()))
+    else:
+        bufOut[:, :, :3][:, :, ::-1] = bufpostUI8
     # base layer : no need to forward the alpha channel
     rawLayer.updatePixmap()
+    # all stages are up to date
+    rawLayer.rawStage = STAGE_COLOR + 1
+
+
+def postprocessParams(options, expCorrection, brCorrection, overexpValue, denoiseValue):
+    """
+    Returns the keyword arguments of rawpy postprocess() corresponding
+    to the settings of a development form (cf. graphicsRaw.rawForm).
+    White balance and output parameters are not included.
+    @param options: form options
+    @type options: dict
+    @param expCorrection: exposure shift
+    @type expCorrection: float
+    @param brCorrection: brightness, should be > 0
+    @type brCorrection: float
+    @param overexpValue: highlight mode index
+    @type overexpValue: int
+    @param denoiseValue: fbdd noise reduction index
+    @type denoiseValue: int
+    @return:
+    @rtype: dict
+    """
+    # no_auto_scale = False  don't use : green shift
+    # gamma = (2.222, 4.5) default REC BT 709 (exponent, slope)
+    # gamma = (2.4, 12.92)  # sRGB (exponent, slope) cf. https://en.wikipedia.org/wiki/SRGB#The_sRGB_transfer_function_("gamma")
+    hv, dv = overexpValue, denoiseValue
+    return {'exp_shift': expCorrection if not options['Auto Brightness'] else 0,
+            'no_auto_bright': not options['Auto Brightness'],
+            'bright': brCorrection,  # default 1, should be > 0
+            'exp_preserve_highlights': 0.99 if options['Preserve Highlights'] else 0.2,  # range 0.0..1.0 (1.0 = full preservation)
+            'highlight_mode': rawpy.HighlightMode.Clip if hv == 0
+                              else rawpy.HighlightMode.Ignore if hv == 1
+                              else rawpy.HighlightMode.Blend if hv == 2
+                              else rawpy.HighlightMode.ReconstructDefault,
+            'fbdd_noise_reduction': rawpy.FBDDNoiseReductionMode.Off if dv == 0
+                                    else rawpy.FBDDNoiseReductionMode.Light if dv == 1
+                                    else rawpy.FBDDNoiseReductionMode.Full
+            }
+
+
+def rawColorMatrix(multipliers, temperature, profileTemperature, XYZ2CameraInverseMatrix, dngDict,
+                   exp_preserve_highlights):
+    """
+    Returns the matrix converting postprocessed raw values to linear sRGB.
+    @param multipliers: white balance multipliers used by postprocess
+    @type multipliers: 4-uple of float
+    @param temperature: white balance temperature
+    @type temperature: float
+    @param profileTemperature: temperature used to interpolate the dng forward matrices
+    @type profileTemperature: float
+    @param XYZ2CameraInverseMatrix:
+    @type XYZ2CameraInverseMatrix: ndarray, shape (3, 3)
+    @param dngDict: dng profile
+    @type dngDict: dict
+    @param exp_preserve_highlights:
+    @type exp_preserve_highlights: float
+    @return:
+    @rtype: ndarray, shape (3, 3)
+    """
+    m1, m2, m3 = multipliers[:3]
+    D = np.diag((1/m1, 1/m2, 1/m3))
+    MM = bradfordAdaptationMatrix(6500, temperature)
+    MM1 = bradfordAdaptationMatrix(6500, 5000)
+    FM = None
+    myHighlightPreservation = 0.8 if exp_preserve_highlights > 0.9 else 1.0
+    if dngDict:
+        try:
+            FM = interpolatedForwardMatrix(profileTemperature, dngDict)
+        except ValueError:
+            pass
+    return sRGB_lin2XYZInverse @ MM1 @ FM * myHighlightPreservation if FM is not None else\
+           sRGB_lin2XYZInverse @ MM @ XYZ2CameraInverseMatrix @ D
+
+
+def saturationLUT(satCorr):
+    """
+    Tabulates the saturation correction s --> s**alpha.
+    @param satCorr: correction, range -0.5..0.5
+    @type satCorr: float
+    @return:
+    @rtype: ndarray, shape (256,)
+    """
+    alpha = 1.0 / (0.501 + satCorr) - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
+    return np.power(np.arange(256) / 255, alpha)
+
+
+def gammaEncode8(bufRGB32, bufOut, ind):
+    """
+    Applies the gamma curve to a linear RGB buffer, range 0..1,
+    and converts the result to 8 bits/channel. Like rgbLinear2rgb(),
+    we use the gamma table, but it is converted to uint8 once for all.
+    @param bufRGB32: linear buffer
+    @type bufRGB32: ndarray, shape (h, w, 3), dtype np.float32
+    @param bufOut: output buffer
+    @type bufOut: ndarray, shape (h, w, 3), dtype np.uint8
+    @param ind: scratch buffer
+    @type ind: ndarray, shape (h, w), dtype np.uint16
+    """
+    gt = gammaTables.getInstance()
+    table8 = getattr(gt, 'table8', None)
+    if table8 is None:
+        table8 = gt.table5.astype(np.uint8)
+        gt.table8 = table8
+
+    def g(rows):
+        for c in range(3):
+            np.multiply(bufRGB32[rows, :, c], gammaTables.tableSize, out=ind[rows], casting='unsafe')
+            np.take(table8, ind[rows], out=bufOut[rows, :, c], mode='clip')
+    applyByRows(g, bufRGB32.shape[0])
+
+
+def profileLUT(rawLayer, dngDict, useLookTable, pool=None):
+    """
+    Returns the 3D LUT baking the profile look table and tone curve
+    of dngDict (cf. bakeProfileLUT()). The LUT is cached
+    in rawLayer and rebuilt only when the profile changes.
+    @param rawLayer:
+    @type rawLayer: QRawLayer
+    @param dngDict: dng profile
+    @type dngDict: dict
+    @param useLookTable:
+    @type useLookTable: boolean
+    @param pool:
+    @type pool: multiprocessing.Pool
+    @return: 3D LUT or None
+    @rtype: ndarray
+    """
+    cached = rawLayer.profileLUTCache
+    if cached is not None and cached[0] is dngDict and cached[1] == useLookTable:
+        return cached[2]
+    LUT = bakeProfileLUT(dngDict, useLookTable, pool=pool)
+    rawLayer.profileLUTCache = (dngDict, useLookTable, LUT)
+    return LUT
+
+
+def bakeProfileLUT(dngDict, useLookTable, pool=None):
+    """
+    Returns the 3D LUT baking the profile look table (if useLookTable is True)
+    and the profile tone curve of dngDict, or None if the profile has none of them.
+    Inputs of the LUT are the square roots of linear RGB values, which
+    improves the accuracy of interpolation in the shadows. Outputs are linear RGB values.
+    @param dngDict: dng profile
+    @type dngDict: dict
+    @param useLookTable:
+    @type useLookTable: boolean
+    @param pool:
+    @type pool: multiprocessing.Pool
+    @return: 3D LUT
+    @rtype: ndarray, shape (PROFILE_LUT_SIZE + 1,)*3 + (3,), dtype=np.float32
+    """
+    hsvLUT = dngProfileLookTable(dngDict) if useLookTable else None
+    if hsvLUT is not None and not hsvLUT.isValid:
+        hsvLUT = None
+    toneCurve = dngDict.get('ProfileToneCurve', [])
+    LUTXY = dngProfileToneCurve(toneCurve).toLUTXY(maxrange=255) if len(toneCurve) > 0 else None
+    if hsvLUT is None and LUTXY is None:
+        return None
+    # grid nodes. The last node is a sentinel (cf. interpTriLinear)
+    n = PROFILE_LUT_SIZE
+    u = np.minimum(np.arange(n + 1, dtype=np.float32) / (n - 1), 1)
+    grid = np.stack(np.meshgrid(u, u, u, indexing='ij'), axis=-1).reshape((n + 1) ** 2, n + 1, 3)
+    grid *= grid
+    bufHSV = cv2.cvtColor(grid, cv2.COLOR_RGB2HSV)
+    if hsvLUT is not None:
+        divs = hsvLUT.divs
+        steps = tuple([360 / divs[0], 1.0 / (divs[1] - 1), 1.0 / (divs[2] - 1)])
+        coeffs = chosenInterp(pool, grid.shape[0] * grid.shape[1])(hsvLUT.data, steps, bufHSV, convert=False)
+        bufHSV[:, :, 0] = np.mod(bufHSV[:, :, 0] + coeffs[:, :, 0], 360)
+        bufHSV[:, :, 1:] = bufHSV[:, :, 1:] * coeffs[:, :, 1:]
+        np.clip(bufHSV, (0, 0, 0), (360, 1, 1), out=bufHSV)
+    if LUTXY is not None:
+        bufHSV[:, :, 2] = np.interp(bufHSV[:, :, 2] * 255, np.arange(len(LUTXY)), LUTXY) / 255
+    return np.ascontiguousarray(cv2.cvtColor(bufHSV, cv2.COLOR_HSV2RGB).reshape((n + 1,) * 3 + (3,)))
+
+
+def applyLUT(channel, LUT, ind):
+    """
+    Applies in place a 256 entries LUT to a float channel,
+    range 0..1. The channel is discretized in 256 levels.
+    @param channel: image channel (view)
+    @type channel: ndarray, dtype np.float32
+    @param LUT:
+    @type LUT: ndarray, shape (256,)
+    @param ind: scratch buffer, same shape as channel
+    @type ind: ndarray, dtype np.uint16
+    """
+    np.multiply(channel, 255, out=ind, casting='unsafe')
+    np.take(LUT.astype(np.float32), ind, out=channel, mode='clip')
+
+
+def composeToneTable(userLUTXY, T):
+    """
+    Composes the user tone curve and the contrast curve
+    into a single table with TONE_TABLE_SIZE entries, mapping
+    the range 0..1 of the V channel to 0..1 (cf. applyTable16()).
+    @param userLUTXY: user tone curve, range 0..255 --> 0..255, or None
+    @type userLUTXY: ndarray, shape (256,)
+    @param T: contrast curve, range 0..255 --> 0..1 (cf. warpSpline()), or None
+    @type T: ndarray
+    @return:
+    @rtype: ndarray, shape (TONE_TABLE_SIZE,), dtype np.float32
+    """
+    x = np.arange(TONE_TABLE_SIZE) / (TONE_TABLE_SIZE - 1)
+    if userLUTXY is not None:
+        x = np.interp(x * 255, np.arange(len(userLUTXY)), userLUTXY / 255)
+    if T is not None:
+        # extrapolate T to handle eventual value 256 (cf. warpHistogram)
+        T1 = np.hstack((T, [T[-1]]))
+        x = np.clip(np.interp(x * 255, np.arange(len(T1)), T1), 0, 1)
+    return x.astype(np.float32)
+
+
+def toneTable(rawLayer, userLUTXY, T):
+    """
+    Returns the composition of the user tone curve and the contrast
+    curve (cf. composeToneTable()). The table is cached in rawLayer
+    and rebuilt only when a curve changes.
+    @param rawLayer:
+    @type rawLayer: QRawLayer
+    @param userLUTXY: user tone curve or None
+    @type userLUTXY: ndarray
+    @param T: contrast curve or None
+    @type T: ndarray
+    @return:
+    @rtype: ndarray, shape (TONE_TABLE_SIZE,), dtype np.float32
+    """
+    key = (None if userLUTXY is None else np.asarray(userLUTXY).tobytes(),
+           None if T is None else np.asarray(T).tobytes())
+    cached = rawLayer.toneTableCache
+    if cached is None or cached[0] != key:
+        cached = (key, composeToneTable(userLUTXY, T))
+        rawLayer.toneTableCache = cached
+    return cached[1]
+
+
+def applyTable16(channel, table, ind):
+    """
+    Applies in place a tone table with TONE_TABLE_SIZE
+    entries to a float channel, range 0..1.
+    @param channel: image channel (view)
+    @type channel: ndarray, dtype np.float32
+    @param table:
+    @type table: ndarray, shape (TONE_TABLE_SIZE,), dtype np.float32
+    @param ind: scratch buffer, same shape as channel
+    @type ind: ndarray, dtype np.uint16
+    """
+    np.multiply(channel, TONE_TABLE_SIZE - 1, out=ind, casting='unsafe')
+    np.take(table, ind, out=channel, mode='clip')
+
+
+def applyByRows(func, height):
+    """
+    Calls func(rows) for horizontal bands of an image, using a pool
+    of threads. Numpy releases the GIL during element wise operations,
+    so bands are processed concurrently.
+    @param func: band processing function
+    @type func: function(slice)
+    @param height: image height
+    @type height: int
+    """
+    global bandPool
+    if bandPool is None:
+        bandPool = ThreadPool(BAND_COUNT)
+    step = max(-(-height // BAND_COUNT), 1)
+    bandPool.map(func, [slice(y, min(y + step, height)) for y in range(0, height, step)])
@@ -0,0 +1,141 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+import cv2
+
+from bLUeCore.tiling import getTilePool
+
+# size of the tiles refined at full resolution
+GRABCUT_TILE_SIZE = 512
+
+
+def getGrabcut():
+    """
+    Returns the fastest available grabcut function.
+    @return:
+    @rtype: function
+    """
+    if getattr(cv2, 'grabCut_mt', None) is None:
+        return cv2.grabCut
+    return cv2.grabCut_mt
+
+
+def isForeground(segMask):
+    """
+    Returns the (probable) foreground of a grabcut mask.
+    @param segMask:
+    @type segMask: ndarray, dtype=np.uint8
+    @return:
+    @rtype: ndarray, dtype=bool
+    """
+    return (segMask == cv2.GC_FGD) | (segMask == cv2.GC_PR_FGD)
+
+
+def downscaleSegMask(segMask, size):
+    """
+    Downscales a grabcut mask. Thin user strokes are kept :
+    a cell containing a definite foreground (resp. background) pixel
+    is labeled as definite foreground (resp. background), foreground first.
+    @param segMask: grabcut mask
+    @type segMask: ndarray, shape (h, w), dtype=np.uint8
+    @param size: (width, height)
+    @type size: 2-uple of int
+    @return: downscaled mask
+    @rtype: ndarray, dtype=np.uint8
+    """
+    small = cv2.resize(segMask, size, interpolation=cv2.INTER_NEAREST)
+    for label in (cv2.GC_BGD, cv2.GC_FGD):
+        m = cv2.resize((segMask == label).astype(np.uint8) * 255, size, interpolation=cv2.INTER_AREA)
+        small[m > 0] = label
+    return small
+
+
+def pyramidGrabcut(buf, segMask, nbIter, mode, maxSize, band):
+    """
+    Coarse to fine grabcut segmentation.
+    The image is segmented at a scale where its largest dimension is
+    maxSize, and the foreground is upscaled. Pixels farther than band from
+    the foreground/background boundary are then fixed, and the
+    boundary band is refined at full resolution, by tiles processed in parallel.
+    Definite labels of segMask (user strokes) are preserved.
+    segMask is updated in place. If the image is not larger than maxSize,
+    a single grabcut is done.
+    @param buf: image
+    @type buf: ndarray, shape (h, w, 3), dtype=np.uint8
+    @param segMask: grabcut mask
+    @type segMask: ndarray, shape (h, w), dtype=np.uint8
+    @param nbIter: grabcut iteration count
+    @type nbIter: int
+    @param mode: grabcut mode
+    @type mode: int
+    @param maxSize: max size of the coarse image
+    @type maxSize: int
+    @param band: half width of the refined band (full resolution pixels)
+    @type band: int
+    """
+    grabcut = getGrabcut()
+    h, w = segMask.shape
+    if maxSize <= 0 or max(h, w) <= maxSize:
+        bgdmodel = np.zeros((1, 13 * 5), np.float64)  # Temporary array for the background GMM model
+        fgdmodel = np.zeros((1, 13 * 5), np.float64)  # Temporary array for the foreground GMM model
+        grabcut(buf, segMask, None, bgdmodel, fgdmodel, nbIter, mode)
+        return
+    ##########################
+    # coarse segmentation
+    ##########################
+    scale = maxSize / max(h, w)
+    size = (max(int(w * scale), 1), max(int(h * scale), 1))
+    smallBuf = cv2.resize(buf, size, interpolation=cv2.INTER_AREA)
+    smallMask = downscaleSegMask(segMask, size)
+    grabcut(smallBuf, smallMask, None, np.zeros((1, 13 * 5), np.float64), np.zeros((1, 13 * 5), np.float64), nbIter, mode)
+    fg = cv2.resize(isForeground(smallMask).astype(np.uint8) * 255, (w, h), interpolation=cv2.INTER_LINEAR) > 127
+    ##########################
+    # uncertain boundary band
+    ##########################
+    fg8 = fg.astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * band + 1, 2 * band + 1))
+    uncertain = cv2.dilate(fg8, kernel) != cv2.erode(fg8, kernel)
+    userFixed = (segMask == cv2.GC_FGD) | (segMask == cv2.GC_BGD)
+    fineMask = np.where(fg, cv2.GC_FGD, cv2.GC_BGD).astype(np.uint8)
+    fineMask[uncertain] = np.where(fg[uncertain], cv2.GC_PR_FGD, cv2.GC_PR_BGD)
+    fineMask[userFixed] = segMask[userFixed]
+    ##########################
+    # full resolution refinement of tiles
+    # containing a part of the band.
+    ##########################
+    tiles = [(r, c) for r in range(0, h, GRABCUT_TILE_SIZE) for c in range(0, w, GRABCUT_TILE_SIZE)
+             if uncertain[r:r + GRABCUT_TILE_SIZE, c:c + GRABCUT_TILE_SIZE].any()]
+    margin = 2 * band
+
+    def f(tile):
+        r, c = tile
+        r0, r1 = max(r - margin, 0), min(r + GRABCUT_TILE_SIZE + margin, h)
+        c0, c1 = max(c - margin, 0), min(c + GRABCUT_TILE_SIZE + margin, w)
+        tMask = fineMask[r0:r1, c0:c1].copy()
+        tFg = isForeground(tMask)
+        # grabcut needs foreground and background samples
+        if tFg.all() or not tFg.any():
+            return
+        grabcut(np.ascontiguousarray(buf[r0:r1, c0:c1]), tMask, None,
+                np.zeros((1, 13 * 5), np.float64), np.zeros((1, 13 * 5), np.float64), 1, cv2.GC_INIT_WITH_MASK)
+        segMask[r:r + GRABCUT_TILE_SIZE, c:c + GRABCUT_TILE_SIZE] = tMask[r - r0:r - r0 + GRABCUT_TILE_SIZE,
+                                                                          c - c0:c - c0 + GRABCUT_TILE_SIZE]
+
+    # tiles without band pixels are fixed
+    segMask[...] = fineMask
+    getTilePool().map(f, tiles)
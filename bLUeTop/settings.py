@@ -54,6 +54,8 @@ else:
     SYSTEM_PROFILE_DIR = expanduser(CONFIG["PATHS"]["SYSTEM_PROFILE_DIR"])
     DNG_PROFILES_DIR1 = expanduser(CONFIG["DNG_PROFILES"]["DIR1"])
     DNG_PROFILES_DIR2 = expanduser(CONFIG["DNG_PROFILES"]["DIR2"])
+# cache of parsed profiles (cf. dng.getDngProfileDict)
+DNG_PROFILES_CACHE_DIR = expanduser(CONFIG["DNG_PROFILES"]["CACHE_DIR"])
 
 ADOBE_RGB_PROFILE_PATH = SYSTEM_PROFILE_DIR + CONFIG["PROFILES"]["ADOBE_RGB_PROFILE_NAME"]  # "\AdobeRGB1998.icc"
 SRGB_PROFILE_PATH = SYSTEM_PROFILE_DIR + CONFIG["PROFILES"]["SRGB_PROFILE_NAME"]  # "\sRGB Color Space Profile.icm"
@@ -86,3 +88,11 @@ THEME = CONFIG["LOOK"]["THEME"]
 #########
 MAX_ZOOM = CONFIG["PARAMS"]["MAX_ZOOM"]
 TABBING = CONFIG["PARAMS"]["TABBING"]
+PROGRESSIVE_RENDER = CONFIG["PARAMS"]["PROGRESSIVE_RENDER"]
+RENDER_TILE_SIZE = CONFIG["PARAMS"]["RENDER_TILE_SIZE"]
+HIST_SAMPLE_SIZE = CONFIG["PARAMS"]["HIST_SAMPLE_SIZE"]
+RAW_BATCH_MEMORY = CONFIG["PARAMS"]["RAW_BATCH_MEMORY"]
+RAW_DOCUMENT_MEMORY = CONFIG["PARAMS"]["RAW_DOCUMENT_MEMORY"]
+EDGE_PRESERVING_FILTER = CONFIG["PARAMS"]["EDGE_PRESERVING_FILTER"]
+GRABCUT_PYRAMID_SIZE = CONFIG["PARAMS"]["GRABCUT_PYRAMID_SIZE"]
+GRABCUT_BAND = CONFIG["PARAMS"]["GRABCUT_BAND"]
@@ -48,12 +48,16 @@ from bLUeGui.colorCIE import sRGB2LabVec, Lab2sRGBVec, rgb2rgbLinear, \
     rgbLinear2rgb, RGB2XYZ, sRGB_lin2XYZInverse, bbTemperature2RGB, sRGB_lin2XYZ
 from bLUeGui.multiplier import temperatureAndTint2Multipliers
 from bLUeGui.dialog import dlgWarn
-from bLUeCore.kernel import getKernel
+from bLUeCore.kernel import applyKernel
 from bLUeTop.lutUtils import LUT3DIdentity
 from bLUeTop.rawProcessing import rawPostProcess
 from bLUeTop.utils import UDict
-from bLUeCore.dwtDenoising import dwtDenoiseChan
+from bLUeCore.dwtDenoising import dwtDenoise
+from bLUeCore.tiling import tiledFilter
+from bLUeCore.guidedFilter import guidedFilter, guidedRadius, guidedSupport
 from bLUeTop.mergeImages import expFusion
+from bLUeTop.segmentation import pyramidGrabcut
+from bLUeTop.settings import EDGE_PRESERVING_FILTER, GRABCUT_PYRAMID_SIZE, GRABCUT_BAND
 
 
 class ColorSpace:
@@ -700,7 +704,7 @@ class vImage(bImage):
         bufOut[:, :, :] = bufIn
         self.updatePixmap()
 
-    def applyCloning(self, seamless=True, showTranslated=False, moving=False):  # TODO remove parameter showTranslated
+    def applyCloning(self, seamless=True, showTranslated=False, moving=False, preview=False):  # TODO remove parameter showTranslated
         """
         Seamless cloning. In addition to the layer input image, (output) image
         and mask, the method uses a source pixmap. The pixmap can
@@ -716,6 +720,8 @@ class vImage(bImage):
         @type showTranslated:
         @param moving: flag indicating if the method is triggered by a mouse event
         @type moving: boolean
+        @param preview: fast low resolution seamless cloning, used while dragging
+        @type preview: boolean
         """
         adjustForm = self.getGraphicsForm()
         options = adjustForm.options
@@ -792,15 +798,17 @@ class vImage(bImage):
         #####################
         if seamless:
             try:
-                QApplication.setOverrideCursor(Qt.WaitCursor)
-                app.processEvents()
+                if not preview:
+                    QApplication.setOverrideCursor(Qt.WaitCursor)
+                    app.processEvents()
                 # temporary dest image
                 imgInc = QImage(imgIn)
                 ###########################
                 # clone imgOut into imgInc
                 ###########################
                 self.seamlessMerge(imgInc, imgOut, self.mask, self.cloningMethod,
-                                     version="blue" if options['blue'] else 'opencv', w=16)
+                                     version="blue" if options['blue'] else 'opencv', w=16,
+                                     preview=preview)
                 #########################################
                 # copy imgInc into imgOut.
                 # To ensure interactive mask
@@ -818,8 +826,9 @@ class vImage(bImage):
                 bufOut[...] = alphaBlend(QImageBuffer(imgInc), bufOut, vImage.colorMask2BinaryArray(mask))
             finally:
                 self.parentImage.setModified(True)
-                QApplication.restoreOverrideCursor()
-                QApplication.processEvents()
+                if not preview:
+                    QApplication.restoreOverrideCursor()
+                    QApplication.processEvents()
         # should we forward the alpha channel ?
         self.updatePixmap()
         # the presentation layer must be updated here because
@@ -893,17 +902,13 @@ class vImage(bImage):
         #############
         # do segmentation
         #############
-        bgdmodel = np.zeros((1, 13 * 5), np.float64)  # Temporary array for the background GMM model
-        fgdmodel = np.zeros((1, 13 * 5), np.float64)  # Temporary array for the foreground GMM model
+        # large images are segmented at low resolution and the
+        # boundary is refined at full resolution (cf. segmentation.py)
         t0 = time()
         inputBuf = QImageBuffer(inputImg)
-        # get the fastest available grabcut function
-        if getattr(cv2, 'grabCut_mt', None) is None:
-            bGrabcut = cv2.grabCut
-        else:
-            bGrabcut = cv2.grabCut_mt
-        bGrabcut(inputBuf[:, :, :3], segMask, None, bgdmodel, fgdmodel, nbIter, mode)
-        print('%s : %.2f' % (bGrabcut.__name__, (time()-t0)))
+        pyramidGrabcut(np.ascontiguousarray(inputBuf[:, :, :3]), segMask, nbIter, mode,
+                       GRABCUT_PYRAMID_SIZE, GRABCUT_BAND)
+        print('grabcut : %.2f' % (time()-t0))
 
         # back to mask
         unmasked = vImage.defaultColor_UnMasked.red()
@@ -992,13 +997,17 @@ class vImage(bImage):
             outBuf[:, :, :] = inBuf
             self.updatePixmap()
             return
+        # align images on the first one.
+        # Homographies are cached by (source, target) layer pairs
         bufList = []
         pred = None
         for layer in mergingLayers:
             img = layer.getCurrentImage()
             buf = QImageBuffer(img)
-            if pred is not None:
-                buf[...] = alignImages(buf, pred)
+            if pred is None:
+                pred, predLayer = buf, layer
+            else:
+                buf, _ = alignImages(buf, pred, cache=self.alignCache, key=(id(layer), id(predLayer)))
             bufList.append(buf[:, :, :3])
 
         # buf = np.stack(bufList, axis=-1)
@@ -1122,7 +1131,7 @@ class vImage(bImage):
             buf0 = QImageBuffer(inImg)
             outImg = self.getCurrentImage()
             buf1 = QImageBuffer(outImg)
-            imalgn, h = alignImages(buf1, buf0)
+            imalgn, h = alignImages(buf1, buf0, cache=self.alignCache, key='input')
             buf1[...] = imalgn
             self.updatePixmap()
 
@@ -1166,27 +1175,50 @@ class vImage(bImage):
         if adjustForm.options['Wavelets']:
             noisecorr *= 100
             bufLab = cv2.cvtColor(buf01, cv2.COLOR_RGB2Lab)
-            L = dwtDenoiseChan(bufLab, chan=0, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
-            A = dwtDenoiseChan(bufLab, chan=1, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
-            B = dwtDenoiseChan(bufLab, chan=2, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
-            np.clip(L, 0, 255, out=L)
-            np.clip(A, 0, 255, out=A)
-            np.clip(B, 0, 255, out=B)
-            bufLab = np.dstack((L, A, B))
+            # all channels and levels are denoised in parallel
+            bufLab = dwtDenoise(bufLab, thr=noisecorr, thrmode='wiener')  # level=8 if self.parentImage.useThumb else 11)
+            np.clip(bufLab, 0, 255, out=bufLab)
             # back to RGB
             ROI1[:, :, ::-1] = cv2.cvtColor(bufLab.astype(np.uint8), cv2.COLOR_Lab2RGB)
-        elif adjustForm.options['Bilateral']:
-            ROI1[:, :, ::-1] = cv2.bilateralFilter(buf01,
-                                         9 if self.parentImage.useThumb else 15,    # 21:5.5s, 15:3.5s, diameter of
-                                                                                    # (coordinate) pixel neighborhood,
-                                                                                    # 5 is the recommended value for fast processing
-                                         10 * adjustForm.noiseCorrection,           # std deviation sigma
-                                                                                    # in color space,  100 middle value
-                                         50 if self.parentImage.useThumb else 150,  # std deviation sigma
-                                                                                    # in coordinate space,  100 middle value
-                                         )
-        elif adjustForm.options['NLMeans']:
-            ROI1[:, :, ::-1] = cv2.fastNlMeansDenoisingColored(buf01, None, 1+noisecorr, 1+noisecorr, 7, 21)  # hluminance, hcolor,  last params window sizes 7, 21 are recommended values
+        else:
+            # tiled filtering : the visible tiles are processed first and
+            # the task stops early if the background rendering is preempted
+            renderer = self.parentImage.renderer
+            gen = renderer.generation
+            first = None
+            vRect = getattr(self.parentImage, 'visibleRect', None)
+            if vRect is not None:
+                # visible rectangle in ROI coordinates
+                left, top = (0, 0) if self.rect is None else (int(rect.left() * r), int(rect.top() * r))
+                s = currentImage.width() / self.parentImage.width()
+                first = (vRect.left() * s - left, vRect.top() * s - top,
+                         (vRect.right() + 1) * s - left, (vRect.bottom() + 1) * s - top)
+            if adjustForm.options['Bilateral']:
+                d = 9 if self.parentImage.useThumb else 15  # 21:5.5s, 15:3.5s, diameter of
+                                                            # (coordinate) pixel neighborhood,
+                                                            # 5 is the recommended value for fast processing
+                sigmaColor = 10 * adjustForm.noiseCorrection  # std deviation sigma
+                                                              # in color space,  100 middle value
+                sigmaSpace = 50 if self.parentImage.useThumb else 150  # std deviation sigma
+                                                                       # in coordinate space,  100 middle value
+                if EDGE_PRESERVING_FILTER == 'guided':
+                    gRadius = guidedRadius(d)
+                    func = lambda tile: cv2.convertScaleAbs(guidedFilter(tile, gRadius, sigmaColor * sigmaColor))
+                    radius = guidedSupport(gRadius)
+                else:
+                    func, radius = lambda tile: cv2.bilateralFilter(tile, d, sigmaColor, sigmaSpace), d // 2
+            elif adjustForm.options['NLMeans']:
+                # hluminance, hcolor,  last params window sizes 7, 21 are recommended values
+                func = lambda tile: cv2.fastNlMeansDenoisingColored(tile, None, 1+noisecorr, 1+noisecorr, 7, 21)
+                radius = 21 // 2 + 7 // 2
+            else:
+                func = None
+            if func is not None:
+                res = tiledFilter(buf01, func, radius, out=ROI1[:, :, ::-1], first=first,
+                                  progress=renderer.layerProgress, isCancelled=lambda: renderer.isCancelled(gen))
+                if res is False:
+                    # preempted : the layer will be recomputed
+                    return
 
         # forward the alpha channel
         buf1[:, :, 3] = buf0[:, :, 3]
@@ -1641,14 +1673,19 @@ class vImage(bImage):
                                          filterIndex.SHARPEN, filterIndex.BLUR1, filterIndex.BLUR2]:
             # correct radius for preview if needed
             radius = int(adjustForm.radius * r)
-            kernel = getKernel(adjustForm.kernelCategory, radius, adjustForm.amount)
-            ROI1[:, :, :] = cv2.filter2D(ROI0, -1, kernel)
+            ROI1[:, :, :] = applyKernel(ROI0, adjustForm.kernelCategory, radius, adjustForm.amount)
         else:
             # bilateral filtering
             radius = int(adjustForm.radius * r)
             sigmaColor = 2 * adjustForm.tone
             sigmaSpace = sigmaColor
-            ROI1[:, :, ::-1] = cv2.bilateralFilter(ROI0[:, :, ::-1], radius, sigmaColor, sigmaSpace)
+            if EDGE_PRESERVING_FILTER == 'guided':
+                # radius is the diameter of the pixel neighborhood of the bilateral filter
+                gRadius = guidedRadius(radius)
+                tiledFilter(ROI0, lambda tile: cv2.convertScaleAbs(guidedFilter(tile, gRadius, sigmaColor * sigmaColor)),
+                            guidedSupport(gRadius), out=ROI1)
+            else:
+                ROI1[:, :, ::-1] = cv2.bilateralFilter(ROI0[:, :, ::-1], radius, sigmaColor, sigmaSpace)
         # forward the alpha channel
         buf1[:, :, 3] = buf0[:, :, 3]
         self.updatePixmap()
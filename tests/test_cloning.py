@@ -0,0 +1,49 @@
+"""
+Regression tests for the multigrid Laplace solver of seamless cloning.
+"""
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('PySide2')
+
+from bLUeTop.cloning import membrane
+
+
+def ellipseRegion(h, w):
+    """
+    Returns an elliptical cloning mask and its contour.
+    """
+    yy, xx = np.mgrid[:h, :w]
+    mask = ((((yy - h / 2) / (h * 0.45)) ** 2 + ((xx - w / 2) / (w * 0.45)) ** 2) < 1).astype(np.uint8) * 255
+    contour = np.zeros_like(mask)
+    conts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+    cv2.drawContours(contour, conts, -1, 255, 3)
+    return mask, contour
+
+
+@pytest.mark.parametrize('h, w', [(140, 180), (300, 400), (201, 203)])
+def test_membrane_linear(h, w):
+    # linear boundary values : the harmonic interpolation is the same linear function
+    mask, contour = ellipseRegion(h, w)
+    xx = np.mgrid[:h, :w][1]
+    g = np.dstack([xx * 100.0 / w] * 3).astype(np.float32)
+    inner = (contour != 255) & (mask == 255)
+    out = membrane(g, mask, contour)
+    assert np.abs(out - g)[inner].max() < 0.5
+    # exterior is unchanged
+    assert np.array_equal(out[~inner], g[~inner])
+    # warm start
+    out = membrane(g, mask, contour, init=out)
+    assert np.abs(out - g)[inner].max() < 0.5
+
+
+def test_membrane_constant_square():
+    h, w = 201, 203
+    mask = np.full((h, w), 255, dtype=np.uint8)
+    contour = np.zeros_like(mask)
+    contour[:2], contour[-2:], contour[:, :2], contour[:, -2:] = 255, 255, 255, 255
+    g = np.zeros((h, w, 3), dtype=np.float32)
+    g[contour == 255] = 100
+    out = membrane(g, mask, contour)
+    assert np.abs(out - 100).max() < 0.5